@@ -1,8 +1,95 @@
-from api.views import *
-from models import Base, engine
+import argparse
+import sys
+from datetime import datetime, timedelta
 
+from models import Base, Session, get_engine
+from models.account import Balance, compact_holdings as compact
+from models.order import Reservation, reserve_open_orders as reserve
+import models.contract  # noqa: F401 -- the mappers of `Order` and `Transaction` refer to `Contract`
 
-if __name__ == '__main__':
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+
+def runserver():
+    from api.views import app
+
+    Base.metadata.drop_all(bind=get_engine())
+    Base.metadata.create_all(bind=get_engine())
     app.run(debug=True)
+
+
+def verify_balances():
+    session = Session()
+    mismatches = Balance.verify(session)
+    for user_id, asset_id, ledger_volume, balance_volume in mismatches:
+        print('User {}, asset {}: ledger says {}, balance says {}'.format(user_id, asset_id, ledger_volume,
+                                                                          balance_volume))
+    print('{} balance(s) differ from the ledger'.format(len(mismatches)))
+
+    reserved_mismatches = Reservation.verify(session)
+    for user_id, asset_id, reserved_by_orders, balance_reserved in reserved_mismatches:
+        print('User {}, asset {}: open orders reserve {}, balance says {}'.format(user_id, asset_id,
+                                                                                 reserved_by_orders, balance_reserved))
+    print('{} balance(s) differ from the reservations'.format(len(reserved_mismatches)))
+    return 1 if mismatches or reserved_mismatches else 0
+
+
+def rebuild_balances():
+    session = Session()
+    Balance.rebuild(session)
+    Reservation.rebuild(session)
+    session.commit()
+    print('Rebuilt balances from the ledger and the reservations')
+    return 0
+
+
+def reserve_open_orders():
+    session = Session()
+    count = reserve(session)
+    print('Moved the funds of {} open order(s) into reservations'.format(count))
+    return 0
+
+
+def compact_holdings():
+    parser = argparse.ArgumentParser(prog='manage.py compact_holdings',
+                                     description='Replace old holdings with one snapshot per user and asset')
+    parser.add_argument('--days', type=int, default=90, help='compact holdings older than this many days')
+    args = parser.parse_args(sys.argv[2:])
+
+    session = Session()
+    count = compact(session, datetime.now() - timedelta(days=args.days))
+    print('Archived {} holding(s)'.format(count))
+    return 0
+
+
+def export():
+    from models.export import TABLES, FORMATS, export_table
+
+    parser = argparse.ArgumentParser(prog='manage.py export', description='Export tables to files, resuming where the '
+                                                                          'last export to the same directory stopped')
+    parser.add_argument('directory')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--tables', nargs='+', choices=sorted(TABLES), default=sorted(TABLES))
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args(sys.argv[2:])
+
+    with get_engine().connect() as connection:
+        for name in args.tables:
+            count = export_table(connection, name, args.directory, args.format, args.chunk_size)
+            print('Exported {} row(s) of {}'.format(count, name))
+    return 0
+
+
+commands = {
+    'runserver': runserver,
+    'verify_balances': verify_balances,
+    'rebuild_balances': rebuild_balances,
+    'compact_holdings': compact_holdings,
+    'reserve_open_orders': reserve_open_orders,
+    'export': export,
+}
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'runserver'
+    if command not in commands:
+        sys.exit('Unknown command {}; choose one of {}'.format(command, ', '.join(sorted(commands))))
+    sys.exit(commands[command]())
@@ -0,0 +1,305 @@
+"""
+An in-memory order book per contract.
+
+Resting limit orders are kept in sorted price levels, keyed by the unit price (`price` / `volume`) of the order, with a
+FIFO queue at each level. `put_order` walks this structure to find a counterparty, so only the results of matching ever
+touch the database.
+
+The book assumes a single writer per contract: every order that enters or leaves the market for a contract has to go
+through the same process. Entries are verified against the database when they are picked as a counterparty, so orders
+that were cancelled elsewhere are dropped lazily.
+
+Sessions with `session.info['row_locks']` set do without the in-memory book and take their candidates straight from
+the database with `SELECT ... FOR UPDATE SKIP LOCKED` (see `LockingBook`), so any number of matchers can work on the
+same contract at once:
+
+    LockingSession = sessionmaker(class_=LazySession, info={'row_locks': True})
+"""
+
+import bisect
+import logging
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import event, or_
+from sqlalchemy.orm import Session, joinedload
+
+from models.consts import DirectionType, OrderType, OrderStateType
+from models.fixed import price_units, volume_units, price_from_units
+from models.order import Order
+
+
+logger = logging.getLogger(__file__)
+
+
+def live(now=None):
+    """Criterion for orders that have not expired by `now`"""
+    return or_(Order.expires_at.is_(None), Order.expires_at > (now or datetime.now()))
+
+
+class BookOrder(object):
+
+    """
+    What the book needs to know about a resting order, without holding on to a session bound `Order`. `unit_price` and
+    `volume` are integers in units of `PRICE_QUANTUM` and `VOLUME_QUANTUM` (see `models.fixed`).
+    """
+
+    __slots__ = ('order_id', 'user_id', 'asset_id', 'direction', 'unit_price', 'volume', 'expires_at')
+
+    def __init__(self, order_id, user_id, asset_id, direction, unit_price, volume, expires_at=None):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.asset_id = asset_id
+        self.direction = direction
+        self.unit_price = unit_price
+        self.expires_at = expires_at
+
+        # The part of the order that has not been filled yet
+        self.volume = volume
+
+    @classmethod
+    def from_order(cls, order):
+        return cls(order.id, order.user_id, order.asset_id, order.direction, price_units(order.price_to_volume),
+                   volume_units(order.remaining_volume), order.expires_at)
+
+    def __repr__(self):
+        return "<BookOrder {} {} @ {}>".format(self.order_id, self.direction, price_from_units(self.unit_price))
+
+
+class OrderBook(object):
+
+    def __init__(self, contract_id):
+        self.contract_id = contract_id
+
+        # Sorted (ascending) integer unit prices per side, and a FIFO queue of `BookOrder`s for each of those prices
+        self._prices = {DirectionType.bid.value: [], DirectionType.ask.value: []}
+        self._levels = {DirectionType.bid.value: {}, DirectionType.ask.value: {}}
+        self._orders = {}
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    @classmethod
+    def load(cls, session, contract_id, now=None):
+        book = cls(contract_id)
+        resting_orders = session.query(Order)\
+            .filter(Order.contract_id == contract_id)\
+            .filter(Order.state == OrderStateType.in_market.value)\
+            .filter(Order.order_type == OrderType.limit_order.value)\
+            .filter(Order.price.isnot(None))\
+            .filter(live(now))\
+            .order_by(Order.created_at, Order.id)
+
+        for order in resting_orders:
+            book.add(order)
+
+        logger.info('Loaded order book for contract %s with %s orders', contract_id, len(book))
+        return book
+
+    def add(self, order):
+        self.add_entry(BookOrder.from_order(order))
+
+    def add_entry(self, entry):
+        if entry.order_id in self._orders:
+            self._orders[entry.order_id].volume = entry.volume
+            return
+
+        prices, levels = self._prices[entry.direction], self._levels[entry.direction]
+        level = levels.get(entry.unit_price)
+        if level is None:
+            level = levels[entry.unit_price] = deque()
+            bisect.insort(prices, entry.unit_price)
+
+        level.append(entry)
+        self._orders[entry.order_id] = entry
+
+    def remove(self, order_id):
+        entry = self._orders.pop(order_id, None)
+        if entry is None:
+            return
+
+        prices, levels = self._prices[entry.direction], self._levels[entry.direction]
+        level = levels[entry.unit_price]
+        level.remove(entry)
+        if not level:
+            del levels[entry.unit_price]
+            del prices[bisect.bisect_left(prices, entry.unit_price)]
+
+    def update(self, order):
+        """Make the book reflect the current state of `order`"""
+        if order.state == OrderStateType.in_market.value and order.order_type == OrderType.limit_order.value \
+                and order.price is not None and order.remaining_volume > 0:
+            self.add(order)
+        else:
+            self.remove(order.id)
+
+    def best_price(self, direction):
+        prices = self._prices[direction]
+        if not prices:
+            return None
+        return price_from_units(prices[-1] if direction == DirectionType.bid.value else prices[0])
+
+    def resting(self, direction):
+        """Yields the resting orders of one side in price-time priority"""
+        prices, levels = self._prices[direction], self._levels[direction]
+        ordered_prices = reversed(prices) if direction == DirectionType.bid.value else iter(prices)
+        for unit_price in list(ordered_prices):
+            for entry in list(levels.get(unit_price, ())):
+                yield entry
+
+    def candidates(self, order, now=None):
+        """Yields the resting orders that `order` may be matched with, best first. Expired orders are passed over."""
+        if order.direction == DirectionType.ask.value:
+            reciprocal_direction = DirectionType.bid.value
+        else:
+            reciprocal_direction = DirectionType.ask.value
+
+        # Market orders are only limited if they specify a price
+        limit = price_units(order.price_to_volume) if order.price is not None else None
+        now = now or datetime.now()
+        for entry in self.resting(reciprocal_direction):
+            if limit is not None:
+                if order.direction == DirectionType.ask.value and entry.unit_price < limit:
+                    return
+                if order.direction == DirectionType.bid.value and entry.unit_price > limit:
+                    return
+
+            if entry.user_id == order.user_id or entry.asset_id != order.asset_id:
+                continue
+
+            # The expiry scheduler takes these out of the book
+            if entry.expires_at is not None and entry.expires_at <= now:
+                continue
+
+            yield entry
+
+    def matches(self, session, order, now=None):
+        """Yields the resting `Order`s that `order` can be matched with and that are still in the market"""
+        # The owner of every order that is filled is needed to settle the trade; load it along with the order
+        for entry in self.candidates(order, now):
+            reciprocal_order = session.query(Order).options(joinedload(Order.user)).get(entry.order_id)
+            if reciprocal_order is None or reciprocal_order.state != OrderStateType.in_market.value:
+                logger.info('Dropping stale order %s from book of contract %s', entry.order_id, self.contract_id)
+                self.remove(entry.order_id)
+                continue
+
+            yield reciprocal_order
+
+
+class LockingBook(object):
+
+    """
+    Finds candidates in the database instead of in memory and locks them for the rest of the transaction. Orders that
+    another matcher has locked are skipped rather than waited for, so concurrent matchers never fill the same order.
+    """
+
+    def __init__(self, contract_id):
+        self.contract_id = contract_id
+
+    def update(self, order):
+        # Nothing is kept in memory
+        pass
+
+    def matches(self, session, order, now=None):
+        """Yields the resting `Order`s that `order` can be matched with, best first, each locked when it is yielded"""
+        if order.direction == DirectionType.ask.value:
+            reciprocal_direction, ordering = DirectionType.bid.value, Order.unit_price.desc()
+        else:
+            reciprocal_direction, ordering = DirectionType.ask.value, Order.unit_price
+
+        candidates = session.query(Order)\
+            .filter(Order.contract_id == self.contract_id)\
+            .filter(Order.direction == reciprocal_direction)\
+            .filter(Order.state == OrderStateType.in_market.value)\
+            .filter(Order.order_type == OrderType.limit_order.value)\
+            .filter(Order.unit_price.isnot(None))\
+            .filter(Order.user_id != order.user_id)\
+            .filter(Order.asset_id == order.asset_id)\
+            .filter(live(now))
+
+        # Market orders are only limited if they specify a price
+        if order.price is not None:
+            if order.direction == DirectionType.ask.value:
+                candidates = candidates.filter(Order.unit_price >= order.price_to_volume)
+            else:
+                candidates = candidates.filter(Order.unit_price <= order.price_to_volume)
+
+        # One at a time: another matcher skips every order we hold a lock on, whether we go on to fill it or not.
+        # Orders that were passed over (expired ones, for instance) stay locked by us and have to be left out.
+        seen = set()
+        while True:
+            query = candidates.filter(Order.id.notin_(seen)) if seen else candidates
+            reciprocal_order = query.order_by(ordering, Order.created_at, Order.id)\
+                .options(joinedload(Order.user))\
+                .with_for_update(skip_locked=True, of=Order)\
+                .populate_existing()\
+                .first()
+            if reciprocal_order is None:
+                return
+
+            seen.add(reciprocal_order.id)
+            yield reciprocal_order
+
+
+_books = {}
+
+
+def get_book(session, contract_id):
+    if session.info.get('row_locks'):
+        return LockingBook(contract_id)
+
+    book = _books.get(contract_id)
+    if book is None:
+        book = _books[contract_id] = OrderBook.load(session, contract_id)
+    return book
+
+
+def loaded_books():
+    """Ids of the contracts whose book is in memory"""
+    return list(_books)
+
+
+def forget_book(contract_id):
+    _books.pop(contract_id, None)
+
+
+def clear_books():
+    """Forgets every loaded book; they are loaded from the database again when needed"""
+    _books.clear()
+
+
+def install_books(books):
+    """Replaces the books of the contracts in `books`, a `{contract_id: OrderBook}` dict, e.g. from a journal replay"""
+    _books.update(books)
+
+
+def update_books(session, orders):
+    """
+    Makes the books reflect `orders` right away. Until the session commits, the books of their contracts are marked as
+    uncommitted: if the session rolls back instead, those books are loaded from the database again.
+    """
+    for order in orders:
+        get_book(session, order.contract_id).update(order)
+        session.info.setdefault('uncommitted_books', set()).add(order.contract_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _books_committed(session):
+    # Releasing a savepoint is not final; the transaction around it may still roll back
+    if not session.transaction.nested:
+        session.info.pop('uncommitted_books', None)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _books_rolled_back(session, previous_transaction):
+    # After rolling back to a savepoint, the books are loaded again with whatever the transaction still holds, so they
+    # stay uncommitted until the transaction around it ends
+    if previous_transaction.nested:
+        contract_ids = session.info.get('uncommitted_books', ())
+    else:
+        contract_ids = session.info.pop('uncommitted_books', ())
+    for contract_id in contract_ids:
+        forget_book(contract_id)
@@ -0,0 +1,258 @@
+"""
+Level 2 market data per contract: the total volume and number of resting orders at each unit price, and the best bid
+and ask.
+
+The depth of a contract is loaded from the database the first time it is asked for and kept up to date from then on
+with every `Order` that is flushed, whether that happens in `put_order`, `execute`, `Order.cancel` or the expiry
+scheduler. Changes are applied when the session commits; the depth of a contract that had a savepoint rolled back is
+loaded again instead. Reading depth never touches the `orders` table.
+
+Every change to a contract is published, with a sequence number per contract, to the callbacks given to
+`subscribe()`:
+
+    {'contract_id': 1, 'sequence': 8, 'snapshot': False,
+     'bids': [(Decimal('0.5'), Decimal('10'), 1)], 'asks': [(Decimal('0.6'), Decimal('0'), 0)]}
+
+A level with a count of 0 is gone. When a depth is (re)loaded, the whole book is published with `snapshot` set, and
+subscribers should replace what they have. Like the order book, depth only sees changes made in this process.
+"""
+
+import bisect
+import itertools
+import logging
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models.consts import DirectionType, OrderType, OrderStateType
+from models.order import Order
+
+
+logger = logging.getLogger(__file__)
+
+
+def resting_part(order):
+    """`(direction, unit_price, volume)` of what `order` has resting in the book, or None"""
+    if order.state == OrderStateType.in_market.value and order.order_type == OrderType.limit_order.value \
+            and order.price is not None and order.remaining_volume > 0:
+        return order.direction, order.price_to_volume, order.remaining_volume
+    return None
+
+
+class Depth(object):
+
+    def __init__(self, contract_id, sequence=0):
+        self.contract_id = contract_id
+        self.sequence = sequence
+
+        # Sorted (ascending) unit prices per side, `[volume, count]` for each of those prices, and what each order adds
+        self._prices = {DirectionType.bid.value: [], DirectionType.ask.value: []}
+        self._levels = {DirectionType.bid.value: {}, DirectionType.ask.value: {}}
+        self._orders = {}
+
+    @classmethod
+    def load(cls, session, contract_id, sequence=0):
+        depth = cls(contract_id, sequence)
+        resting_orders = session.query(Order.id, Order.direction, Order.unit_price, Order.volume - Order.filled_volume)\
+            .filter(Order.contract_id == contract_id)\
+            .filter(Order.state == OrderStateType.in_market.value)\
+            .filter(Order.order_type == OrderType.limit_order.value)\
+            .filter(Order.unit_price.isnot(None))
+
+        for order_id, direction, unit_price, volume in resting_orders:
+            if volume > 0:
+                depth.apply(order_id, (direction, unit_price, volume))
+
+        logger.info('Loaded depth of contract %s with %s orders', contract_id, len(depth._orders))
+        return depth
+
+    def apply(self, order_id, resting):
+        """
+        Sets what `order_id` has resting in the book to `resting` (see `resting_part`). Returns the `(direction,
+        unit_price)` of the levels that changed.
+        """
+        previous = self._orders.pop(order_id, None)
+        if resting is not None:
+            self._orders[order_id] = resting
+        if previous == resting:
+            return []
+
+        changed = []
+        if previous is not None:
+            self._add(previous, -1)
+            changed.append(previous[:2])
+        if resting is not None:
+            self._add(resting, 1)
+            if resting[:2] not in changed:
+                changed.append(resting[:2])
+        return changed
+
+    def _add(self, resting, sign):
+        direction, unit_price, volume = resting
+        prices, levels = self._prices[direction], self._levels[direction]
+        level = levels.get(unit_price)
+        if level is None:
+            level = levels[unit_price] = [0, 0]
+            bisect.insort(prices, unit_price)
+
+        level[0] += sign * volume
+        level[1] += sign
+        if not level[1]:
+            del levels[unit_price]
+            del prices[bisect.bisect_left(prices, unit_price)]
+
+    def level(self, direction, unit_price):
+        """`(unit_price, volume, count)` of one level; volume and count are 0 if there is nothing at that price"""
+        volume, count = self._levels[direction].get(unit_price, (0, 0))
+        return unit_price, volume, count
+
+    def levels(self, direction, limit=None):
+        """The levels of one side, best price first"""
+        prices = self._prices[direction]
+        ordered_prices = reversed(prices) if direction == DirectionType.bid.value else iter(prices)
+        return [self.level(direction, unit_price) for unit_price in itertools.islice(ordered_prices, limit)]
+
+    def best(self, direction):
+        best = self.levels(direction, 1)
+        return best[0] if best else None
+
+    def snapshot(self, limit=None):
+        return {
+            'contract_id': self.contract_id,
+            'sequence': self.sequence,
+            'snapshot': True,
+            'bids': self.levels(DirectionType.bid.value, limit),
+            'asks': self.levels(DirectionType.ask.value, limit),
+        }
+
+
+_depths = {}
+_sequences = {}
+_subscribers = []
+_lock = threading.RLock()
+
+
+def subscribe(callback):
+    """Calls `callback` with every delta and snapshot that is published"""
+    with _lock:
+        _subscribers.append(callback)
+
+
+def unsubscribe(callback):
+    with _lock:
+        _subscribers.remove(callback)
+
+
+def _publish(message):
+    for callback in list(_subscribers):
+        try:
+            callback(message)
+        except Exception:
+            logger.exception('Depth subscriber %s failed', callback)
+
+
+def get_depth(session, contract_id):
+    with _lock:
+        depth = _depths.get(contract_id)
+        if depth is None:
+            sequence = _sequences.get(contract_id, 0) + 1
+            depth = _depths[contract_id] = Depth.load(session, contract_id, sequence)
+            _sequences[contract_id] = sequence
+            _publish(depth.snapshot())
+        return depth
+
+
+def depth(session, contract_id, limit=None):
+    """Level 2 depth of a contract, the `limit` best levels per side; see `Depth.snapshot`"""
+    with _lock:
+        return get_depth(session, contract_id).snapshot(limit)
+
+
+def top_of_book(session, contract_id):
+    """`(best_bid, best_ask)` of a contract, each `(unit_price, volume, count)` or None"""
+    with _lock:
+        contract_depth = get_depth(session, contract_id)
+        return contract_depth.best(DirectionType.bid.value), contract_depth.best(DirectionType.ask.value)
+
+
+def forget_depth(contract_id):
+    with _lock:
+        _depths.pop(contract_id, None)
+
+
+def clear_depths():
+    with _lock:
+        _depths.clear()
+
+
+def _apply_changes(changes, reload_contracts):
+    by_contract = {}
+    for order_id, (contract_id, resting) in changes.items():
+        by_contract.setdefault(contract_id, []).append((order_id, resting))
+
+    with _lock:
+        for contract_id in reload_contracts:
+            _depths.pop(contract_id, None)
+
+        for contract_id, orders in by_contract.items():
+            contract_depth = _depths.get(contract_id)
+            if contract_depth is None:
+                # Loaded from the database, changes and all, when it is first asked for
+                continue
+
+            changed = []
+            for order_id, resting in orders:
+                changed.extend(level for level in contract_depth.apply(order_id, resting) if level not in changed)
+            if not changed:
+                continue
+
+            contract_depth.sequence = _sequences[contract_id] = _sequences[contract_id] + 1
+            _publish({
+                'contract_id': contract_id,
+                'sequence': contract_depth.sequence,
+                'snapshot': False,
+                'bids': [contract_depth.level(direction, unit_price) for direction, unit_price in changed
+                         if direction == DirectionType.bid.value],
+                'asks': [contract_depth.level(direction, unit_price) for direction, unit_price in changed
+                         if direction == DirectionType.ask.value],
+            })
+
+
+@event.listens_for(Session, 'after_flush')
+def _orders_flushed(session, flush_context):
+    # Objects are expired once the session commits, so remember what they look like now
+    changes = session.info.setdefault('depth_changes', {})
+    for instance in itertools.chain(session.new, session.dirty):
+        if isinstance(instance, Order) and instance.contract_id is not None:
+            changes[instance.id] = (instance.contract_id, resting_part(instance))
+    for instance in session.deleted:
+        if isinstance(instance, Order):
+            changes[instance.id] = (instance.contract_id, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _depth_committed(session):
+    changes = session.info.pop('depth_changes', None) or {}
+    reload_contracts = session.info.pop('depth_reload', set())
+    if changes or reload_contracts:
+        _apply_changes(changes, reload_contracts)
+
+    # A savepoint is only committed for as long as the transaction around it is
+    if session.transaction.nested:
+        session.info.setdefault('depth_applied', set()).update(contract_id for contract_id, _ in changes.values())
+    else:
+        session.info.pop('depth_applied', None)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _depth_rolled_back(session, previous_transaction):
+    changed_contracts = set(contract_id for contract_id, _ in session.info.get('depth_changes', {}).values())
+    if previous_transaction.nested:
+        # We cannot tell which of the changes were undone; load the depth of those contracts again after the commit
+        session.info.setdefault('depth_reload', set()).update(changed_contracts)
+    else:
+        session.info.pop('depth_changes', None)
+        session.info.pop('depth_reload', None)
+        for contract_id in session.info.pop('depth_applied', ()):
+            forget_depth(contract_id)
@@ -0,0 +1,129 @@
+"""
+Cancels orders once they pass `expires_at`, releasing what they still had reserved.
+
+`ExpiryScheduler` keeps the deadlines that are coming up in a heap. Every `horizon` it looks up, through the
+`ix_orders_expires_at` index, the orders that expire before the next lookup; in between it only has to wait for the
+deadline at the top of the heap. Orders that are due are cancelled in batches of `batch_size`, one transaction per
+batch. An order that a matcher holds a lock on is left for the next lookup.
+
+    scheduler = ExpiryScheduler()
+    threading.Thread(target=scheduler.run, args=(stop_event,), daemon=True).start()
+
+Orders can also be handed to a running scheduler with `schedule()`, so that deadlines shorter than `horizon` are met.
+"""
+
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from market.book import update_books
+from models import Session, commit_or_flush
+from models.consts import OrderStateType
+from models.order import Order
+
+
+logger = logging.getLogger(__file__)
+
+LIVE_STATES = (OrderStateType.created.value, OrderStateType.in_market.value)
+
+
+def expire_orders(session, order_ids, now=None, commit=None):
+    """Cancels those of `order_ids` that are live and past their deadline; returns the orders that were cancelled"""
+    now = now or datetime.now()
+    due_orders = session.query(Order)\
+        .filter(Order.id.in_(order_ids))\
+        .filter(Order.state.in_(LIVE_STATES))\
+        .filter(Order.expires_at <= now)\
+        .order_by(Order.id)\
+        .with_for_update(skip_locked=True)\
+        .populate_existing()\
+        .all()
+
+    try:
+        for order in due_orders:
+            order.cancel(session, commit=False, lock=False)
+        commit_or_flush(session, commit)
+    finally:
+        update_books(session, due_orders)
+
+    if due_orders:
+        logger.info('Expired %s order(s)', len(due_orders))
+    return due_orders
+
+
+class ExpiryScheduler(object):
+
+    def __init__(self, session_factory=Session, batch_size=500, horizon=timedelta(seconds=5)):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.horizon = horizon
+        self._deadlines = []
+        self._scheduled = set()
+        self._loaded_until = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, order_id, expires_at):
+        with self._lock:
+            if order_id not in self._scheduled:
+                heapq.heappush(self._deadlines, (expires_at, order_id))
+                self._scheduled.add(order_id)
+
+    def load(self, session, now=None):
+        """Schedules every live order that expires before the next lookup, including ones that are overdue"""
+        now = now or datetime.now()
+        loaded_until = now + self.horizon
+        upcoming = session.query(Order.id, Order.expires_at)\
+            .filter(Order.expires_at <= loaded_until)\
+            .filter(Order.state.in_(LIVE_STATES))
+        for order_id, expires_at in upcoming:
+            self.schedule(order_id, expires_at)
+        self._loaded_until = loaded_until
+
+    def next_deadline(self):
+        """When the scheduler next has something to do"""
+        deadline = self._loaded_until
+        if self._deadlines and (deadline is None or self._deadlines[0][0] < deadline):
+            deadline = self._deadlines[0][0]
+        return deadline
+
+    def pop_due(self, now=None):
+        now = now or datetime.now()
+        due = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, order_id = heapq.heappop(self._deadlines)
+                self._scheduled.discard(order_id)
+                due.append(order_id)
+        return due
+
+    def run_once(self, now=None):
+        """Cancels every order that is due by `now`; returns how many were cancelled"""
+        now = now or datetime.now()
+        session = self.session_factory()
+        try:
+            if self._loaded_until is None or self._loaded_until <= now:
+                self.load(session, now)
+
+            due = self.pop_due(now)
+            expired = 0
+            for start in range(0, len(due), self.batch_size):
+                expired += len(expire_orders(session, due[start:start + self.batch_size], now))
+            return expired
+        finally:
+            session.close()
+
+    def run(self, stop_event):
+        """Keeps cancelling orders as they expire, until `stop_event` is set"""
+        while not stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('Could not expire orders')
+
+            deadline = self.next_deadline() or datetime.now() + self.horizon
+            timeout = (deadline - datetime.now()).total_seconds()
+            stop_event.wait(max(timeout, 0.01))
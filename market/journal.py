@@ -0,0 +1,357 @@
+"""
+An append-only journal of order state transitions, and a replay of it that rebuilds the in-memory order books.
+
+Every committed change to an order is appended as a fixed-size binary record: a sequence number, what happened
+(`create`, `put`, `fill`, `cancel` or `expire`), what the order has resting in the book afterwards and a CRC32 of the
+record. Prices and volumes are stored as integers scaled by 10^8 and 10^4. Records are written when the outermost
+transaction commits, so the journal never contains changes that were rolled back.
+
+    open_journal('/var/lib/btcex/orders.journal')
+
+At startup the books are restored from the latest snapshot (see `write_snapshot`) and the records written after it,
+read through `mmap`, instead of from the `orders` table:
+
+    restore_books(session, '/var/lib/btcex/orders.snapshot', '/var/lib/btcex/orders.journal')
+
+Every record states the whole resting part of its order, so applying a record twice does no harm. A torn record at the
+end of the journal, left by a crash in the middle of a write, is cut off when the journal is opened again. A crash
+between the database commit and the write loses the last records altogether; `reconcile` finds the orders they would
+have put in the books in the `orders` table.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import select
+
+from market.book import OrderBook, BookOrder, install_books
+from market.depth import resting_part
+from models.consts import DirectionType, OrderType, OrderStateType
+from models.fixed import price_units, volume_units, price_from_units, volume_from_units
+from models.order import Order
+
+
+logger = logging.getLogger(__file__)
+
+KINDS = ('create', 'put', 'fill', 'cancel', 'expire', 'snapshot')
+
+# sequence, kind, order id, contract id, user id, asset id, flags, unit price, volume, timestamp, expires at
+_RECORD = struct.Struct('<QBQQQQBqqqq')
+_CHECKSUM = struct.Struct('<I')
+RECORD_SIZE = _RECORD.size + _CHECKSUM.size
+
+_SNAPSHOT_HEADER = struct.Struct('<8sQQ')
+_SNAPSHOT_MAGIC = b'BTCEXSNP'
+
+_BID, _RESTING = 1, 2
+_EPOCH = datetime(1970, 1, 1)
+
+JournalRecord = namedtuple('JournalRecord', ['sequence', 'kind', 'order_id', 'contract_id', 'user_id', 'asset_id',
+                                             'direction', 'resting', 'unit_price', 'volume', 'timestamp',
+                                             'expires_at'])
+
+
+def _to_micros(timestamp):
+    return (timestamp - _EPOCH) // timedelta(microseconds=1) if timestamp is not None else 0
+
+
+def _from_micros(micros):
+    return _EPOCH + timedelta(microseconds=micros) if micros else None
+
+
+def encode(record):
+    flags = (_BID if record.direction == DirectionType.bid.value else 0) | (_RESTING if record.resting else 0)
+    data = _RECORD.pack(record.sequence, KINDS.index(record.kind), record.order_id, record.contract_id,
+                        record.user_id or 0, record.asset_id or 0, flags,
+                        price_units(record.unit_price) or 0, volume_units(record.volume),
+                        _to_micros(record.timestamp), _to_micros(record.expires_at))
+    return data + _CHECKSUM.pack(zlib.crc32(data))
+
+
+def decode(data):
+    """The record in `data`, or None if its checksum does not match"""
+    body, (checksum,) = data[:_RECORD.size], _CHECKSUM.unpack(data[_RECORD.size:])
+    if zlib.crc32(body) != checksum:
+        return None
+
+    sequence, kind, order_id, contract_id, user_id, asset_id, flags, unit_price, volume, timestamp, expires_at = \
+        _RECORD.unpack(body)
+    return JournalRecord(sequence, KINDS[kind], order_id, contract_id, user_id, asset_id,
+                         DirectionType.bid.value if flags & _BID else DirectionType.ask.value, bool(flags & _RESTING),
+                         price_from_units(unit_price), volume_from_units(volume),
+                         _from_micros(timestamp), _from_micros(expires_at))
+
+
+def record_for(order, kind, sequence=0, timestamp=None):
+    resting = resting_part(order)
+    return JournalRecord(sequence, kind, order.id, order.contract_id, order.user_id, order.asset_id, order.direction,
+                         resting is not None, order.price_to_volume, order.remaining_volume,
+                         timestamp or datetime.now(), order.expires_at)
+
+
+def read_records(path, after_sequence=0):
+    """Yields the records of the journal or snapshot records at `path`, up to the first one that is torn or corrupt"""
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            record = decode(data[offset:offset + RECORD_SIZE])
+            if record is None:
+                logger.warning('Journal %s is corrupt at offset %s; ignoring the rest', path, offset)
+                return
+            if record.sequence > after_sequence:
+                yield record
+
+
+class Journal(object):
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.sequence = 0
+        self._lock = threading.Lock()
+
+        # Keep the valid records and cut off whatever a crash may have left behind them
+        valid = 0
+        for record in read_records(path):
+            self.sequence = record.sequence
+            valid += RECORD_SIZE
+        self._file = open(path, 'ab')
+        if self._file.tell() != valid:
+            logger.warning('Truncating journal %s from %s to %s bytes', path, self._file.tell(), valid)
+            self._file.truncate(valid)
+            self._file.seek(valid)
+
+    def append(self, records):
+        """Writes `records` with the next sequence numbers; returns the last sequence number"""
+        with self._lock:
+            data = []
+            for record in records:
+                self.sequence += 1
+                data.append(encode(record._replace(sequence=self.sequence)))
+            self._file.write(b''.join(data))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            return self.sequence
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_journal = None
+
+
+def open_journal(path, fsync=True):
+    """Starts journalling every committed order transition of this process to `path`"""
+    global _journal
+    close_journal()
+    _journal = Journal(path, fsync)
+    return _journal
+
+
+def close_journal():
+    global _journal
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+
+def write_snapshot(session, path, journal=None):
+    """
+    Writes every resting order to a snapshot at `path`, as of the current sequence number of `journal`. Transitions
+    that commit while the snapshot is taken may be in it as well as after it, which replay does not mind. Orders that
+    are yet to be put in the market are written as not resting, so that `reconcile` knows to look them up.
+    """
+    journal = journal or _journal
+    sequence = journal.sequence if journal is not None else 0
+    orders = Order.__table__
+    resting = session.execute(
+        select([orders.c.id, orders.c.state, orders.c.contract_id, orders.c.user_id, orders.c.asset_id,
+                orders.c.direction, orders.c.unit_price, orders.c.volume - orders.c.filled_volume,
+                orders.c.expires_at])
+        .where(orders.c.state.in_([OrderStateType.created.value, OrderStateType.in_market.value]))
+        .where(orders.c.order_type == OrderType.limit_order.value)
+        .where(orders.c.unit_price.isnot(None))
+        .order_by(orders.c.id))
+
+    count, now = 0, datetime.now()
+    with open(path + '.tmp', 'wb') as f:
+        f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, sequence, 0))
+        for order_id, state, contract_id, user_id, asset_id, direction, unit_price, volume, expires_at in resting:
+            if volume > 0:
+                f.write(encode(JournalRecord(sequence, 'snapshot', order_id, contract_id, user_id, asset_id, direction,
+                                             state == OrderStateType.in_market.value, unit_price, volume, now,
+                                             expires_at)))
+                count += 1
+        f.seek(0)
+        f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, sequence, count))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+    logger.info('Wrote snapshot of %s open orders at sequence %s to %s', count, sequence, path)
+    return sequence
+
+
+def _read_snapshot(path):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, sequence, count = _SNAPSHOT_HEADER.unpack(data[:_SNAPSHOT_HEADER.size])
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError('{} is not a snapshot'.format(path))
+
+        records = []
+        for index in range(count):
+            offset = _SNAPSHOT_HEADER.size + index * RECORD_SIZE
+            record = decode(data[offset:offset + RECORD_SIZE])
+            if record is None:
+                raise ValueError('Snapshot {} is corrupt at record {}'.format(path, index))
+            records.append(record)
+        return sequence, records
+
+
+def apply(books, record):
+    book = books.get(record.contract_id)
+    if book is None:
+        book = books[record.contract_id] = OrderBook(record.contract_id)
+
+    if record.resting:
+        book.add_entry(BookOrder(record.order_id, record.user_id, record.asset_id, record.direction,
+                                 price_units(record.unit_price), volume_units(record.volume), record.expires_at))
+    else:
+        book.remove(record.order_id)
+
+
+def reconcile(session, books, covered, unsettled, chunk_size=500):
+    """
+    Adds the orders that are in the market but whose records were lost to `books`: those with an id above `covered`,
+    the highest order id in the snapshot and journal, and the `unsettled` ones that were last seen before they were put
+    in the market. Returns how many were added.
+    """
+    def resting_orders(criterion):
+        return session.query(Order)\
+            .filter(criterion)\
+            .filter(Order.state == OrderStateType.in_market.value)\
+            .filter(Order.order_type == OrderType.limit_order.value)\
+            .filter(Order.price.isnot(None))\
+            .order_by(Order.created_at, Order.id)\
+            .all()
+
+    orders = resting_orders(Order.id > covered)
+    unsettled = sorted(unsettled)
+    for start in range(0, len(unsettled), chunk_size):
+        orders.extend(resting_orders(Order.id.in_(unsettled[start:start + chunk_size])))
+
+    for order in orders:
+        book = books.get(order.contract_id)
+        if book is None:
+            book = books[order.contract_id] = OrderBook(order.contract_id)
+        book.update(order)
+
+    if orders:
+        logger.warning('Added %s orders missing from the journal to the books', len(orders))
+    return len(orders)
+
+
+def replay(snapshot_path, journal_path, session=None):
+    """
+    Rebuilds the order books from a snapshot and the journal records after it; returns `{contract_id: OrderBook}`.
+    With a `session`, the books are reconciled with the `orders` table afterwards.
+    """
+    books, sequence, covered, unsettled = {}, 0, 0, set()
+
+    def replay_record(record):
+        apply(books, record)
+        if record.kind in ('create', 'snapshot') and not record.resting:
+            unsettled.add(record.order_id)
+        else:
+            unsettled.discard(record.order_id)
+        return max(covered, record.order_id)
+
+    if snapshot_path is not None and os.path.exists(snapshot_path):
+        sequence, records = _read_snapshot(snapshot_path)
+        for record in records:
+            covered = replay_record(record)
+
+    replayed = 0
+    for record in read_records(journal_path, after_sequence=sequence):
+        covered = replay_record(record)
+        replayed += 1
+
+    logger.info('Replayed %s journal records after snapshot sequence %s into %s books', replayed, sequence, len(books))
+    if session is not None:
+        reconcile(session, books, covered, unsettled)
+    return books
+
+
+def restore_books(session, snapshot_path, journal_path):
+    """Replaces the books of every contract in the snapshot, the journal or the database with the replayed ones"""
+    books = replay(snapshot_path, journal_path, session)
+    install_books(books)
+    return books
+
+
+def _kind(order, state):
+    if state.attrs.filled_volume.history.has_changes() and order.filled_volume:
+        return 'fill'
+    if not state.attrs.state.history.has_changes():
+        return None
+    if order.state == OrderStateType.created.value:
+        return 'create'
+    if order.state == OrderStateType.in_market.value:
+        return 'put'
+    if order.state == OrderStateType.cancelled.value:
+        return 'expire' if order.has_expired() else 'cancel'
+    return 'fill'
+
+
+@event.listens_for(Session, 'after_flush')
+def _orders_flushed(session, flush_context):
+    if _journal is None:
+        return
+
+    # Attribute histories are gone after the flush, and objects are expired after the commit; take the records now
+    pending = session.info.setdefault('journal_records', [])
+    now = datetime.now()
+    for instance in list(session.new) + list(session.dirty):
+        if isinstance(instance, Order):
+            kind = _kind(instance, inspect(instance))
+            if kind is not None:
+                pending.append((session.transaction, record_for(instance, kind, timestamp=now)))
+
+
+def _within(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction._parent
+    return False
+
+
+@event.listens_for(Session, 'after_commit')
+def _journal_committed(session):
+    # Savepoints are only final once the transaction around them commits
+    if session.transaction.nested:
+        return
+
+    pending = session.info.pop('journal_records', None)
+    if pending and _journal is not None:
+        _journal.append([record for _, record in pending])
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _journal_rolled_back(session, previous_transaction):
+    pending = session.info.get('journal_records')
+    if pending:
+        pending[:] = [(transaction, record) for transaction, record in pending
+                      if not _within(transaction, previous_transaction)]
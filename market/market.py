@@ -1,95 +1,118 @@
 import logging
+from collections import namedtuple
 from datetime import datetime
+from decimal import ROUND_DOWN, ROUND_UP
 
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload
+
+from market.book import get_book, update_books
 from market.exceptions import MarketException, OrderExpiredError
 from models.consts import DirectionType, OrderType, OrderStateType
+from models import atomic, commit_or_flush
+from models.candle import Candle
+from models.contract import FuturesContract
+from models.metrics import Stopwatch, counter, histogram
 from models.order import Order, Transaction
 
 logger = logging.getLogger(__file__)
 
+# Stages are `lookup` (finding reciprocal orders), `execute` (filling them), `commit` and `total`
+PUT_ORDER_SECONDS = histogram('btcex_put_order_seconds', 'Time spent in put_order, by stage', ['stage'])
+PUT_ORDERS_SECONDS = histogram('btcex_put_orders_seconds', 'Time spent in put_orders per batch, by stage', ['stage'])
+PUT_ORDER_ERRORS = counter('btcex_put_order_errors_total', 'Orders that could not be put in the market, by error',
+                           ['error'])
+FILLS = counter('btcex_fills_total', 'Fills between two orders')
+
 
-def execute(session, first_order, second_order):
+def fill(session, first_order, second_order, now=None):
+    """
+    Matches as much of `first_order` and `second_order` as possible and records the result as a `Transaction`. Nothing
+    is committed; an order stays in the market until its whole volume has been filled.
+    """
     if not isinstance(first_order, Order) or not isinstance(second_order, Order):
         logger.error('Both arguments are not Order instances')
         raise MarketException('Both arguments are not Order instances')
 
     if first_order.asset is None or first_order.asset != second_order.asset:
-        logger.error('Asset is None or order assets differ ({}, {})'.format(first_order.id, second_order.id))
+        logger.error('Asset is None or order assets differ (%s, %s)', first_order.id, second_order.id)
         raise MarketException('Asset is None or order assets differ')
 
     if first_order.contract.contract_asset is None or\
             first_order.contract.contract_asset != second_order.contract.contract_asset:
-        logger.error('Contract asset is None or they differ ({}, {})'.format(first_order.id, second_order.id))
+        logger.error('Contract asset is None or they differ (%s, %s)', first_order.id, second_order.id)
         raise MarketException('Contract asset is None or they differ')
 
     if first_order.state != OrderStateType.in_market.value or second_order.state != OrderStateType.in_market.value:
-        logger.error('At least one order is not in market ({}, {})'.format(first_order.id, second_order.id))
+        logger.error('At least one order is not in market (%s, %s)', first_order.id, second_order.id)
         raise MarketException('At least one order is not in market')
 
     if first_order.executed() or second_order.executed():
-        logger.error('First or second order is already executed ({}, {}))'.format(first_order.id, second_order.id))
+        logger.error('First or second order is already executed (%s, %s))', first_order.id, second_order.id)
         raise MarketException('First or second order is already executed')
 
-    def has_expired(order, now):
-        if order.expires_in is not None and order.created_at + order.expires_in > now:
-            return True
-        return False
-
-    now = datetime.now()
-    if has_expired(first_order, now) or has_expired(second_order, now):
-        logger.error('At least one order has expired ({}, {})'.format(first_order.id, second_order.id))
+    now = now or datetime.now()
+    if first_order.has_expired(now) or second_order.has_expired(now):
+        logger.error('At least one order has expired (%s, %s)', first_order.id, second_order.id)
         raise OrderExpiredError('At least one order has expired')
 
     if first_order.direction == second_order.direction:
-        logger.error('Orders have the same direction ({}, {})'.format(first_order.id, second_order.id))
+        logger.error('Orders have the same direction (%s, %s)', first_order.id, second_order.id)
         raise MarketException('Orders have the same direction')
 
     if first_order.contract != second_order.contract:
-        logger.error('Orders have different contracts ({}, {})'.format(first_order.id, second_order.id))
+        logger.error('Orders have different contracts (%s, %s)', first_order.id, second_order.id)
         raise MarketException('Orders have different contracts')
 
     if first_order.price is None and second_order.price is None:
-        logger.error('Both orders have no price specified ({}, {})'.format(first_order.id, second_order.id))
+        logger.error('Both orders have no price specified (%s, %s)', first_order.id, second_order.id)
         raise MarketException('Orders have no price specified')
 
-    volume = min([first_order.volume, second_order.volume])
+    volume = min([first_order.remaining_volume, second_order.remaining_volume])
 
     if first_order.created_at <= second_order.created_at:
         earliest_order, latest_order = first_order, second_order
     else:
         earliest_order, latest_order = second_order, first_order
 
-    if earliest_order.price is None and latest_order.price is not None:
-        price = latest_order.price
-    elif earliest_order.price is not None and latest_order.price is None:
-        price = earliest_order.price
-    else:
-        # Both prices are specified
-        if earliest_order.direction == DirectionType.ask.value:
-            price = max([earliest_order.price, latest_order.price])
-        else:
-            price = min([earliest_order.price, latest_order.price])
+    # The order that was in the market first sets the price
+    price_setter = earliest_order if earliest_order.price is not None else latest_order
+    unit_price = price_setter.price_to_volume
 
-    def verify_price(order, price):
+    def verify_price(order, unit_price):
         if order.price is None:
             return True
 
-        if order.direction == DirectionType.ask.value and order.price < price:
+        if order.direction == DirectionType.ask.value and order.price_to_volume > unit_price:
             return False
-        elif order.direction == DirectionType.bid.value and order.price > price:
+        elif order.direction == DirectionType.bid.value and order.price_to_volume < unit_price:
             return False
         else:
             return True
 
-    if not verify_price(first_order, price) or not verify_price(second_order, price):
-        logger.error('Tried to pay more / less than expected ({}, {})'.format(first_order.id, second_order.id))
+    if not verify_price(first_order, unit_price) or not verify_price(second_order, unit_price):
+        logger.error('Tried to pay more / less than expected (%s, %s)', first_order.id, second_order.id)
         raise MarketException('Tried to pay more or less than expected')
 
-    first_order.executed_at, second_order.executed_at = now, now
-    first_order.state, second_order.state = OrderStateType.executed.value, OrderStateType.executed.value
     first_order_is_ask_order = bool(first_order.direction == DirectionType.ask.value)
     ask_order = first_order if first_order_is_ask_order else second_order
     bid_order = second_order if first_order_is_ask_order else first_order
+
+    # Every fill is paid its share of the whole price of the price setter, so that all of its fills add up to exactly
+    # that price. Rounding up favours the seller, but the bid side never pays more than it reserved for this volume.
+    rounding = ROUND_UP if price_setter is ask_order else ROUND_DOWN
+    filled_volume = price_setter.filled_volume
+    price = price_setter.price_for(filled_volume + volume, rounding) - price_setter.price_for(filled_volume, rounding)
+    filled_bid_volume = bid_order.filled_volume
+    reserved = bid_order.reserved_for(filled_bid_volume + volume) - bid_order.reserved_for(filled_bid_volume)
+    price = min([price, reserved])
+
+    for order in (first_order, second_order):
+        order.filled_volume += volume
+        if not order.remaining_volume:
+            order.executed_at = now
+            order.state = OrderStateType.executed.value
+
     transaction = Transaction(contract=first_order.contract,
                               ask_order=ask_order,
                               bid_order=bid_order,
@@ -97,82 +120,148 @@ def execute(session, first_order, second_order):
                               volume=volume,
                               asset=first_order.asset)
     session.add_all([first_order, second_order, transaction])
+    transaction.execute_trade(session, bid_released=reserved)
+    Candle.record_transaction(session, transaction)
+    FILLS.inc()
+    logger.info('Filled %s of orders %s, %s', volume, first_order.id, second_order.id)
+    return transaction
 
-    try:
-        if transaction.execute_trade(session):
-            session.commit()
-            logger.info('Executed orders {}, {}. ({})'.format(first_order.id, second_order.id, transaction.id))
-            return transaction
-    except MarketException as e:
-        session.rollback()
-        logger.warning('Did *not* execute orders {}, {}: {}'.format(first_order.id, second_order.id, str(e)))
-        return
 
+def execute(session, first_order, second_order, commit=None):
+    transaction = fill(session, first_order, second_order)
+    commit_or_flush(session, commit)
+    logger.info('Executed orders %s, %s. (%s)', first_order.id, second_order.id, transaction.id)
+    return transaction
 
-def put_order(session, order):
-    if order.state != OrderStateType.created.value:
-        logger.error('Order {} was not in state `created` but {}'.format(order.id, order.state))
-        raise MarketException('Order not in state created')
 
-    order.state = OrderStateType.in_market.value
-    session.add(order)
-    session.commit()
-    logger.info('Order {} is now in state `in market`'.format(order.id))
+PutOrderResult = namedtuple('PutOrderResult', ['order', 'transactions', 'error'])
 
-    if order.direction == DirectionType.ask.value:
-        reciprocal_direction = DirectionType.bid.value
-    else:
-        reciprocal_direction = DirectionType.ask.value
 
-    candidate_orders = session.query(Order)\
-        .filter(Order.contract == order.contract)\
-        .filter(Order.direction == reciprocal_direction)\
-        .filter(Order.state == OrderStateType.in_market.value)\
-        .filter(Order.user != order.user)\
-        .order_by(Order.id)
+def _load_for_matching(session, order):
+    """
+    Everything in the session is expired after a commit, and `fill` would load `order`, its user, its asset, its
+    contract and the contract's asset again one lazy load at a time. Loads all of them with one query instead.
+    """
+    state = inspect(order)
+    if state.identity is None or not state.expired:
+        return
 
-    if order.order_type == OrderType.market_order.value:
-        candidate_orders = candidate_orders.filter(Order.price.isnot(None))
+    session.query(Order)\
+        .filter(Order.id == state.identity[0])\
+        .options(joinedload(Order.user),
+                 joinedload(Order.asset),
+                 joinedload(Order.contract.of_type(FuturesContract)).joinedload(FuturesContract.contract_asset))\
+        .one()
 
-        # Make sure we order by best price for this direction
-        if order.direction == DirectionType.ask.value:
-            candidate_orders = candidate_orders.filter(Order.volume >= order.volume).order_by(Order.price.desc())
-        else:
-            candidate_orders = candidate_orders.filter(Order.volume <= order.volume).order_by(Order.price)
 
-        reciprocal_order = candidate_orders.first()
-        if reciprocal_order is not None:
-            return execute(session, order, reciprocal_order)
-        else:
-            logger.info('Cancelling order {} because result set is empty'.format(order.id))
-            order.cancel(session)
+def _check_created(order):
+    if order.state != OrderStateType.created.value:
+        logger.error('Order %s was not in state `created` but %s', order.id, order.state)
+        raise MarketException('Order not in state created')
 
-    elif order.order_type == OrderType.limit_order.value:
-        # if len(candidate_orders.filter(Order.price.is_(None))): pass
-        if order.direction == DirectionType.ask.value:
-            candidate_orders = candidate_orders.filter(Order.price >= order.price).order_by(Order.price.desc())
-        else:
-            candidate_orders = candidate_orders.filter(Order.price <= order.price).order_by(Order.price)
-
-        reciprocal_order = candidate_orders.first()
-        if reciprocal_order is not None:
-            return execute(session, order, reciprocal_order)
-
-        more_candidates = session.query(Order)\
-            .filter(Order.user != order.user)\
-            .filter(Order.direction == reciprocal_direction)\
-            .filter(Order.state == OrderStateType.in_market.value)\
-            .filter(Order.contract == order.contract)\
-
-        if order.direction == DirectionType.ask.value:
-            more_candidates = more_candidates\
-                .filter(Order.price / Order.volume >= order.price_to_volume)\
-                .order_by(Order.volume.desc())
-        else:
-            more_candidates = more_candidates\
-                .filter(Order.price / Order.volume <= order.price_to_volume)\
-                .order_by(Order.volume)
 
-        reciprocal_order = more_candidates.first()
-        if reciprocal_order is not None:
-            return execute(session, order, reciprocal_order)
+def _sweep(session, order, now, touched_orders, stopwatch):
+    """
+    Puts `order` in the market and sweeps the other side of the book, best price first, until it has been filled or no
+    more reciprocal orders qualify. A limit order rests with whatever is left; the rest of a market order is cancelled.
+    Nothing is committed. Every order that was changed is appended to `touched_orders`, and the time spent is added to
+    the `lookup` and `execute` laps of `stopwatch`.
+    """
+    if order.has_expired(now):
+        logger.info('Order %s expired before it was put in the market', order.id)
+        order.cancel(session, commit=False)
+        stopwatch.lap('execute')
+        return []
+
+    order.state = OrderStateType.in_market.value
+    session.add(order)
+    session.flush()
+    stopwatch.lap('execute')
+
+    book = get_book(session, order.contract_id)
+    transactions = []
+    for reciprocal_order in book.matches(session, order, now):
+        stopwatch.lap('lookup')
+        try:
+            transactions.append(fill(session, order, reciprocal_order, now))
+        except OrderExpiredError:
+            logger.info('Skipping expired order %s', reciprocal_order.id)
+            continue
+        finally:
+            stopwatch.lap('execute')
+
+        touched_orders.append(reciprocal_order)
+        if not order.remaining_volume:
+            break
+    stopwatch.lap('lookup')
+
+    if order.order_type == OrderType.market_order.value and order.remaining_volume:
+        logger.info('Cancelling the remaining %s of order %s', order.remaining_volume, order.id)
+        order.cancel(session, commit=False)
+        stopwatch.lap('execute')
+
+    logger.info('Order %s is now in state `%s` after %s fill(s)', order.id, order.state, len(transactions))
+    return transactions
+
+
+def put_order(session, order, commit=None):
+    """Matches `order` against the book and commits once. Returns the `Transaction`s that were created."""
+    _load_for_matching(session, order)
+    _check_created(order)
+
+    stopwatch = Stopwatch()
+    touched_orders = [order]
+    try:
+        with atomic(session, commit):
+            transactions = _sweep(session, order, datetime.now(), touched_orders, stopwatch)
+    except Exception as e:
+        PUT_ORDER_ERRORS.labels(type(e).__name__).inc()
+        raise
+    finally:
+        update_books(session, touched_orders)
+
+    stopwatch.lap('commit')
+    stopwatch.observe(PUT_ORDER_SECONDS)
+    return transactions
+
+
+def put_orders(session, orders, commit=None):
+    """
+    Matches `orders` in the order given and commits once for all of them. Each order is matched inside a savepoint, so
+    an order that fails does not undo the others. Returns a `PutOrderResult` per order, in the same order.
+    """
+    if len(set(map(id, orders))) != len(orders):
+        raise MarketException('The same order was given more than once')
+    for order in orders:
+        _check_created(order)
+
+    logger.info('Putting %s orders in the market', len(orders))
+
+    now, stopwatch = datetime.now(), Stopwatch()
+    results, touched_orders = [], []
+    try:
+        with atomic(session, commit):
+            for order in orders:
+                order_touched_orders = [order]
+                savepoint = session.begin_nested()
+                try:
+                    transactions = _sweep(session, order, now, order_touched_orders, stopwatch)
+                    savepoint.commit()
+                    results.append(PutOrderResult(order, transactions, None))
+                except MarketException as e:
+                    savepoint.rollback()
+                    PUT_ORDER_ERRORS.labels(type(e).__name__).inc()
+                    logger.warning('Could not put order %s in the market: %s', order.id, e)
+                    results.append(PutOrderResult(order, [], e))
+                finally:
+                    # Later orders in the batch have to see what this one left in the book
+                    update_books(session, order_touched_orders)
+                    touched_orders.extend(order_touched_orders)
+    except Exception as e:
+        PUT_ORDER_ERRORS.labels(type(e).__name__).inc()
+        update_books(session, touched_orders)
+        raise
+
+    stopwatch.lap('commit')
+    stopwatch.observe(PUT_ORDERS_SECONDS)
+    return results
@@ -0,0 +1,133 @@
+"""
+An asyncio front end for `put_order`.
+
+Orders for one contract have to be matched one at a time, orders for different contracts do not. The service keeps one
+queue and one consumer task per contract: a burst of orders on one contract waits in its own queue and does not hold
+up the others. The matching itself, and every database write that comes with it, runs in a thread pool with a
+session per order.
+
+Orders are created and committed as usual (`Order.create_order`) and then handed to the service by id, either in
+process with `await service.submit(order_id)` or over a local socket (see `serve_unix`) that reads one JSON object per
+line, `{"order_id": 1}`, and answers with `{"order_id": 1, "fills": [...]}` or `{"order_id": 1, "error": "..."}`.
+"""
+
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from market.exceptions import MarketException
+from market.market import put_order
+from models import Session
+from models.order import Order
+
+
+logger = logging.getLogger(__file__)
+
+
+def describe_fill(transaction):
+    return {
+        'transaction_id': transaction.id,
+        'ask_order_id': transaction.ask_order_id,
+        'bid_order_id': transaction.bid_order_id,
+        'price': str(transaction.price),
+        'volume': str(transaction.volume),
+    }
+
+
+class MatchingService(object):
+
+    def __init__(self, session_factory=Session, max_workers=8):
+        self.session_factory = session_factory
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='matching')
+        self._queues = {}
+        self._consumers = {}
+
+    async def submit(self, order_id, contract_id=None):
+        """Matches the order with id `order_id` and returns a description of its fills"""
+        loop = asyncio.get_running_loop()
+        if contract_id is None:
+            contract_id = await loop.run_in_executor(self.executor, self._contract_of, order_id)
+
+        queue = self._queues.get(contract_id)
+        if queue is None:
+            queue = self._queues[contract_id] = asyncio.Queue()
+            self._consumers[contract_id] = loop.create_task(self._consume(contract_id, queue))
+
+        result = loop.create_future()
+        await queue.put((order_id, result))
+        return await result
+
+    async def _consume(self, contract_id, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            order_id, result = await queue.get()
+            try:
+                fills = await loop.run_in_executor(self.executor, self._put_order, order_id)
+            except Exception as e:
+                if not result.cancelled():
+                    result.set_exception(e)
+            else:
+                if not result.cancelled():
+                    result.set_result(fills)
+            finally:
+                queue.task_done()
+
+    def _contract_of(self, order_id):
+        session = self.session_factory()
+        try:
+            contract_id = session.query(Order.contract_id).filter(Order.id == order_id).scalar()
+        finally:
+            session.close()
+
+        if contract_id is None:
+            raise MarketException('Unknown order {}'.format(order_id))
+        return contract_id
+
+    def _put_order(self, order_id):
+        session = self.session_factory()
+        try:
+            order = session.query(Order).get(order_id)
+            if order is None:
+                raise MarketException('Unknown order {}'.format(order_id))
+            return [describe_fill(transaction) for transaction in put_order(session, order)]
+        finally:
+            session.close()
+
+    async def drain(self):
+        """Waits until every order that has been submitted so far is matched"""
+        await asyncio.gather(*(queue.join() for queue in self._queues.values()))
+
+    async def close(self):
+        await self.drain()
+        for consumer in self._consumers.values():
+            consumer.cancel()
+        await asyncio.gather(*self._consumers.values(), return_exceptions=True)
+        self._queues.clear()
+        self._consumers.clear()
+        self.executor.shutdown(wait=True)
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                order_id = None
+                try:
+                    order_id = json.loads(line.decode())['order_id']
+                    response = {'order_id': order_id, 'fills': await self.submit(order_id)}
+                except (ValueError, KeyError, TypeError, MarketException) as e:
+                    response = {'order_id': order_id, 'error': str(e)}
+
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve_unix(self, path):
+        """Accepts orders on the unix socket at `path`; returns the `asyncio` server"""
+        server = await asyncio.start_unix_server(self._handle_client, path=path)
+        logger.info('Matching service listening on %s', path)
+        return server
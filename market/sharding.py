@@ -0,0 +1,218 @@
+"""
+Matching spread over worker processes, sharded by contract.
+
+Contracts are assigned to workers by consistent hashing on `contract_id`, so adding or removing a worker only moves the
+contracts that hash to it. Each worker is a separate process with its own engine and connection pool; it owns the
+books of its contracts and runs `put_order` for them. `ShardedMatcher` routes every order to the worker that owns its
+contract.
+
+When workers are added or removed, every worker is told the new set of workers and acknowledges once it has finished
+the orders it was given before. It then forgets the books it no longer owns, and the new owner loads them from the
+database on first use. Orders are only routed with the new assignment after all workers have acknowledged, so the
+orders of one contract are never matched by two workers at the same time.
+
+    matcher = ShardedMatcher(workers=4)
+    fills = matcher.submit(order.id, order.contract_id).result()
+"""
+
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future
+
+from market.exceptions import MarketException
+
+
+logger = logging.getLogger(__file__)
+
+
+class HashRing(object):
+
+    def __init__(self, workers=(), replicas=64):
+        self.replicas = replicas
+        self._hashes = []
+        self._owners = {}
+        for worker in workers:
+            self.add(worker)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+    @property
+    def workers(self):
+        return sorted(set(self._owners.values()))
+
+    def add(self, worker):
+        for replica in range(self.replicas):
+            point = self._hash('{}:{}'.format(worker, replica))
+            if point not in self._owners:
+                bisect.insort(self._hashes, point)
+                self._owners[point] = worker
+
+    def remove(self, worker):
+        for point in [point for point, owner in self._owners.items() if owner == worker]:
+            del self._owners[point]
+            del self._hashes[bisect.bisect_left(self._hashes, point)]
+
+    def worker_for(self, contract_id):
+        if not self._hashes:
+            raise MarketException('There are no workers')
+        index = bisect.bisect(self._hashes, self._hash(contract_id)) % len(self._hashes)
+        return self._owners[self._hashes[index]]
+
+
+def _work(name, workers, replicas, settings, inbox, outbox):
+    """Main loop of a worker process; `replicas` must be the same as in the ring that orders are routed with"""
+    from models import Session, configure
+    from market.book import loaded_books, forget_book
+    from market.market import put_order
+    from market.service import describe_fill
+    from models.order import Order
+    import models.contract  # noqa: F401 -- registers every mapped class
+
+    # Never share the parent's connections; every worker gets its own engine and pool
+    configure(**settings)
+    ring = HashRing(workers, replicas)
+
+    while True:
+        message = inbox.get()
+        kind = message[0]
+        if kind == 'stop':
+            break
+
+        elif kind == 'rebalance':
+            _, workers, token = message
+            ring = HashRing(workers, replicas)
+            for contract_id in loaded_books():
+                if name not in workers or ring.worker_for(contract_id) != name:
+                    forget_book(contract_id)
+            outbox.put(('ack', token, name))
+
+        elif kind == 'order':
+            _, request_id, order_id = message
+            session = Session()
+            try:
+                order = session.query(Order).get(order_id)
+                if order is None:
+                    raise MarketException('Unknown order {}'.format(order_id))
+                fills = [describe_fill(transaction) for transaction in put_order(session, order)]
+                outbox.put(('result', request_id, fills, None))
+            except Exception as e:
+                logger.exception('Worker %s could not match order %s', name, order_id)
+                outbox.put(('result', request_id, None, '{}: {}'.format(type(e).__name__, e)))
+            finally:
+                session.close()
+
+
+class ShardedMatcher(object):
+
+    def __init__(self, workers=2, settings=None, replicas=64, context=None):
+        """
+        `workers` is a number of workers or a list of worker names; `settings` are passed to `models.configure` in
+        every worker.
+        """
+        self.settings = settings or {}
+        self.replicas = replicas
+        self._context = context or multiprocessing.get_context('spawn')
+        self._outbox = self._context.Queue()
+        self._processes = {}
+        self._inboxes = {}
+        self._futures = {}
+        self._acks = {}
+        self._request_ids = itertools.count()
+        self._lock = threading.RLock()
+        self._acked = threading.Condition()
+
+        names = ['worker{}'.format(i) for i in range(workers)] if isinstance(workers, int) else list(workers)
+        self.ring = HashRing(names, replicas)
+        for name in names:
+            self._start(name, names)
+
+        self._receiver = threading.Thread(target=self._receive, name='sharded-matcher', daemon=True)
+        self._receiver.start()
+
+    def _start(self, name, names):
+        inbox = self._context.Queue()
+        process = self._context.Process(target=_work, name=name,
+                                        args=(name, names, self.replicas, self.settings, inbox, self._outbox),
+                                        daemon=True)
+        process.start()
+        self._inboxes[name], self._processes[name] = inbox, process
+        logger.info('Started matching worker %s', name)
+
+    def _receive(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                break
+
+            if message[0] == 'result':
+                _, request_id, fills, error = message
+                future = self._futures.pop(request_id)
+                if error is None:
+                    future.set_result(fills)
+                else:
+                    future.set_exception(MarketException(error))
+
+            elif message[0] == 'ack':
+                _, token, name = message
+                with self._acked:
+                    self._acks[token].discard(name)
+                    self._acked.notify_all()
+
+    def submit(self, order_id, contract_id):
+        """Sends the order to the worker that owns `contract_id`; returns a `Future` of its fills"""
+        with self._lock:
+            worker = self.ring.worker_for(contract_id)
+            request_id = next(self._request_ids)
+            future = self._futures[request_id] = Future()
+            self._inboxes[worker].put(('order', request_id, order_id))
+        return future
+
+    def _rebalance(self, names):
+        token = next(self._request_ids)
+        with self._acked:
+            self._acks[token] = set(self._inboxes)
+        for inbox in self._inboxes.values():
+            inbox.put(('rebalance', names, token))
+
+        with self._acked:
+            self._acked.wait_for(lambda: not self._acks[token])
+            del self._acks[token]
+
+    def add_worker(self, name):
+        with self._lock:
+            if name in self._processes:
+                raise MarketException('Worker {} already exists'.format(name))
+
+            names = self.ring.workers + [name]
+            self._rebalance(names)
+            self._start(name, names)
+            self.ring.add(name)
+            logger.info('Added matching worker %s', name)
+
+    def remove_worker(self, name):
+        with self._lock:
+            if name not in self._processes:
+                raise MarketException('Unknown worker {}'.format(name))
+
+            names = [worker for worker in self.ring.workers if worker != name]
+            self._rebalance(names)
+            self.ring.remove(name)
+            self._stop(name)
+            logger.info('Removed matching worker %s', name)
+
+    def _stop(self, name):
+        self._inboxes.pop(name).put(('stop',))
+        self._processes.pop(name).join()
+
+    def close(self):
+        with self._lock:
+            for name in list(self._processes):
+                self._stop(name)
+            self._outbox.put(None)
+            self._receiver.join()
@@ -0,0 +1,61 @@
+import unittest
+from decimal import Decimal
+
+from models.order import Order
+import models.contract  # noqa: F401 -- registers every mapped class
+from models.consts import DirectionType, OrderType, OrderStateType
+from models.fixed import price_units, volume_units, price_from_units, volume_from_units
+from market.book import OrderBook
+
+
+def make_order(order_id, user_id, direction, price, volume, order_type=OrderType.limit_order.value):
+    return Order(id=order_id, user_id=user_id, direction=direction, price=price, volume=volume,
+                 order_type=order_type, state=OrderStateType.in_market.value)
+
+
+class OrderBookTest(unittest.TestCase):
+    def setUp(self):
+        self.book = OrderBook(contract_id=1)
+
+    def test_price_time_priority(self):
+        # Unit prices 0.5, 0.4, 0.4 and 0.6
+        self.book.add(make_order(1, 1, DirectionType.ask.value, Decimal('10'), Decimal('20')))
+        self.book.add(make_order(2, 1, DirectionType.ask.value, Decimal('8'), Decimal('20')))
+        self.book.add(make_order(3, 2, DirectionType.ask.value, Decimal('4'), Decimal('10')))
+        self.book.add(make_order(4, 2, DirectionType.ask.value, Decimal('6'), Decimal('10')))
+
+        assert self.book.best_price(DirectionType.ask.value) == Decimal('0.4')
+        assert [entry.order_id for entry in self.book.resting(DirectionType.ask.value)] == [2, 3, 1, 4]
+
+    def test_candidates_respect_limit_and_user(self):
+        self.book.add(make_order(1, 1, DirectionType.bid.value, Decimal('10'), Decimal('20')))
+        self.book.add(make_order(2, 2, DirectionType.bid.value, Decimal('12'), Decimal('20')))
+        self.book.add(make_order(3, 3, DirectionType.bid.value, Decimal('4'), Decimal('20')))
+
+        ask_order = make_order(4, 2, DirectionType.ask.value, Decimal('5'), Decimal('10'))
+        assert [entry.order_id for entry in self.book.candidates(ask_order)] == [1]
+
+        market_order = make_order(5, 4, DirectionType.ask.value, None, Decimal('10'), OrderType.market_order.value)
+        assert [entry.order_id for entry in self.book.candidates(market_order)] == [2, 1, 3]
+
+    def test_remove_and_update(self):
+        order = make_order(1, 1, DirectionType.bid.value, Decimal('10'), Decimal('20'))
+        self.book.add(order)
+        assert 1 in self.book
+
+        order.state = OrderStateType.cancelled.value
+        self.book.update(order)
+        assert 1 not in self.book
+        assert self.book.best_price(DirectionType.bid.value) is None
+        assert len(self.book) == 0
+
+    def test_entries_are_fixed_point(self):
+        self.book.add(make_order(1, 1, DirectionType.ask.value, Decimal('1'), Decimal('3')))
+        entry = next(self.book.resting(DirectionType.ask.value))
+
+        # 1 / 3 = 0.33333333, in units of 10^-8
+        assert (entry.unit_price, entry.volume) == (33333333, 30000)
+        assert price_from_units(entry.unit_price) == Decimal('0.33333333')
+        assert volume_from_units(entry.volume) == Decimal('3')
+        assert price_units(Decimal('0.5')) == 50000000 and volume_units(Decimal('0.0001')) == 1
+        assert not hasattr(entry, '__dict__')
@@ -0,0 +1,58 @@
+from decimal import Decimal
+
+from sqlalchemy import event
+
+from models.testing import MarketTestCase
+from models.order import Order
+from models.consts import OrderType
+from market.depth import depth, top_of_book, subscribe, unsubscribe
+from market.market import put_order
+
+
+class DepthTest(MarketTestCase):
+    def setUp(self):
+        super(DepthTest, self).setUp()
+        self.messages = []
+        subscribe(self.messages.append)
+
+    def tearDown(self):
+        unsubscribe(self.messages.append)
+        super(DepthTest, self).tearDown()
+
+    def order(self, user, price, volume, is_bid):
+        order = Order.create_order(self.session, user, price, self.usd, self.contract, volume, is_bid,
+                                   OrderType.limit_order.value)
+        return order, put_order(self.session, order)
+
+    def test_incremental_depth(self):
+        self.order(self.issuer, Decimal('6'), Decimal('10'), False)
+        assert depth(self.session, self.contract.id)['asks'] == [(Decimal('0.6'), Decimal('10'), 1)]
+        assert self.messages[-1]['snapshot'] and self.messages[-1]['sequence'] == 1
+
+        self.order(self.issuer, Decimal('3'), Decimal('5'), False)
+        bid, _ = self.order(self.buyer, Decimal('5'), Decimal('10'), True)
+
+        # Reading depth does not go to the database
+        contract_id = self.contract.id
+        statements = []
+        record = lambda *args: statements.append(args[2])  # noqa: E731
+        event.listen(self.connection.engine, 'before_cursor_execute', record)
+        try:
+            assert top_of_book(self.session, contract_id) == ((Decimal('0.5'), Decimal('10'), 1),
+                                                              (Decimal('0.6'), Decimal('15'), 2))
+        finally:
+            event.remove(self.connection.engine, 'before_cursor_execute', record)
+        assert statements == []
+
+        # A bid that fills part of the best ask level
+        _, transactions = self.order(self.buyer, Decimal('4.2'), Decimal('7'), True)
+        assert len(transactions) == 1
+        assert depth(self.session, self.contract.id, limit=1) == {
+            'contract_id': self.contract.id, 'sequence': 4, 'snapshot': True,
+            'bids': [(Decimal('0.5'), Decimal('10'), 1)], 'asks': [(Decimal('0.6'), Decimal('8'), 2)]}
+
+        bid.cancel(self.session)
+        assert self.messages[-1] == {'contract_id': self.contract.id, 'sequence': 5, 'snapshot': False,
+                                     'bids': [(Decimal('0.5'), 0, 0)], 'asks': []}
+        assert [message['sequence'] for message in self.messages] == [1, 2, 3, 4, 5]
+        assert top_of_book(self.session, self.contract.id)[0] is None
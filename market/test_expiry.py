@@ -0,0 +1,54 @@
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+from models.testing import MarketTestCase
+from models.order import Order
+from models.consts import OrderType, OrderStateType
+from market.book import get_book
+from market.expiry import ExpiryScheduler, expire_orders
+from market.market import put_order
+
+
+class ExpiryTest(MarketTestCase):
+    def bid(self, expires_in=None):
+        order = Order.create_order(self.session, self.buyer, Decimal('5'), self.usd, self.contract, Decimal('10'),
+                                   True, OrderType.limit_order.value, expires_in)
+        put_order(self.session, order)
+        return order
+
+    def test_expired_orders_are_not_matched(self):
+        expiring = self.bid(timedelta(minutes=1))
+        assert expiring.expires_at == expiring.created_at + timedelta(minutes=1)
+        assert not expiring.has_expired()
+        assert expiring.has_expired(datetime.now() + timedelta(minutes=2))
+
+        # Until the scheduler gets to it, an expired order is passed over rather than matched
+        expiring.expires_at = datetime.now() - timedelta(seconds=1)
+        self.session.commit()
+        lasting = self.bid()
+        ask = Order.create_order(self.session, self.issuer, Decimal('5'), self.usd, self.contract, Decimal('10'),
+                                 False, OrderType.limit_order.value)
+        assert [transaction.bid_order for transaction in put_order(self.session, ask)] == [lasting]
+        assert expiring.state == OrderStateType.in_market.value
+
+    def test_scheduler_cancels_and_releases(self):
+        orders = [self.bid(timedelta(seconds=seconds)) for seconds in (30, 10, 20, 3600)]
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('80')
+
+        scheduler = ExpiryScheduler(horizon=timedelta(minutes=1))
+        now = datetime.now()
+        scheduler.load(self.session, now)
+        assert len(scheduler) == 3
+        assert scheduler.next_deadline() == orders[1].expires_at
+
+        # Deadlines come out of the heap in order, and only once they have passed
+        later = now + timedelta(seconds=25)
+        due = scheduler.pop_due(later)
+        assert due == [orders[1].id, orders[2].id]
+        assert [order.id for order in expire_orders(self.session, due, later)] == due
+
+        assert [order.state for order in orders] == [OrderStateType.in_market.value, OrderStateType.cancelled.value,
+                                                     OrderStateType.cancelled.value, OrderStateType.in_market.value]
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('90')
+        assert orders[1].id not in get_book(self.session, self.contract.id)
+        assert orders[0].id in get_book(self.session, self.contract.id)
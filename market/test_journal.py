@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+
+from models import Base, Session, make_engine, unit_of_work
+from models.testing import MarketFixture
+from models.order import Order
+from models.consts import DirectionType, OrderType
+from models.fixed import price_from_units, volume_from_units
+from market.book import OrderBook, clear_books
+from market.journal import RECORD_SIZE, Journal, open_journal, close_journal, read_records, write_snapshot, replay
+from market.market import put_order
+
+
+class JournalTest(MarketFixture, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.directory.name, 'orders.journal')
+        self.snapshot_path = os.path.join(self.directory.name, 'orders.snapshot')
+        self.engine = make_engine('sqlite:///' + os.path.join(self.directory.name, 'btcex.db'))
+        Base.metadata.create_all(bind=self.engine)
+        self.session = Session(bind=self.engine)
+        clear_books()
+        self.create_market()
+        self.journal = open_journal(self.journal_path, fsync=False)
+
+    def tearDown(self):
+        close_journal()
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+        clear_books()
+
+    def order(self, user, price, volume, is_bid):
+        order = Order.create_order(self.session, user, price, self.usd, self.contract, volume, is_bid,
+                                   OrderType.limit_order.value)
+        self.session.commit()
+        put_order(self.session, order)
+        return order
+
+    def resting(self, book):
+        return [(entry.order_id, price_from_units(entry.unit_price), volume_from_units(entry.volume))
+                for direction in DirectionType for entry in book.resting(direction.value)]
+
+    def test_journal_and_replay(self):
+        first_ask = self.order(self.issuer, Decimal('5'), Decimal('10'), False)
+        self.order(self.issuer, Decimal('6'), Decimal('10'), False)
+        assert [(record.sequence, record.kind, record.order_id) for record in read_records(self.journal_path)] == \
+            [(1, 'create', first_ask.id), (2, 'put', first_ask.id), (3, 'create', first_ask.id + 1),
+             (4, 'put', first_ask.id + 1)]
+
+        assert write_snapshot(self.session, self.snapshot_path) == 4
+        bid = self.order(self.buyer, Decimal('9'), Decimal('15'), True)
+        self.order(self.buyer, Decimal('1'), Decimal('4'), True).cancel(self.session)
+        assert [record.kind for record in read_records(self.journal_path, after_sequence=4)] == \
+            ['create', 'put', 'fill', 'fill', 'fill', 'fill', 'create', 'put', 'cancel']
+
+        # Nothing that is rolled back ends up in the journal
+        with self.assertRaises(ZeroDivisionError):
+            with unit_of_work(self.session):
+                put_order(self.session, Order.create_order(self.session, self.issuer, Decimal('9'), self.usd,
+                                                           self.contract, Decimal('10'), False,
+                                                           OrderType.limit_order.value))
+                1 / 0
+        assert self.journal.sequence == 13
+
+        books = replay(self.snapshot_path, self.journal_path)
+        expected = self.resting(OrderBook.load(self.session, self.contract.id))
+        assert self.resting(books[self.contract.id]) == expected == [(first_ask.id + 1, Decimal('0.6'), Decimal('5'))]
+        assert bid.state == 'Executed'
+
+    def test_torn_tail_is_cut_off(self):
+        self.order(self.issuer, Decimal('5'), Decimal('10'), False)
+        close_journal()
+        with open(self.journal_path, 'ab') as f:
+            f.write(b'\x00' * (RECORD_SIZE // 2))
+
+        journal = Journal(self.journal_path, fsync=False)
+        try:
+            assert journal.sequence == 2
+            assert os.path.getsize(self.journal_path) == 2 * RECORD_SIZE
+        finally:
+            journal.close()
+
+    def test_lost_records_are_reconciled(self):
+        first_ask = self.order(self.issuer, Decimal('5'), Decimal('10'), False)
+        write_snapshot(self.session, self.snapshot_path)
+        second_ask = self.order(self.issuer, Decimal('6'), Decimal('10'), False)
+        close_journal()
+
+        # A crash after the commit of the last transition, but before it was journalled
+        os.truncate(self.journal_path, 3 * RECORD_SIZE)
+        assert [entry[0] for entry in self.resting(replay(self.snapshot_path, self.journal_path)[self.contract.id])] \
+            == [first_ask.id]
+        books = replay(self.snapshot_path, self.journal_path, self.session)
+        assert [entry[0] for entry in self.resting(books[self.contract.id])] == [first_ask.id, second_ask.id]
+
+        # The order is not in the journal at all
+        os.truncate(self.journal_path, 2 * RECORD_SIZE)
+        books = replay(self.snapshot_path, self.journal_path, self.session)
+        assert self.resting(books[self.contract.id]) == self.resting(OrderBook.load(self.session, self.contract.id))
@@ -0,0 +1,176 @@
+import os
+import threading
+import unittest
+from collections import defaultdict
+from decimal import Decimal
+from datetime import datetime, timedelta
+from unittest import mock
+
+from models import Base, Session, make_engine
+from models.testing import MarketTestCase
+from models.account import User, Balance
+from models.asset import Asset
+from models.order import Order, Transaction
+from models.contract import FuturesContract
+from models.consts import OrderType
+from market.market import put_order
+
+
+URL = os.environ.get('BTCEX_TEST_DATABASE_URL', '')
+
+WORKERS = 8
+ORDERS_PER_WORKER = 10
+
+
+@unittest.skipUnless(URL.startswith('postgres'), 'needs BTCEX_TEST_DATABASE_URL to point at PostgreSQL')
+class ConcurrentMatchingTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = make_engine(URL, pool_size=WORKERS + 2)
+        Base.metadata.drop_all(bind=self.engine)
+        Base.metadata.create_all(bind=self.engine)
+        session = Session(bind=self.engine, info={'row_locks': True})
+
+        issuer = User.create_user(session, 'issuer', 'abcd')
+        btc, usd = Asset.create_asset('BTC'), Asset.create_asset('USD')
+        issuer.increase_volume_of_asset(session, btc, Decimal('1'))
+        contract, _ = FuturesContract.create_contract(session, issuer, datetime.now() + timedelta(days=14), btc,
+                                                      Decimal('1'), 'FUTURE', Decimal('1000'))
+        self.buyers = []
+        for i in range(WORKERS):
+            buyer = User.create_user(session, 'buyer{}'.format(i), 'abcd')
+            buyer.increase_volume_of_asset(session, usd, Decimal('1000'))
+            self.buyers.append(buyer.id)
+        session.commit()
+
+        # Fewer asks than bids, so that the workers compete for them
+        for _ in range(WORKERS * ORDERS_PER_WORKER // 2):
+            put_order(session, Order.create_order(session, issuer, Decimal('1'), usd, contract, Decimal('1'), False,
+                                                  OrderType.limit_order.value))
+        self.contract_id, self.usd_id = contract.id, usd.id
+
+        # Two traders that hold both sides of a contract without other orders, for crossing each other's orders
+        issuer.increase_volume_of_asset(session, btc, Decimal('1'))
+        crossed, crossed_asset = FuturesContract.create_contract(session, issuer, datetime.now() + timedelta(days=14),
+                                                                 btc, Decimal('1'), 'CROSSED', Decimal('1000'))
+        self.traders = []
+        for i in range(2):
+            trader = User.create_user(session, 'trader{}'.format(i), 'abcd')
+            trader.increase_volume_of_asset(session, usd, Decimal('1000'))
+            issuer.decrease_volume_of_asset(session, crossed_asset, Decimal('100'))
+            trader.increase_volume_of_asset(session, crossed_asset, Decimal('100'))
+            self.traders.append(trader.id)
+        session.commit()
+        self.crossed_id = crossed.id
+        session.close()
+
+    def tearDown(self):
+        # Leave an empty schema behind for the other tests
+        Base.metadata.drop_all(bind=self.engine)
+        Base.metadata.create_all(bind=self.engine)
+        self.engine.dispose()
+
+    def bid(self, buyer_id, errors):
+        session = Session(bind=self.engine, info={'row_locks': True})
+        try:
+            buyer, usd = session.query(User).get(buyer_id), session.query(Asset).get(self.usd_id)
+            contract = session.query(FuturesContract).get(self.contract_id)
+            for _ in range(ORDERS_PER_WORKER):
+                put_order(session, Order.create_order(session, buyer, Decimal('1'), usd, contract, Decimal('1'), True,
+                                                      OrderType.limit_order.value))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            session.close()
+
+    def cross(self, trader_id, other_id, barrier, errors):
+        session = Session(bind=self.engine, info={'row_locks': True})
+        try:
+            trader, usd = session.query(User).get(trader_id), session.query(Asset).get(self.usd_id)
+            contract = session.query(FuturesContract).get(self.crossed_id)
+            for _ in range(ORDERS_PER_WORKER):
+                # Both traders rest an ask and then bid at the other one's price, so that their trades lock both
+                price = Decimal('2') if trader_id < other_id else Decimal('3')
+                put_order(session, Order.create_order(session, trader, price, usd, contract, Decimal('1'), False,
+                                                      OrderType.limit_order.value))
+                barrier.wait()
+                other_price = Decimal('3') if trader_id < other_id else Decimal('2')
+                put_order(session, Order.create_order(session, trader, other_price, usd, contract, Decimal('1'), True,
+                                                      OrderType.limit_order.value))
+                barrier.wait()
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+        finally:
+            session.close()
+
+    def test_crossing_traders_do_not_deadlock(self):
+        errors, barrier = [], threading.Barrier(2, timeout=30)
+        threads = [threading.Thread(target=self.cross, args=(trader_id, other_id, barrier, errors))
+                   for trader_id, other_id in (self.traders, self.traders[::-1])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+        session = Session(bind=self.engine)
+        try:
+            assert Balance.verify(session) == []
+        finally:
+            session.close()
+
+    def test_no_order_is_filled_twice(self):
+        errors = []
+        threads = [threading.Thread(target=self.bid, args=(buyer_id, errors)) for buyer_id in self.buyers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+        session = Session(bind=self.engine)
+        try:
+            filled = defaultdict(Decimal)
+            for transaction in session.query(Transaction):
+                filled[transaction.ask_order_id] += transaction.volume
+                filled[transaction.bid_order_id] += transaction.volume
+
+            orders = session.query(Order).all()
+            assert all(filled[order.id] == order.filled_volume <= order.volume for order in orders)
+            assert session.query(Transaction).count() == WORKERS * ORDERS_PER_WORKER // 2
+            assert Balance.verify(session) == []
+        finally:
+            session.close()
+
+
+class LockOrderTest(MarketTestCase):
+    def test_balances_are_locked_in_key_order(self):
+        # Every balance a transaction locks has to come after the ones it already holds
+        out_of_order = []
+        lock, hold = Balance.lock.__func__, Balance.hold.__func__
+
+        def check(session, keys):
+            held = set(session.info.get('locked_balances', ()))
+            new = set(keys) - held
+            if held and new and min(new) < max(held):
+                out_of_order.append((sorted(held), sorted(new)))
+
+        def checked_lock(cls, session, keys):
+            check(session, keys)
+            return lock(cls, session, keys)
+
+        def checked_hold(cls, session, user_id, asset_id, volume):
+            check(session, [(user_id, asset_id)])
+            return hold(cls, session, user_id, asset_id, volume)
+
+        with mock.patch.object(Balance, 'lock', classmethod(checked_lock)), \
+                mock.patch.object(Balance, 'hold', classmethod(checked_hold)):
+            # The buyer sorts after the issuer, so the buyer's reservation must not be held while the trade locks
+            put_order(self.session, Order.create_order(self.session, self.issuer, Decimal('5'), self.usd,
+                                                       self.contract, Decimal('10'), False,
+                                                       OrderType.limit_order.value))
+            bid_order = Order.create_order(self.session, self.buyer, Decimal('5'), self.usd, self.contract,
+                                           Decimal('10'), True, OrderType.limit_order.value)
+            assert len(put_order(self.session, bid_order)) == 1
+
+        assert out_of_order == []
@@ -0,0 +1,174 @@
+from decimal import Decimal
+from unittest import mock
+
+from models import unit_of_work
+from models.testing import MarketTestCase
+from models.order import Order
+from models.consts import OrderType, OrderStateType
+from market.exceptions import MarketException
+from market.book import get_book, loaded_books
+from market.market import PUT_ORDER_SECONDS, FILLS, put_order, put_orders
+
+
+class SweepTest(MarketTestCase):
+    def ask(self, price, volume):
+        order = Order.create_order(self.session, self.issuer, price, self.usd, self.contract, volume, False,
+                                   OrderType.limit_order.value)
+        assert put_order(self.session, order) == []
+        return order
+
+    def test_sweep_several_levels(self):
+        cheap = self.ask(Decimal('5'), Decimal('10'))
+        expensive = self.ask(Decimal('12'), Decimal('20'))
+        too_expensive = self.ask(Decimal('10'), Decimal('10'))
+
+        # Limit of 0.6 per unit for 25 units reaches the first two levels, but not the third one
+        bid_order = Order.create_order(self.session, self.buyer, Decimal('15'), self.usd, self.contract, Decimal('25'),
+                                       True, OrderType.limit_order.value)
+        fills, commits = FILLS.value, PUT_ORDER_SECONDS.labels('commit').count
+        transactions = put_order(self.session, bid_order)
+        assert [(t.ask_order, t.volume, t.price) for t in transactions] == \
+            [(cheap, Decimal('10'), Decimal('5')), (expensive, Decimal('15'), Decimal('9'))]
+        assert (FILLS.value, PUT_ORDER_SECONDS.labels('commit').count) == (fills + 2, commits + 1)
+
+        assert cheap.state == OrderStateType.executed.value
+        assert expensive.state == OrderStateType.in_market.value
+        assert expensive.remaining_volume == Decimal('5')
+        assert too_expensive.remaining_volume == Decimal('10')
+        assert bid_order.state == OrderStateType.executed.value
+
+        # Paid 14 of the 15 reserved; the difference is available again
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('86')
+        assert self.buyer.volume_of_asset(self.session, self.future) == Decimal('25')
+        assert self.issuer.volume_of_asset(self.session, self.usd) == Decimal('14')
+
+    def test_fills_add_up_to_the_limit(self):
+        # 1 for 3 units is 0.33333333 per unit; the whole order must still be paid 1
+        ask_order = self.ask(Decimal('1'), Decimal('3'))
+        bid_order = Order.create_order(self.session, self.buyer, Decimal('1'), self.usd, self.contract, Decimal('3'),
+                                       True, OrderType.limit_order.value)
+        assert [t.price for t in put_order(self.session, bid_order)] == [Decimal('1')]
+        assert ask_order.state == OrderStateType.executed.value
+
+        # The fills of 2 for 3 are rounded up, apart from the last one
+        ask_order = self.ask(Decimal('2'), Decimal('3'))
+        prices = []
+        for _ in range(3):
+            bid_order = Order.create_order(self.session, self.buyer, Decimal('1'), self.usd, self.contract,
+                                           Decimal('1'), True, OrderType.limit_order.value)
+            prices.extend(t.price for t in put_order(self.session, bid_order))
+        assert prices == [Decimal('0.6667'), Decimal('0.6667'), Decimal('0.6666')]
+        assert ask_order.state == OrderStateType.executed.value
+
+        assert self.issuer.volume_of_asset(self.session, self.usd) == Decimal('3')
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('97')
+
+    def test_statement_budget(self):
+        self.ask(Decimal('5'), Decimal('10'))
+        self.ask(Decimal('6'), Decimal('10'))
+        bid_order = Order.create_order(self.session, self.buyer, Decimal('12'), self.usd, self.contract, Decimal('20'),
+                                       True, OrderType.limit_order.value)
+        self.session.commit()
+
+        # Everything was expired by the commit; the order and what it refers to are loaded in one go, and the owners
+        # of the asks along with them, instead of one lazy load at a time
+        with self.assertQueryBudget(42) as budget:
+            assert len(put_order(self.session, bid_order)) == 2
+        selected_from = set(' '.join(statement.split()).split(' FROM ')[1].split()[0]
+                            for statement in budget.executed if statement.startswith('SELECT'))
+        assert selected_from == {'orders', 'balances', 'candles'}
+
+    def test_remainder_rests_or_is_cancelled(self):
+        self.ask(Decimal('5'), Decimal('10'))
+
+        limit_order = Order.create_order(self.session, self.buyer, Decimal('10'), self.usd, self.contract,
+                                         Decimal('20'), True, OrderType.limit_order.value)
+        assert len(put_order(self.session, limit_order)) == 1
+        assert limit_order.state == OrderStateType.in_market.value
+        assert limit_order.remaining_volume == Decimal('10')
+
+        # Cancelling the rest releases only the part that was not filled
+        assert limit_order.cancel(self.session) is True
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('95')
+
+        self.ask(Decimal('5'), Decimal('10'))
+        market_order = Order.create_order(self.session, self.buyer, Decimal('20'), self.usd, self.contract,
+                                          Decimal('20'), True, OrderType.market_order.value)
+        assert len(put_order(self.session, market_order)) == 1
+        assert market_order.state == OrderStateType.cancelled.value
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('90')
+
+    def test_put_orders(self):
+        orders = [Order.create_order(self.session, self.issuer, Decimal('5'), self.usd, self.contract, Decimal('10'),
+                                     False, OrderType.limit_order.value),
+                  Order.create_order(self.session, self.issuer, Decimal('6'), self.usd, self.contract, Decimal('10'),
+                                     False, OrderType.limit_order.value),
+                  Order.create_order(self.session, self.buyer, Decimal('12'), self.usd, self.contract, Decimal('20'),
+                                     True, OrderType.limit_order.value)]
+
+        # Every order has to be new, so nothing happens if one of them is given twice
+        with self.assertRaises(MarketException):
+            put_orders(self.session, orders + orders[:1])
+        assert all(order.state == OrderStateType.created.value for order in orders)
+
+        results = put_orders(self.session, orders)
+        assert [result.order for result in results] == orders
+        assert [result.error for result in results] == [None, None, None]
+        assert [len(result.transactions) for result in results] == [0, 0, 2]
+        assert all(order.state == OrderStateType.executed.value for order in orders)
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('89')
+
+    def test_unit_of_work(self):
+        with mock.patch.object(self.session, 'commit', wraps=self.session.commit) as commit:
+            with unit_of_work(self.session):
+                ask_order = self.ask(Decimal('5'), Decimal('10'))
+                bid_order = Order.create_order(self.session, self.buyer, Decimal('5'), self.usd, self.contract,
+                                               Decimal('10'), True, OrderType.limit_order.value)
+                assert len(put_order(self.session, bid_order)) == 1
+                assert commit.call_count == 0
+            assert commit.call_count == 1
+        assert ask_order.state == bid_order.state == OrderStateType.executed.value
+
+        # When the unit of work is rolled back, so is the book
+        with self.assertRaises(ZeroDivisionError):
+            with unit_of_work(self.session):
+                ask_order = self.ask(Decimal('5'), Decimal('10'))
+                assert ask_order.id in get_book(self.session, self.contract.id)
+                1 / 0
+        assert ask_order.id not in get_book(self.session, self.contract.id)
+
+        # The same for a batch, which matches every order in a savepoint of its own
+        resting = self.ask(Decimal('5'), Decimal('10'))
+        with self.assertRaises(ZeroDivisionError):
+            with unit_of_work(self.session):
+                bid_order = Order.create_order(self.session, self.buyer, Decimal('5'), self.usd, self.contract,
+                                               Decimal('10'), True, OrderType.limit_order.value)
+                ask_order = Order.create_order(self.session, self.issuer, Decimal('6'), self.usd, self.contract,
+                                               Decimal('10'), False, OrderType.limit_order.value)
+                assert [len(result.transactions) for result in put_orders(self.session, [bid_order, ask_order])] == \
+                    [1, 0]
+                1 / 0
+        book = get_book(self.session, self.contract.id)
+        assert resting.id in book
+        assert ask_order.id not in book
+
+        bid_order = Order.create_order(self.session, self.buyer, Decimal('5'), self.usd, self.contract, Decimal('10'),
+                                       True, OrderType.limit_order.value)
+        assert [t.ask_order for t in put_order(self.session, bid_order)] == [resting]
+
+    def test_row_locks(self):
+        self.session.info['row_locks'] = True
+        cheap = self.ask(Decimal('5'), Decimal('10'))
+        expensive = self.ask(Decimal('12'), Decimal('20'))
+        self.ask(Decimal('10'), Decimal('10'))
+
+        # Same sweep as above, with the candidates taken from the database instead of the book
+        bid_order = Order.create_order(self.session, self.buyer, Decimal('15'), self.usd, self.contract, Decimal('25'),
+                                       True, OrderType.limit_order.value)
+        fills, commits = FILLS.value, PUT_ORDER_SECONDS.labels('commit').count
+        transactions = put_order(self.session, bid_order)
+        assert [(t.ask_order, t.volume, t.price) for t in transactions] == \
+            [(cheap, Decimal('10'), Decimal('5')), (expensive, Decimal('15'), Decimal('9'))]
+        assert (FILLS.value, PUT_ORDER_SECONDS.labels('commit').count) == (fills + 2, commits + 1)
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('86')
+        assert self.contract.id not in loaded_books()
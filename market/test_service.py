@@ -0,0 +1,64 @@
+import asyncio
+import json
+import os
+import tempfile
+from decimal import Decimal
+
+from models import Session
+from models.testing import MarketTestCase
+from models.order import Order
+from models.consts import OrderType
+from market.service import MatchingService
+
+
+class MatchingServiceTest(MarketTestCase):
+    contract_count = 2
+
+    def setUp(self):
+        super(MatchingServiceTest, self).setUp()
+
+        # The service runs in a worker thread; it has to see what this test wrote in its transaction
+        self.service = MatchingService(session_factory=lambda: Session(bind=self.connection), max_workers=1)
+
+    def order(self, user, contract, is_bid):
+        order = Order.create_order(self.session, user, Decimal('5'), self.usd, contract, Decimal('10'), is_bid,
+                                   OrderType.limit_order.value)
+        self.session.commit()
+        return order
+
+    def test_submit(self):
+        asks = [self.order(self.issuer, contract, False) for contract in self.contracts]
+        bids = [self.order(self.buyer, contract, True) for contract in self.contracts]
+
+        async def run():
+            await asyncio.gather(*(self.service.submit(ask.id) for ask in asks))
+            fills = await asyncio.gather(*(self.service.submit(bid.id, bid.contract_id) for bid in bids))
+            await self.service.close()
+            return fills
+
+        fills = asyncio.run(run())
+        assert [[(fill['ask_order_id'], fill['bid_order_id'], fill['volume']) for fill in contract_fills]
+                for contract_fills in fills] == [[(ask.id, bid.id, '10.0000')] for ask, bid in zip(asks, bids)]
+
+    def test_unix_socket(self):
+        ask = self.order(self.issuer, self.contracts[0], False)
+
+        async def run(path):
+            server = await self.service.serve_unix(path)
+            reader, writer = await asyncio.open_unix_connection(path)
+            for request in (b'{"order_id": ' + str(ask.id).encode() + b'}\n', b'{"order_id": 1000}\n', b'nonsense\n'):
+                writer.write(request)
+                await writer.drain()
+            responses = [json.loads((await reader.readline()).decode()) for _ in range(3)]
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            await self.service.close()
+            return responses
+
+        with tempfile.TemporaryDirectory() as directory:
+            responses = asyncio.run(run(os.path.join(directory, 'matching.sock')))
+
+        assert responses[0] == {'order_id': ask.id, 'fills': []}
+        assert responses[1] == {'order_id': 1000, 'error': 'Unknown order 1000'}
+        assert responses[2]['order_id'] is None and 'error' in responses[2]
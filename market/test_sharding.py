@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+
+from models import Base, Session, make_engine
+from models.testing import MarketFixture
+from models.order import Order
+from models.consts import OrderType
+from market.sharding import HashRing, ShardedMatcher
+
+
+class HashRingTest(unittest.TestCase):
+    def test_adding_a_worker_only_moves_its_contracts(self):
+        ring = HashRing(['worker0', 'worker1', 'worker2'])
+        before = dict((contract_id, ring.worker_for(contract_id)) for contract_id in range(1000))
+        assert set(before.values()) == {'worker0', 'worker1', 'worker2'}
+
+        ring.add('worker3')
+        after = dict((contract_id, ring.worker_for(contract_id)) for contract_id in range(1000))
+        moved = [contract_id for contract_id in before if before[contract_id] != after[contract_id]]
+        assert moved
+        assert all(after[contract_id] == 'worker3' for contract_id in moved)
+
+        ring.remove('worker3')
+        assert dict((contract_id, ring.worker_for(contract_id)) for contract_id in range(1000)) == before
+
+
+class ShardedMatcherTest(MarketFixture, unittest.TestCase):
+    contract_count = 4
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///' + os.path.join(self.directory.name, 'btcex.db')
+        self.engine = make_engine(self.url)
+        Base.metadata.create_all(bind=self.engine)
+        # Reloading attributes after a commit would keep a read transaction open while the workers write
+        self.session = Session(bind=self.engine, expire_on_commit=False)
+        self.create_market()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def order(self, user, contract, is_bid, price=Decimal('5'), volume=Decimal('10')):
+        order = Order.create_order(self.session, user, price, self.usd, contract, volume, is_bid,
+                                   OrderType.limit_order.value)
+        self.session.commit()
+        return order
+
+    def test_orders_are_matched_by_the_owning_worker(self):
+        matcher = ShardedMatcher(workers=2, settings={'url': self.url})
+        try:
+            asks = [self.order(self.issuer, contract, False) for contract in self.contracts]
+            assert [matcher.submit(ask.id, ask.contract_id).result(timeout=30) for ask in asks] == [[]] * 4
+
+            # Books move to their new owners without losing the resting asks
+            matcher.add_worker('worker2')
+            matcher.remove_worker('worker0')
+
+            bids = [self.order(self.buyer, contract, True) for contract in self.contracts]
+            fills = [matcher.submit(bid.id, bid.contract_id).result(timeout=30) for bid in bids]
+            assert [[(fill['ask_order_id'], fill['bid_order_id']) for fill in contract_fills]
+                    for contract_fills in fills] == [[(ask.id, bid.id)] for ask, bid in zip(asks, bids)]
+        finally:
+            matcher.close()
+
+    def test_workers_use_the_replicas_of_the_router(self):
+        # Find a contract, a number of replicas and a new worker that it moves to when the worker is added, while with
+        # the default number of replicas it would stay with its owner
+        def owner(workers, contract, replicas=64):
+            return HashRing(workers, replicas).worker_for(contract.id)
+
+        workers = ['worker0', 'worker1']
+        contract, replicas, new_worker = next(
+            (contract, replicas, name) for contract in self.contracts for replicas in (2, 4, 8)
+            for name in ('worker{}'.format(i) for i in range(2, 100))
+            if owner(workers, contract, replicas) == owner(workers, contract) == owner(workers + [name], contract) and
+            owner(workers + [name], contract, replicas) == name)
+
+        matcher = ShardedMatcher(workers=2, settings={'url': self.url}, replicas=replicas)
+        try:
+            first_ask = self.order(self.issuer, contract, False)
+            assert matcher.submit(first_ask.id, contract.id).result(timeout=30) == []
+            matcher.add_worker(new_worker)
+            second_ask = self.order(self.issuer, contract, False)
+            assert matcher.submit(second_ask.id, contract.id).result(timeout=30) == []
+
+            # Back with its first owner, which must load the book again rather than keep the one without the second ask
+            matcher.remove_worker(new_worker)
+            bid = self.order(self.buyer, contract, True, Decimal('10'), Decimal('20'))
+            fills = matcher.submit(bid.id, contract.id).result(timeout=30)
+            assert [fill['ask_order_id'] for fill in fills] == [first_ask.id, second_ask.id]
+        finally:
+            matcher.close()
@@ -1,12 +1,15 @@
 import logging
+from datetime import datetime
 from decimal import Decimal
 from collections import defaultdict
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Numeric, Enum
-from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy import Column, Integer, String, ForeignKey, Numeric, Enum, Index, DateTime, event
+from sqlalchemy.orm import relationship, Session
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import func, select, exists, and_, or_, literal
 
-from models import Base
+from models import Base, commit_or_flush, instance_id
+from models.asset import asset_removed
 
 
 logger = logging.getLogger(__file__)
@@ -27,49 +30,59 @@ class User(Base):
         return user
 
     def volume_of_asset(self, session, asset):
-        current_holdings = Holding.current_holdings_for_user(session, self)
-        return current_holdings[asset.id]
+        """What this user can spend of `asset`: the balance less what open orders have reserved"""
+        return Balance.available_for(session, self, asset)
 
     def increase_volume_of_asset(self, session, asset, volume):
         holding = Holding.create_holding(session, self, asset, volume)
         if holding is not None:
             session.add(holding)
-            logger.info('Increased holding of asset {} for user {} with {}'.format(asset.id, self.id, volume))
+            Balance.record_holding(session, holding)
+            logger.info('Increased holding of asset %s for user %s with %s',
+                        instance_id(asset), instance_id(self), volume)
             return holding
         else:
-            logger.warning('Could not increase holding of asset {} for user {} ({})'.format(asset.id, self.id, volume))
+            logger.warning('Could not increase holding of asset %s for user %s (%s)',
+                           instance_id(asset), instance_id(self), volume)
             return None
 
     def decrease_volume_of_asset(self, session, asset, volume):
         holding = Holding.create_holding(session, self, asset, -volume)
         if holding is not None:
             session.add(holding)
-            logger.info('Decreased holding of asset {} for user {} with {}'.format(asset.id, self.id, volume))
+            Balance.record_holding(session, holding)
+            logger.info('Decreased holding of asset %s for user %s with %s',
+                        instance_id(asset), instance_id(self), volume)
             return holding
         else:
-            logger.warning('Could not decrease holding of asset {} for user {} ({})'.format(asset.id, self.id, volume))
+            logger.warning('Could not decrease holding of asset %s for user %s (%s)',
+                           instance_id(asset), instance_id(self), volume)
             return None
 
 
 class Holding(Base):
 
     __tablename__ = 'holdings'
+    __table_args__ = (Index('ix_holdings_user_asset', 'user_id', 'asset_id'),
+                      Index('ix_holdings_asset_user', 'asset_id', 'user_id'))
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     asset_id = Column(Integer, ForeignKey('assets.id'))
     volume = Column(Numeric(precision=10, scale=4))
-    source = Column(Enum('InternalTrade', 'External', name='source_types'))
+    # A `Snapshot` holding stands in for the holdings that `compact_holdings` moved to the archive
+    source = Column(Enum('InternalTrade', 'External', 'Snapshot', name='source_types'))
     description = Column(String(250))
+    created_at = Column(DateTime, default=datetime.now)
 
     user = relationship('User')
     asset = relationship('Asset')
 
     @classmethod
     def create_holding(cls, session, user, asset, volume, source='InternalTrade', description=None):
-        logger.info('Trying to increase/decrease volume in asset {} for user {}'.format(asset.id, user.id))
-        if asset.removed:
-            logger.warning('Tried to increase/decrease volume in a removed asset ({})'.format(asset.id))
+        logger.info('Trying to increase/decrease volume in asset %s for user %s', instance_id(asset), instance_id(user))
+        if asset_removed(session, asset):
+            logger.warning('Tried to increase/decrease volume in a removed asset (%s)', instance_id(asset))
             return None
 
         if not volume:
@@ -77,9 +90,9 @@ class Holding(Base):
             return None
 
         if volume < 0:
-            holdings = cls.current_holdings_for_user(session, user)
-            if holdings[asset.id] + volume < 0:
-                logger.warning('Total vol. < 0 aborting. Ass. vol. {}, delta vol {}'.format(holdings[asset.id], volume))
+            current_volume = Balance.available_for(session, user, asset, for_update=True)
+            if current_volume + volume < 0:
+                logger.warning('Total vol. < 0 aborting. Ass. vol. %s, delta vol %s', current_volume, volume)
                 return None
 
         holding = cls(user=user, asset=asset, volume=volume, source=source, description=description)
@@ -87,6 +100,17 @@ class Holding(Base):
 
     @classmethod
     def current_holdings_for_user(cls, session, user):
+        current = session.query(Balance.asset_id, Balance.volume).filter(Balance.user_id == user.id)
+
+        d = defaultdict(Decimal)
+        for asset_id, volume in current:
+            d[asset_id] = volume
+
+        return d
+
+    @classmethod
+    def ledger_holdings_for_user(cls, session, user):
+        """Sums the whole ledger of `user`; `current_holdings_for_user` reads the same numbers from `Balance`"""
         current = session.query(Holding.asset_id, func.sum(Holding.volume).label('volume_sum'))\
             .filter(Holding.user == user).group_by(Holding.asset_id)
 
@@ -98,11 +122,269 @@ class Holding(Base):
 
     @classmethod
     def users_that_hold_asset(cls, session, asset):
-        all_holdings = session.query(Holding.user_id, func.sum(Holding.volume).label('volume_sum'))\
-            .filter(Holding.asset == asset).group_by(Holding.user_id)
+        return list(cls.iter_users_that_hold_asset(session, asset))
+
+    @classmethod
+    def iter_users_that_hold_asset(cls, session, asset, exclude_user=None, chunk_size=1000):
+        """
+        Yields `(user, volume)` for every user that has held `asset`, ordered by user id, with one joined query whose
+        rows are fetched `chunk_size` at a time.
+        """
+        holders = session.query(User, Balance.volume)\
+            .join(Balance, Balance.user_id == User.id)\
+            .filter(Balance.asset == asset)\
+            .order_by(User.id)
+
+        if exclude_user is not None:
+            holders = holders.filter(User.id != exclude_user.id)
+
+        for user, volume in holders.yield_per(chunk_size):
+            yield user, volume
+
+
+class Balance(Base):
+
+    """
+    The running sum of all `Holding`s of a user in an asset, kept up to date with every `Holding` that is added, and
+    how much of it open orders have reserved. Only `volume` - `reserved` is available.
+    """
+
+    __tablename__ = 'balances'
+    __table_args__ = (Index('ix_balances_asset', 'asset_id'),)
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    asset_id = Column(Integer, ForeignKey('assets.id'), primary_key=True)
+    volume = Column(Numeric(precision=10, scale=4), default=Decimal('0'), nullable=False)
+    # The sum of the `Reservation`s of the user's open orders in this asset
+    reserved = Column(Numeric(precision=10, scale=4), default=Decimal('0'), nullable=False)
+
+    user = relationship('User')
+    asset = relationship('Asset')
+
+    @classmethod
+    def get(cls, session, user, asset, for_update=False):
+        """
+        The balance of `user` in `asset`, or None. With `for_update`, the row is locked until the end of the transaction
+        (`SELECT ... FOR UPDATE`), so that concurrent transactions changing the same balance wait for each other.
+        """
+        # Users and assets that are not flushed yet have no id to look the balance up with
+        key = (instance_id(user), instance_id(asset))
+        if None in key:
+            session.flush()
+            key = (user.id, asset.id)
+        if None in key:
+            return None
+
+        return cls._get(session, key, for_update)
+
+    @classmethod
+    def _get(cls, session, key, for_update=False):
+        if for_update:
+            cls.lock(session, [key])
+            balance = session.info['locked_balances'][key]
+            if balance is not None:
+                return balance
+        return session.query(cls).get(key)
+
+    @classmethod
+    def lock(cls, session, keys):
+        """
+        Locks the balances of the `(user_id, asset_id)` pairs in `keys` until the end of the transaction and reloads
+        them. Rows are locked in key order, so that two transactions locking the same balances do not deadlock.
+        """
+        # The session only holds on to clean objects weakly; keep the locked balances around for as long as the locks
+        locked = session.info.setdefault('locked_balances', {})
+        keys = sorted(set(keys) - set(locked))
+        if not keys:
+            return
+
+        # Reloading is safe, changes that have not been flushed yet are flushed before the query
+        balances = session.query(cls)\
+            .filter(or_(*(and_(cls.user_id == user_id, cls.asset_id == asset_id) for user_id, asset_id in keys)))\
+            .order_by(cls.user_id, cls.asset_id)\
+            .with_for_update()\
+            .populate_existing()\
+            .all()
+        locked.update(dict.fromkeys(keys))
+        locked.update(((balance.user_id, balance.asset_id), balance) for balance in balances)
+
+    @classmethod
+    def volume_for(cls, session, user, asset, for_update=False):
+        balance = cls.get(session, user, asset, for_update)
+        return balance.volume if balance is not None else Decimal('0')
+
+    @classmethod
+    def available_for(cls, session, user, asset, for_update=False):
+        balance = cls.get(session, user, asset, for_update)
+        return balance.volume - balance.reserved if balance is not None else Decimal('0')
+
+    @classmethod
+    def hold(cls, session, user_id, asset_id, volume):
+        """
+        Reserves `volume` of a balance if that much is available. Checking and reserving is one conditional UPDATE,
+        which also locks the row until the end of the transaction. Returns whether it was reserved.
+        """
+        held = session.query(cls)\
+            .filter(cls.user_id == user_id, cls.asset_id == asset_id, cls.volume - cls.reserved >= volume)\
+            .update({cls.reserved: cls.reserved + volume}, synchronize_session=False)
+        if not held:
+            return False
+
+        # The row is locked now; a balance loaded before reloads on its next use
+        key = (user_id, asset_id)
+        balance = session.identity_map.get(identity_key(cls, key))
+        if balance is not None:
+            session.expire(balance)
+        session.info.setdefault('locked_balances', {})[key] = balance
+        return True
+
+    @classmethod
+    def release(cls, session, user_id, asset_id, volume):
+        """Makes `volume` that `hold` reserved available again"""
+        balance = cls._get(session, (user_id, asset_id), for_update=True)
+        balance.reserved -= volume
+        return balance
+
+    @classmethod
+    def record_holding(cls, session, holding):
+        """Must be called for every `Holding` that is added, in the same transaction"""
+        balance = cls.get(session, holding.user, holding.asset, for_update=True)
+        if balance is None:
+            balance = cls(user_id=instance_id(holding.user), asset_id=instance_id(holding.asset), volume=Decimal('0'),
+                          reserved=Decimal('0'))
+            session.add(balance)
+            session.info['locked_balances'][(balance.user_id, balance.asset_id)] = balance
+        balance.volume += holding.volume
+        return balance
+
+    @classmethod
+    def record_holdings_where(cls, session, *criteria):
+        """
+        Set-based version of `record_holding` for `Holding`s that were inserted with plain SQL. `criteria` must select
+        exactly the new rows of the `holdings` table.
+        """
+        holdings, balances = Holding.__table__, cls.__table__
+        new_holdings = select([holdings.c.user_id, holdings.c.asset_id])\
+            .where(and_(*criteria)).group_by(holdings.c.user_id, holdings.c.asset_id).alias('new_holdings')
+        missing = select([new_holdings.c.user_id, new_holdings.c.asset_id, literal(0)])\
+            .where(~exists().where(and_(balances.c.user_id == new_holdings.c.user_id,
+                                        balances.c.asset_id == new_holdings.c.asset_id)))
+        session.execute(balances.insert().from_select(['user_id', 'asset_id', 'volume'], missing))
+
+        matching = and_(holdings.c.user_id == balances.c.user_id, holdings.c.asset_id == balances.c.asset_id, *criteria)
+        delta = select([func.sum(holdings.c.volume)]).where(matching).as_scalar()
+        session.execute(balances.update().where(exists().where(matching)).values(volume=balances.c.volume + delta))
+
+        # Balances loaded in this session do not know about the statements above
+        for instance in list(session.identity_map.values()):
+            if isinstance(instance, cls):
+                session.expire(instance)
+
+    @classmethod
+    def verify(cls, session):
+        """Returns `(user_id, asset_id, ledger_volume, balance_volume)` for each balance that differs from the ledger"""
+        ledger = session.query(Holding.user_id, Holding.asset_id, func.sum(Holding.volume))\
+            .group_by(Holding.user_id, Holding.asset_id)
+        ledger_volumes = dict(((user_id, asset_id), volume) for user_id, asset_id, volume in ledger)
+        balance_volumes = dict(((user_id, asset_id), volume) for user_id, asset_id, volume in
+                               session.query(cls.user_id, cls.asset_id, cls.volume))
+
+        mismatches = []
+        for user_id, asset_id in sorted(set(ledger_volumes) | set(balance_volumes)):
+            ledger_volume = ledger_volumes.get((user_id, asset_id)) or Decimal('0')
+            balance_volume = balance_volumes.get((user_id, asset_id)) or Decimal('0')
+            if ledger_volume != balance_volume:
+                mismatches.append((user_id, asset_id, ledger_volume, balance_volume))
+
+        return mismatches
+
+    @classmethod
+    def rebuild(cls, session):
+        """Recomputes the volume of every balance from the `Holding` ledger; see `Reservation.rebuild` for `reserved`"""
+        holdings, balances = Holding.__table__, cls.__table__
+        matching = and_(holdings.c.user_id == balances.c.user_id, holdings.c.asset_id == balances.c.asset_id)
+        ledger_volume = select([func.coalesce(func.sum(holdings.c.volume), 0)]).where(matching).as_scalar()
+        session.execute(balances.update().values(volume=ledger_volume))
+
+        missing = select([holdings.c.user_id, holdings.c.asset_id, func.sum(holdings.c.volume)])\
+            .where(~exists().where(matching))\
+            .group_by(holdings.c.user_id, holdings.c.asset_id)
+        session.execute(balances.insert().from_select(['user_id', 'asset_id', 'volume'], missing))
+        session.expire_all()
+        logger.info('Rebuilt balances from the holdings ledger')
+
+
+class ArchivedHolding(Base):
+
+    """A `Holding` that `compact_holdings` has replaced with a snapshot; kept for the audit trail"""
+
+    __tablename__ = 'holdings_archive'
+    __table_args__ = (Index('ix_holdings_archive_user_asset', 'user_id', 'asset_id'),)
+
+    # The id the holding had in `holdings`; two compactions can never archive the same holding
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    asset_id = Column(Integer, ForeignKey('assets.id'))
+    volume = Column(Numeric(precision=10, scale=4))
+    source = Column(Holding.__table__.c.source.type)
+    description = Column(String(250))
+    created_at = Column(DateTime)
+    archived_at = Column(DateTime, nullable=False)
+
+
+def compact_holdings(session, before, chunk_size=1000, commit=None):
+    """
+    For every user and asset, replaces the holdings created before `before` by a single `Snapshot` holding of the same
+    total volume, and moves them to `holdings_archive`. Holdings without `created_at` predate it and count as old.
+    Balances are not touched, since no total changes. Users are compacted `chunk_size` at a time, each chunk in one
+    transaction; trades only ever add new holdings, so they can go on meanwhile. Returns how many were archived.
+    """
+    holdings, archive = Holding.__table__, ArchivedHolding.__table__
+    old = or_(holdings.c.created_at < before, holdings.c.created_at.is_(None))
+    columns = ['id', 'user_id', 'asset_id', 'volume', 'source', 'description', 'created_at']
+
+    archived, last_user_id = 0, None
+    while True:
+        user_ids = select([holdings.c.user_id]).where(old).distinct().order_by(holdings.c.user_id).limit(chunk_size)
+        if last_user_id is not None:
+            user_ids = user_ids.where(holdings.c.user_id > last_user_id)
+        user_ids = [user_id for user_id, in session.execute(user_ids)]
+        if not user_ids:
+            break
+
+        # The archive is filled first; the rows that made it there are the ones that are deleted and summed up
+        now = datetime.now()
+        in_chunk = and_(archive.c.archived_at == now, archive.c.user_id.between(user_ids[0], user_ids[-1]))
+        moved = session.execute(archive.insert().from_select(
+            columns + ['archived_at'],
+            select([holdings.c[column] for column in columns] + [literal(now, archive.c.archived_at.type)])
+            .where(old).where(holdings.c.user_id.between(user_ids[0], user_ids[-1]))))
+        session.execute(holdings.delete().where(holdings.c.id.in_(select([archive.c.id]).where(in_chunk))))
+
+        total = func.sum(archive.c.volume)
+        snapshots = select([archive.c.user_id, archive.c.asset_id, total, literal('Snapshot'),
+                            literal('Snapshot of holdings before {}'.format(before.isoformat(' '))),
+                            literal(before, holdings.c.created_at.type)])\
+            .where(in_chunk)\
+            .group_by(archive.c.user_id, archive.c.asset_id)\
+            .having(total != 0)
+        session.execute(holdings.insert().from_select(
+            ['user_id', 'asset_id', 'volume', 'source', 'description', 'created_at'], snapshots))
+
+        commit_or_flush(session, commit)
+        archived += moved.rowcount
+        last_user_id = user_ids[-1]
+
+    logger.info('Compacted %s holdings from before %s', archived, before)
+    return archived
+
+
+@event.listens_for(Session, 'after_commit')
+def _balances_unlocked(session):
+    session.info.pop('locked_balances', None)
 
-        ret = []
-        for user_id, volume_sum in all_holdings:
-            ret.append((session.query(User).get(user_id), volume_sum))
 
-        return ret
+@event.listens_for(Session, 'after_soft_rollback')
+def _balances_rolled_back(session, previous_transaction):
+    # Rolling back to a savepoint releases the locks taken since; forget them all and lock again when needed
+    session.info.pop('locked_balances', None)
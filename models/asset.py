@@ -1,7 +1,19 @@
+"""
+Assets, and a registry of them shared by every session in the process.
+
+Assets are added now and then and removed even less often, so the registry keeps what there is to know about them in
+memory, by id and by name. `get_asset` and `find_asset` read from it and only go to the database for an asset they do
+not know yet. Changes made through `Asset.remove` are picked up when the session commits. Other processes can add and
+remove assets too; calling `refresh_assets` now and then reloads the registry when anything changed.
+"""
+
 import logging
+import threading
+from collections import namedtuple
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, event, func, inspect
+from sqlalchemy.orm import Session
 
 from models import Base
 
@@ -9,6 +21,10 @@ from models import Base
 logger = logging.getLogger(__file__)
 
 
+def normalize_name(name):
+    return name.strip().upper()
+
+
 class Asset(Base):
 
     __tablename__ = 'assets'
@@ -23,15 +39,178 @@ class Asset(Base):
     @classmethod
     def create_asset(cls, name):
         if name is not None:
-            asset = cls(name=name.strip().upper())
+            asset = cls(name=normalize_name(name))
             return asset
 
     def remove(self, session):
         self.name, self.previous_name = None, self.name
         self.removed_at = datetime.now()
         session.add(self)
+        _changed_assets(session).add(self)
         logger.info('Added Asset instance {} for removal'.format(self.id))
 
     @property
     def removed(self):
         return self.removed_at is not None
+
+
+class AssetInfo(namedtuple('AssetInfo', ['id', 'name', 'previous_name', 'removed_at'])):
+
+    """What the registry knows about an `Asset`, detached from any session"""
+
+    __slots__ = ()
+
+    @property
+    def removed(self):
+        return self.removed_at is not None
+
+
+_COLUMNS = (Asset.id, Asset.name, Asset.previous_name, Asset.removed_at)
+
+_by_id = {}
+_by_name = {}
+_version = None
+_lock = threading.RLock()
+
+
+def _remember(info):
+    with _lock:
+        _forget(info.id)
+        _by_id[info.id] = info
+        if info.name is not None:
+            _by_name[info.name] = info
+
+
+def _forget(asset_id):
+    with _lock:
+        info = _by_id.pop(asset_id, None)
+        if info is not None and _by_name.get(info.name) is info:
+            del _by_name[info.name]
+
+
+def clear_assets():
+    global _version
+    with _lock:
+        _by_id.clear()
+        _by_name.clear()
+        _version = None
+
+
+def _changed_assets(session):
+    """Assets added or removed in the current transaction of `session`; the registry learns about them when it ends"""
+    return session.info.setdefault('changed_assets', set())
+
+
+def _uncommitted(session, asset_id=None, name=None):
+    for asset in session.info.get('changed_assets', ()):
+        identity = inspect(asset).identity
+        if (identity is not None and identity[0] == asset_id) or (name is not None and asset.name == name):
+            return asset
+    return None
+
+
+def _info(asset):
+    return AssetInfo(asset.id, asset.name, asset.previous_name, asset.removed_at)
+
+
+def _load(session, criterion):
+    row = session.query(*_COLUMNS).filter(criterion).first()
+    if row is None:
+        return None
+    info = AssetInfo(*row)
+    if _uncommitted(session, asset_id=info.id) is None:
+        _remember(info)
+    return info
+
+
+def get_asset(session, asset_id):
+    """The `AssetInfo` of the asset with id `asset_id`, or None if there is none"""
+    if session.info.get('changed_assets'):
+        asset = _uncommitted(session, asset_id=asset_id)
+        if asset is not None:
+            return _info(asset)
+
+    info = _by_id.get(asset_id)
+    return info if info is not None else _load(session, Asset.id == asset_id)
+
+
+def find_asset(session, name):
+    """The `AssetInfo` of the asset called `name`, normalized the way `Asset.create_asset` does, or None"""
+    name = normalize_name(name)
+    changed = session.info.get('changed_assets')
+    if changed:
+        asset = _uncommitted(session, name=name)
+        if asset is not None:
+            return _info(asset)
+
+    info = _by_name.get(name)
+    if info is None:
+        info = _load(session, Asset.name == name)
+    # Unless it was renamed or removed in this transaction
+    if info is not None and changed and _uncommitted(session, asset_id=info.id) is not None:
+        return None
+    return info
+
+
+def asset_removed(session, asset):
+    """Whether `asset` has been removed, from the registry unless the instance itself is loaded"""
+    state = inspect(asset)
+    if state.identity is None or 'removed_at' not in state.unloaded:
+        return asset.removed
+    info = get_asset(session, state.identity[0])
+    return info is None or info.removed
+
+
+def _registry_version(session):
+    # Changes whenever an asset is added or removed
+    return tuple(session.query(func.count(Asset.id), func.max(Asset.id), func.max(Asset.removed_at)).one())
+
+
+def load_assets(session):
+    """Loads every asset into the registry, replacing what it had; returns how many there are"""
+    global _version
+    version = _registry_version(session)
+    rows = session.query(*_COLUMNS).all()
+    with _lock:
+        clear_assets()
+        for row in rows:
+            _remember(AssetInfo(*row))
+        _version = version
+
+    logger.info('Loaded %s assets into the registry', len(rows))
+    return len(rows)
+
+
+def refresh_assets(session):
+    """Reloads the registry when assets were added or removed since it was last loaded; returns whether it was"""
+    if _registry_version(session) == _version:
+        return False
+    load_assets(session)
+    return True
+
+
+@event.listens_for(Session, 'after_flush')
+def _assets_flushed(session, flush_context):
+    new_assets = [instance for instance in session.new if isinstance(instance, Asset)]
+    if new_assets:
+        _changed_assets(session).update(new_assets)
+
+
+def _transaction_ended(session):
+    for asset in session.info.pop('changed_assets', ()):
+        identity = inspect(asset).identity
+        if identity is not None:
+            _forget(identity[0])
+
+
+@event.listens_for(Session, 'after_commit')
+def _assets_committed(session):
+    # What a savepoint changed is only final when the transaction around it commits
+    if not session.transaction.nested:
+        _transaction_ended(session)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _assets_rolled_back(session, previous_transaction):
+    if not previous_transaction.nested:
+        _transaction_ended(session)
@@ -0,0 +1,103 @@
+"""
+Counting the SQL statements, rows and database time of an operation.
+
+    with query_budget('put_order') as budget:
+        put_order(session, order)
+    logger.info('%s', budget)  # <QueryBudget put_order: 12 statements, 3 rows, 4.1 ms>
+
+Budgets belong to the thread that opens them and they nest: a statement counts towards every budget that is open in its
+thread. Totals per operation name are added to the `btcex_sql_*` counters in `models.metrics` as well. A budget that
+is given `max_statements` logs a warning when it goes over; tests use `DatabaseTestCase.assertQueryBudget` to fail
+instead.
+
+Rows are what the database driver reports as the row count of a statement: the rows an INSERT, UPDATE or DELETE
+changed, and for a SELECT only on drivers that know it up front, such as psycopg2.
+"""
+
+import logging
+import threading
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models.metrics import counter
+
+
+logger = logging.getLogger(__file__)
+
+SQL_STATEMENTS = counter('btcex_sql_statements_total', 'SQL statements executed, by operation', ['operation'])
+SQL_ROWS = counter('btcex_sql_rows_total', 'Rows reported by SQL statements, by operation', ['operation'])
+SQL_SECONDS = counter('btcex_sql_seconds_total', 'Time spent executing SQL statements, by operation', ['operation'])
+
+_local = threading.local()
+
+
+def _open_budgets():
+    budgets = getattr(_local, 'budgets', None)
+    if budgets is None:
+        budgets = _local.budgets = []
+    return budgets
+
+
+class QueryBudget(object):
+
+    def __init__(self, name, max_statements=None):
+        self.name = name
+        self.max_statements = max_statements
+        self.statements = 0
+        self.rows = 0
+        self.seconds = 0.0
+        # The SQL of every statement, in the order they were executed
+        self.executed = []
+
+    def __repr__(self):
+        return '<QueryBudget {}: {} statements, {} rows, {:.1f} ms>'.format(self.name, self.statements, self.rows,
+                                                                           self.seconds * 1000)
+
+    def __enter__(self):
+        _open_budgets().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _open_budgets().remove(self)
+        SQL_STATEMENTS.labels(self.name).inc(self.statements)
+        SQL_ROWS.labels(self.name).inc(self.rows)
+        SQL_SECONDS.labels(self.name).inc(self.seconds)
+        if self.exceeded():
+            logger.warning('%s went over its budget of %s statements', self, self.max_statements)
+
+    def exceeded(self):
+        return self.max_statements is not None and self.statements > self.max_statements
+
+    def report(self):
+        """The totals followed by every statement that was executed, one per line"""
+        return '\n'.join([repr(self)] + ['{:>4}. {}'.format(index, ' '.join(statement.split()))
+                                         for index, statement in enumerate(self.executed, 1)])
+
+
+def query_budget(name, max_statements=None):
+    """Counts the statements, rows and database time of the block in the returned `QueryBudget`"""
+    return QueryBudget(name, max_statements)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _statement_started(connection, cursor, statement, parameters, context, executemany):
+    if context is not None and getattr(_local, 'budgets', None):
+        context.budget_started = perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _statement_finished(connection, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'budget_started', None)
+    budgets = getattr(_local, 'budgets', None)
+    if started is None or not budgets:
+        return
+
+    seconds = perf_counter() - started
+    rows = max(cursor.rowcount, 0)
+    for budget in budgets:
+        budget.statements += 1
+        budget.rows += rows
+        budget.seconds += seconds
+        budget.executed.append(statement)
@@ -0,0 +1,157 @@
+"""
+OHLCV candles per contract, at each of `CANDLE_INTERVALS`.
+
+Candles are kept up to date with every `Transaction` as it is filled, in the same database transaction, the way
+`Balance` is kept up to date with every `Holding`. History from before that is filled in with `backfill_candles`, which
+walks back from the oldest transaction the candles of a contract have counted. It can be interrupted and run again, and
+it does not get in the way of trading.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, Numeric
+from sqlalchemy.sql import and_, or_, func
+
+from models import Base, commit_or_flush
+from models.consts import CANDLE_INTERVALS, PRICE_QUANTUM
+from models.order import Transaction
+
+
+logger = logging.getLogger(__file__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(timestamp, interval):
+    """Start of the candle of `interval` seconds that `timestamp` falls in"""
+    step = timedelta(seconds=interval)
+    return EPOCH + (timestamp - EPOCH) // step * step
+
+
+class Candle(Base):
+
+    __tablename__ = 'candles'
+
+    contract_id = Column(Integer, ForeignKey('contracts.id'), primary_key=True)
+    # Length of the candle in seconds
+    interval = Column(Integer, primary_key=True)
+    opened_at = Column(DateTime, primary_key=True)
+
+    # Unit prices (`price` / `volume` of the transactions)
+    open = Column(Numeric(precision=19, scale=8), nullable=False)
+    high = Column(Numeric(precision=19, scale=8), nullable=False)
+    low = Column(Numeric(precision=19, scale=8), nullable=False)
+    close = Column(Numeric(precision=19, scale=8), nullable=False)
+    volume = Column(Numeric(precision=19, scale=4), nullable=False)
+    trades = Column(Integer, nullable=False)
+
+    # The transactions with the lowest and highest id in this candle, which set `open` and `close`
+    first_transaction_id = Column(Integer, nullable=False)
+    last_transaction_id = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<Candle {} {}s @ {}>".format(self.contract_id, self.interval, self.opened_at)
+
+    def add(self, transaction_id, unit_price, volume):
+        """Counts one transaction in this candle"""
+        if self.trades is None:
+            self.open = self.high = self.low = self.close = unit_price
+            self.volume, self.trades = volume, 1
+            self.first_transaction_id = self.last_transaction_id = transaction_id
+            return
+
+        if transaction_id < self.first_transaction_id:
+            self.open, self.first_transaction_id = unit_price, transaction_id
+        if transaction_id > self.last_transaction_id:
+            self.close, self.last_transaction_id = unit_price, transaction_id
+        self.high, self.low = max(self.high, unit_price), min(self.low, unit_price)
+        self.volume += volume
+        self.trades += 1
+
+    @classmethod
+    def load(cls, session, contract_id, ranges, for_update=False):
+        """
+        The candles of `contract_id` that start within `ranges`, a `{interval: (first_start, last_start)}` dict, keyed
+        by `(interval, opened_at)`
+        """
+        query = session.query(cls)\
+            .filter(cls.contract_id == contract_id)\
+            .filter(or_(*(and_(cls.interval == interval, cls.opened_at.between(first, last))
+                          for interval, (first, last) in sorted(ranges.items()))))\
+            .order_by(cls.interval, cls.opened_at)
+        if for_update:
+            query = query.with_for_update()
+        return dict(((candle.interval, candle.opened_at), candle) for candle in query)
+
+    @classmethod
+    def add_transaction(cls, session, candles, contract_id, transaction_id, executed_at, price, volume):
+        """Counts a transaction in its candles, taken from or added to `candles` (see `load`)"""
+        unit_price = (price / volume).quantize(PRICE_QUANTUM)
+        for interval in CANDLE_INTERVALS:
+            key = (interval, bucket_start(executed_at, interval))
+            candle = candles.get(key)
+            if candle is None:
+                candle = candles[key] = cls(contract_id=contract_id, interval=interval, opened_at=key[1])
+                session.add(candle)
+            candle.add(transaction_id, unit_price, volume)
+
+    @classmethod
+    def record_transaction(cls, session, transaction):
+        """Must be called for every `Transaction` that is executed, in the same database transaction"""
+        if transaction.id is None:
+            session.flush()
+
+        contract_id = transaction.contract.id
+        starts = dict((interval, bucket_start(transaction.executed_at, interval)) for interval in CANDLE_INTERVALS)
+        candles = cls.load(session, contract_id, dict((interval, (start, start)) for interval, start in starts.items()),
+                           for_update=True)
+        cls.add_transaction(session, candles, contract_id, transaction.id, transaction.executed_at, transaction.price,
+                            transaction.volume)
+
+    @classmethod
+    def for_contract(cls, session, contract, interval, since=None, until=None):
+        """Candles of one contract and interval, oldest first"""
+        query = session.query(cls).filter(cls.contract_id == contract.id).filter(cls.interval == interval)
+        if since is not None:
+            query = query.filter(cls.opened_at >= bucket_start(since, interval))
+        if until is not None:
+            query = query.filter(cls.opened_at <= until)
+        return query.order_by(cls.opened_at)
+
+
+def backfill_candles(session, contract, chunk_size=1000, commit=None):
+    """
+    Counts the executed transactions of `contract` that are older than any of its candles have counted, newest first and
+    `chunk_size` at a time. Every chunk is committed on its own. Returns how many transactions were counted.
+    """
+    oldest_counted = session.query(func.min(Candle.first_transaction_id))\
+        .filter(Candle.contract_id == contract.id)\
+        .filter(Candle.interval == CANDLE_INTERVALS[0])\
+        .scalar()
+
+    counted = 0
+    while True:
+        chunk = session.query(Transaction.id, Transaction.executed_at, Transaction.price, Transaction.volume)\
+            .filter(Transaction.contract_id == contract.id)\
+            .filter(Transaction.executed_at.isnot(None))
+        if oldest_counted is not None:
+            chunk = chunk.filter(Transaction.id < oldest_counted)
+        chunk = chunk.order_by(Transaction.id.desc()).limit(chunk_size).all()
+        if not chunk:
+            break
+
+        first_executed_at = min(executed_at for _, executed_at, _, _ in chunk)
+        last_executed_at = max(executed_at for _, executed_at, _, _ in chunk)
+        candles = Candle.load(session, contract.id, dict(
+            (interval, (bucket_start(first_executed_at, interval), last_executed_at)) for interval in CANDLE_INTERVALS),
+            for_update=True)
+        for transaction_id, executed_at, price, volume in chunk:
+            Candle.add_transaction(session, candles, contract.id, transaction_id, executed_at, price, volume)
+
+        commit_or_flush(session, commit)
+        counted += len(chunk)
+        oldest_counted = chunk[-1][0]
+
+    logger.info('Backfilled %s transaction(s) of contract %s into candles', counted, contract.id)
+    return counted
@@ -1,4 +1,15 @@
 import enum
+from decimal import Decimal
+
+
+# Smallest representable steps of the `Numeric` columns for prices (scale 8) and volumes (scale 4)
+PRICE_SCALE = 8
+VOLUME_SCALE = 4
+PRICE_QUANTUM = Decimal('0.00000001')
+VOLUME_QUANTUM = Decimal('0.0001')
+
+# Lengths in seconds of the candles kept per contract: a second, a minute, an hour and a day
+CANDLE_INTERVALS = (1, 60, 3600, 86400)
 
 
 class OrderType(enum.Enum):
@@ -3,17 +3,23 @@ from datetime import datetime
 
 from sqlalchemy import Column, Integer, ForeignKey, DateTime, Enum, Numeric, Boolean
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy.sql import exists, and_
+from sqlalchemy.sql import exists, and_, select, func, case, literal
 
-from models import Base
+from models import Base, commit_or_flush
 from models.asset import Asset
-from models.account import Holding
+from models.account import Holding, Balance
 from models.order import Order
 from models.consts import OrderStateType
+from models.metrics import counter, histogram, timed
+from models.sql import truncate
 
 
 logger = logging.getLogger(__file__)
 
+EXPIRE_SECONDS = histogram('btcex_contract_expire_seconds', 'Time spent in FuturesContract.expire', buckets=(
+    0.001, 0.01, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+CONTRACTS_SETTLED = counter('btcex_contracts_settled_total', 'Futures contracts settled at expiry')
+
 
 class Contract(Base):
 
@@ -74,9 +80,13 @@ class FuturesContract(Contract):
     def can_be_used_in_order(self):
         return not self.cancelled and not self.expired and datetime.now() <= self.expires_at
 
-    def cancel(self, session):
-        users_and_holdings = Holding.users_that_hold_asset(session, self.contract_asset)
-        if any(user for user, volume_sum in users_and_holdings if user is not self.issuer):
+    def cancel(self, session, commit=None):
+        # We only need to know whether there is one other holder
+        other_holders = Holding.iter_users_that_hold_asset(session, self.contract_asset, exclude_user=self.issuer,
+                                                           chunk_size=1)
+        has_other_holders = next(other_holders, None) is not None
+        other_holders.close()
+        if has_other_holders:
             logger.info('Cannot cancel futures contract {} if other people hold it'.format(self.id))
             return False
 
@@ -112,22 +122,69 @@ class FuturesContract(Contract):
             self.cancelled = True
             session.add(self)
 
-        session.commit()
+        commit_or_flush(session, commit)
         logger.info('Cancelled contract {}'.format(self.id))
         return True
 
-    def expire(self, session):
+    @timed(EXPIRE_SECONDS)
+    def expire(self, session, commit=None):
         if self.expired:
             return
 
-        users_and_holdings = Holding.users_that_hold_asset(session, self.contract_asset)
+        self.settle(session)
+        commit_or_flush(session, commit)
+
+    def settle(self, session):
+        """
+        Distributes `volume` of `asset` among the holders of this contract, pro rata to the volume they hold, and marks
+        the contract as expired. The payouts are written with a single INSERT ... SELECT. Shares are truncated to the
+        scale of `Holding.volume`; whatever that leaves over goes to the largest holder (lowest user id on ties).
+        """
+        if self.expired:
+            return
 
-        # We may assume that all holdings are strictly positive
-        total_volume = sum(volume_sum for _, volume_sum in users_and_holdings)
-        for user, volume_sum in users_and_holdings:
-            user.increase_volume_of_asset(session, self.asset, volume_sum / total_volume * self.volume)
-            logger.info('Distributed {} of asset {} to user {}'.format(volume_sum, self.asset_id, user.id))
+        # Our own statements below do not trigger an autoflush
+        session.flush()
+
+        holdings = Holding.__table__
+        description = 'Expiry of contract {}'.format(self.id)
+        holders = select([holdings.c.user_id, func.sum(holdings.c.volume).label('volume')])\
+            .where(holdings.c.asset_id == self.contract_asset_id)\
+            .group_by(holdings.c.user_id)\
+            .having(func.sum(holdings.c.volume) > 0)\
+            .alias('holders')
+        share = truncate(holders.c.volume * self.volume / func.sum(holders.c.volume).over(), Holding.volume.type.scale)
+        holder_rank = func.row_number().over(order_by=(holders.c.volume.desc(), holders.c.user_id))
+        shares = select([holders.c.user_id, share.label('share'), holder_rank.label('holder_rank')]).alias('shares')
+        remainder = literal(self.volume, Holding.volume.type) - func.sum(shares.c.share).over()
+        payouts = select([shares.c.user_id,
+                          literal(self.asset_id),
+                          shares.c.share + case([(shares.c.holder_rank == 1, remainder)], else_=0),
+                          literal('InternalTrade'),
+                          literal(description),
+                          literal(datetime.now(), holdings.c.created_at.type)])
+        result = session.execute(holdings.insert().from_select(
+            ['user_id', 'asset_id', 'volume', 'source', 'description', 'created_at'], payouts))
+        Balance.record_holdings_where(session, holdings.c.asset_id == self.asset_id,
+                                      holdings.c.description == description)
 
         self.expired = True
         session.add(self)
-        session.commit()
+        CONTRACTS_SETTLED.inc()
+        logger.info('Distributed %s of asset %s among %s holders of contract %s', self.volume, self.asset_id,
+                    result.rowcount, self.id)
+
+
+def expire_due_contracts(session, now=None, commit=None):
+    """Settles every futures contract that is past `expires_at` and has not expired yet, committing per contract"""
+    now = now or datetime.now()
+    due_contracts = session.query(FuturesContract)\
+        .filter(FuturesContract.expired.is_(False))\
+        .filter(FuturesContract.expires_at <= now)\
+        .order_by(FuturesContract.expires_at, FuturesContract.id)\
+        .all()
+
+    for contract in due_contracts:
+        contract.expire(session, commit)
+
+    return due_contracts
@@ -0,0 +1,229 @@
+"""
+Bulk export of the `transactions`, `orders` and `holdings` tables to gzipped CSV or, when pyarrow is installed, Parquet.
+
+Rows are read with plain Core selects, `chunk_size` at a time by keyset on `id`, so memory use does not grow with the
+size of a table and every chunk is a cheap index range scan. Each run exports the rows that were there when it
+started; rows go into numbered part files of `chunks_per_file` chunks each. A part file is only renamed into place once
+it is complete, after which `checkpoint.json` in the same directory records the last id it contains. An interrupted
+export picks up at the last checkpoint, and a later run only exports the rows that were added since.
+
+Ids are handed out when a row is inserted, not when it is committed, so a run can see a row while one with a lower id
+is still to be committed. The ids a run skips within `gap_window` of the highest one are kept in the checkpoint as
+pending and looked up again by every later run, which exports them once they are there. Every row is exported once, as
+it is at that time; orders that are still open can change, so they are held back as pending until they are executed or
+cancelled.
+
+    python manage.py export /var/exports/2016-03-04 --format parquet
+"""
+
+import csv
+import gzip
+import itertools
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import Integer, Numeric, DateTime, Boolean
+from sqlalchemy.sql import select, func
+
+from models.account import Holding
+from models.consts import OrderStateType
+from models.order import Order, Transaction
+from models.types import Interval
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+logger = logging.getLogger(__file__)
+
+TABLES = {
+    'transactions': Transaction.__table__,
+    'orders': Order.__table__,
+    'holdings': Holding.__table__,
+}
+
+FORMATS = ('csv', 'parquet')
+
+# Whether a row of the table can still change; rows that can are not exported yet
+OPEN = {
+    'orders': lambda row: row[Order.__table__.c.state] not in (OrderStateType.executed.value,
+                                                               OrderStateType.cancelled.value),
+}
+
+
+def iter_chunks(connection, table, after_id=0, until_id=None, chunk_size=10000):
+    """Yields the rows of `table` with `after_id` < id <= `until_id` in lists of at most `chunk_size`, by id"""
+    while True:
+        query = select([table]).where(table.c.id > after_id)
+        if until_id is not None:
+            query = query.where(table.c.id <= until_id)
+        chunk = connection.execute(query.order_by(table.c.id).limit(chunk_size)).fetchall()
+        if not chunk:
+            return
+        yield chunk
+        after_id = chunk[-1][table.c.id]
+
+
+def iter_pending(connection, table, pending, chunk_size=10000):
+    """Yields the rows of `table` whose id is in `pending` in lists of at most `chunk_size`, by id"""
+    pending = sorted(pending)
+    for start in range(0, len(pending), chunk_size):
+        query = select([table]).where(table.c.id.in_(pending[start:start + chunk_size])).order_by(table.c.id)
+        yield connection.execute(query).fetchall()
+
+
+class Checkpoint(object):
+
+    """The last id exported, the ids below it that are still pending and the number of part files so far, per table"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'checkpoint.json')
+        self.tables = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.tables = json.load(f)
+
+    def get(self, name):
+        return dict({'last_id': 0, 'parts': 0, 'pending': []}, **self.tables.get(name, {}))
+
+    def save(self, name, last_id, parts, pending=()):
+        self.tables[name] = {'last_id': last_id, 'parts': parts, 'pending': sorted(pending)}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.tables, f, indent=2, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, timedelta):
+        return int(value.total_seconds())
+    return str(value)
+
+
+class CsvPart(object):
+
+    extension = '.csv.gz'
+
+    def __init__(self, path, table):
+        self._file = gzip.open(path, 'wt', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([column.name for column in table.columns])
+
+    def write(self, rows):
+        self._writer.writerows([_csv_value(value) for value in row] for row in rows)
+
+    def close(self):
+        self._file.close()
+
+
+def _arrow_type(column_type):
+    if isinstance(column_type, Interval):
+        return pyarrow.duration('s')
+    if isinstance(column_type, Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, Numeric):
+        return pyarrow.decimal128(column_type.precision, column_type.scale)
+    if isinstance(column_type, DateTime):
+        return pyarrow.timestamp('us')
+    if isinstance(column_type, Boolean):
+        return pyarrow.bool_()
+    return pyarrow.string()
+
+
+class ParquetPart(object):
+
+    extension = '.parquet'
+
+    def __init__(self, path, table):
+        self._names = [column.name for column in table.columns]
+        self._schema = pyarrow.schema([(column.name, _arrow_type(column.type)) for column in table.columns])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression='zstd')
+
+    def write(self, rows):
+        # One row group per chunk
+        columns = dict((name, [row[index] for row in rows]) for index, name in enumerate(self._names))
+        self._writer.write_table(pyarrow.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def export_table(connection, name, directory, format='csv', chunk_size=10000, chunks_per_file=10, gap_window=10000):
+    """
+    Exports the rows of table `name` that were not exported to `directory` yet; returns how many were written. Ids that
+    are missing more than `gap_window` below the highest id are taken to be rolled back, and no longer looked for.
+    """
+    if format not in FORMATS:
+        raise ValueError('Unknown format {}; choose one of {}'.format(format, ', '.join(FORMATS)))
+    if format == 'parquet' and pyarrow is None:
+        raise ValueError('Exporting to Parquet needs pyarrow')
+
+    table, part_class = TABLES[name], CsvPart if format == 'csv' else ParquetPart
+    is_open = OPEN.get(name, lambda row: False)
+    os.makedirs(directory, exist_ok=True)
+    checkpoint = Checkpoint(directory)
+    state = checkpoint.get(name)
+    last_id, parts, pending = state['last_id'], state['parts'], set(state['pending'])
+
+    # Rows added while we export are left for the next run
+    until_id = connection.execute(select([func.max(table.c.id)])).scalar() or 0
+    lowest_kept = until_id - gap_window
+
+    # What is still pending from earlier runs is looked up first; ids that are still missing stay pending for a while
+    still_missing = set(pending)
+    chunks = itertools.chain(iter_pending(connection, table, pending, chunk_size),
+                             iter_chunks(connection, table, last_id, until_id, chunk_size))
+
+    exported, part, chunk_count = 0, None, 0
+    for chunk in chunks:
+        rows = []
+        for row in chunk:
+            row_id = row[table.c.id]
+            still_missing.discard(row_id)
+            if row_id > last_id:
+                # Ids this run skipped over
+                pending.update(range(max(last_id + 1, lowest_kept + 1), row_id))
+                last_id = row_id
+            if is_open(row):
+                pending.add(row_id)
+            else:
+                pending.discard(row_id)
+                rows.append(row)
+        if not rows:
+            continue
+
+        if part is None:
+            path = os.path.join(directory, '{}-{:06d}{}'.format(name, parts, part_class.extension))
+            part = part_class(path + '.tmp', table)
+        part.write(rows)
+        chunk_count += 1
+        exported += len(rows)
+
+        if chunk_count == chunks_per_file:
+            part.close()
+            os.replace(path + '.tmp', path)
+            parts += 1
+            checkpoint.save(name, last_id, parts, pending)
+            part, chunk_count = None, 0
+
+    if part is not None:
+        part.close()
+        os.replace(path + '.tmp', path)
+        parts += 1
+    checkpoint.save(name, last_id, parts, _kept(pending, still_missing, lowest_kept))
+
+    logger.info('Exported %s row(s) of %s up to id %s; %s pending', exported, name, last_id, len(pending))
+    return exported
+
+
+def _kept(pending, still_missing, lowest_kept):
+    # Open rows stay pending however old they are, missing ones only within the gap window
+    return set(row_id for row_id in pending if row_id > lowest_kept or row_id not in still_missing)
@@ -0,0 +1,26 @@
+"""
+Prices and volumes as integers, in units of `PRICE_QUANTUM` and `VOLUME_QUANTUM`.
+
+Integers are a lot cheaper to compare and add up than `Decimal`s. The matching core keeps its prices and volumes in
+these units and converts them back to `Decimal` only where they leave it.
+"""
+
+from decimal import Decimal
+
+from models.consts import PRICE_SCALE, VOLUME_SCALE
+
+
+def price_units(price):
+    return int(price.scaleb(PRICE_SCALE)) if price is not None else None
+
+
+def volume_units(volume):
+    return int(volume.scaleb(VOLUME_SCALE)) if volume is not None else None
+
+
+def price_from_units(units):
+    return Decimal(units).scaleb(-PRICE_SCALE) if units is not None else None
+
+
+def volume_from_units(units):
+    return Decimal(units).scaleb(-VOLUME_SCALE) if units is not None else None
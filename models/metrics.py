@@ -0,0 +1,325 @@
+"""
+In-process counters and latency histograms, exported in the Prometheus text format.
+
+    ORDERS_CREATED = counter('btcex_orders_created_total', 'Orders created')
+    ORDERS_CREATED.inc()
+
+    PUT_ORDER_SECONDS = histogram('btcex_put_order_seconds', 'Time spent in put_order, by stage', ['stage'])
+    PUT_ORDER_SECONDS.labels('commit').observe(0.002)
+
+Metrics are registered once per process, when the module that uses them is imported. `render()` returns all of them as
+text, `dump(path)` writes that to a file (for node_exporter's textfile collector) and `serve(port)` answers
+`GET /metrics` from a background thread, for Prometheus to scrape. Quantiles such as the p99 are estimated from the
+histogram buckets, by `histogram_quantile()` in Prometheus or by `Histogram.quantile` here.
+"""
+
+import bisect
+import logging
+import os
+import threading
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+
+logger = logging.getLogger(__file__)
+
+# Upper bounds in seconds, from 100 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _number(value):
+    return '+Inf' if value == float('inf') else repr(value)
+
+
+class _CounterValue(object):
+
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, label_names, label_values):
+        yield '{}{} {}'.format(name, _labels(label_names, label_values), _number(self.value))
+
+
+class _Timer(object):
+
+    __slots__ = ('_histogram', '_started')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(perf_counter() - self._started)
+
+
+class _HistogramValue(object):
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Observations per bucket, not cumulative; the last one is everything above the highest bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager that observes how long its block takes"""
+        return _Timer(self)
+
+    def quantile(self, q):
+        """
+        Estimates the `q` quantile (0.99 for the p99) the way Prometheus' `histogram_quantile()` does, by interpolating
+        within the bucket it falls in. None if nothing was observed.
+        """
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+
+        rank, cumulative = q * count, 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+
+    def samples(self, name, label_names, label_values):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            yield '{}_bucket{} {}'.format(name, _labels(label_names, label_values, [('le', _number(float(bound)))]),
+                                          cumulative)
+        yield '{}_sum{} {}'.format(name, _labels(label_names, label_values), _number(total))
+        yield '{}_count{} {}'.format(name, _labels(label_names, label_values), count)
+
+
+class _Metric(object):
+
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *label_values):
+        """The counter or histogram for one combination of label values, which are strings"""
+        child = self._children.get(label_values)
+        if child is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError('{} takes the labels {}'.format(self.name, ', '.join(self.label_names)))
+            with self._lock:
+                child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    def reset(self):
+        with self._lock:
+            self._children.clear()
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation.replace('\\', '\\\\').replace('\n', '\\n'))
+        yield '# TYPE {} {}'.format(self.name, self.type)
+        with self._lock:
+            children = sorted(self._children.items())
+        for label_values, child in children:
+            for sample in child.samples(self.name, self.label_names, label_values):
+                yield sample
+
+
+class Counter(_Metric):
+
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    @property
+    def value(self):
+        return self.labels().value
+
+
+class Histogram(_Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def quantile(self, q):
+        return self.labels().quantile(q)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Adds `metric`; a metric of the same name, type and labels that was registered before is returned instead"""
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None:
+                self._metrics[metric.name] = existing = metric
+            elif type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                raise ValueError('Metric {} is already registered as a different metric'.format(metric.name))
+            return existing
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def reset(self):
+        """Forgets every value observed so far, but not the metrics themselves"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return ''.join(line + '\n' for metric in metrics for line in metric.render())
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, label_names=(), registry=REGISTRY):
+    return registry.register(Counter(name, documentation, label_names))
+
+
+def histogram(name, documentation, label_names=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+    return registry.register(Histogram(name, documentation, label_names, buckets))
+
+
+def timed(metric):
+    """Decorator that observes in `metric` how long every call takes, whether it returns or raises"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metric.observe(perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class Stopwatch(object):
+
+    """Splits the time one operation takes into stages; `lap(stage)` adds the time since the previous lap to `stage`"""
+
+    __slots__ = ('laps', '_started', '_last')
+
+    def __init__(self):
+        self.laps = {}
+        self._started = self._last = perf_counter()
+
+    def lap(self, stage):
+        now = perf_counter()
+        self.laps[stage] = self.laps.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def observe(self, metric, total='total'):
+        """Observes every stage, and the time up to the last lap as `total`, in `metric` labelled by stage"""
+        for stage, seconds in self.laps.items():
+            metric.labels(stage).observe(seconds)
+        metric.labels(total).observe(self._last - self._started)
+
+
+def render(registry=REGISTRY):
+    """Every metric in the Prometheus text format"""
+    return registry.render()
+
+
+def dump(path, registry=REGISTRY):
+    """Writes `render()` to `path`, replacing it in one go"""
+    with open(path + '.tmp', 'w') as f:
+        f.write(registry.render())
+    os.replace(path + '.tmp', path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """Serves `GET /metrics` on `host`:`port` from a daemon thread; returns the server, to `shutdown()` it"""
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logger.info('Serving metrics on http://%s:%s/metrics', host, server.server_address[1])
+    return server
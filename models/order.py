@@ -5,21 +5,39 @@ A `limit order` is an order with a specified price and volume.
 
 import logging
 from datetime import datetime
+from decimal import Decimal, ROUND_DOWN
 
-from sqlalchemy import Column, Integer, Enum, DateTime, ForeignKey, Numeric, Interval, UniqueConstraint
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, Enum, DateTime, ForeignKey, Numeric, UniqueConstraint, Index, text
+from sqlalchemy.sql import select, func, and_
+from sqlalchemy.orm import relationship, backref, validates
 
-from models import Base
-from models.account import User
-from models.consts import DirectionType, OrderStateType
+from models import Base, commit_or_flush, instance_id
+from models.account import User, Balance, Holding
+from models.asset import asset_removed, get_asset
+from models.types import Interval
+from models.consts import DirectionType, OrderStateType, PRICE_QUANTUM, VOLUME_QUANTUM
+from models.metrics import counter, histogram, timed
 
 
 logger = logging.getLogger(__file__)
 
+CREATE_ORDER_SECONDS = histogram('btcex_create_order_seconds', 'Time spent in Order.create_order')
+ORDERS_CREATED = counter('btcex_orders_created_total', 'Orders created')
+ORDERS_REJECTED = counter('btcex_orders_rejected_total', 'Orders that could not be created, by reason', ['reason'])
+EXECUTE_TRADE_SECONDS = histogram('btcex_execute_trade_seconds', 'Time spent in Transaction.execute_trade')
+
 
 class Order(Base):
 
     __tablename__ = 'orders'
+    __table_args__ = (Index('ix_orders_contract_state', 'contract_id', 'state'),
+                      # Only orders in the market are ever looked up by price
+                      Index('ix_orders_in_market', 'contract_id', 'direction', 'unit_price', 'id',
+                            postgresql_where=text("state = 'InMarket'"), sqlite_where=text("state = 'InMarket'")),
+                      # The expiry scheduler looks for the next deadlines among orders that can still expire
+                      Index('ix_orders_expires_at', 'expires_at',
+                            postgresql_where=text("expires_at IS NOT NULL AND state IN ('Created', 'InMarket')"),
+                            sqlite_where=text("expires_at IS NOT NULL AND state IN ('Created', 'InMarket')")))
 
     # Boilerplate information
     id = Column(Integer, primary_key=True)
@@ -34,13 +52,21 @@ class Order(Base):
     volume = Column(Numeric(precision=10, scale=4))
     contract_id = Column(Integer, ForeignKey('contracts.id'))
 
+    # `price` / `volume`, stored so that it can be compared and indexed
+    unit_price = Column(Numeric(precision=19, scale=8), nullable=True)
+
+    # How much of `volume` has been matched so far; an order can be filled by several `Transaction`s
+    filled_volume = Column(Numeric(precision=10, scale=4), default=Decimal('0'), nullable=False)
+
     # Order specific information
     expires_in = Column(Interval, nullable=True)
+    # `created_at` + `expires_in`, kept up to date when `expires_in` is set
+    expires_at = Column(DateTime, nullable=True)
     direction = Column(Enum('Bid', 'Ask', name='order_directions'))
     order_type = Column(Enum('MarketOrder', 'LimitOrder', name='order_types'))
     state = Column(Enum('Created', 'InMarket', 'Executed', 'Cancelled', name='order_states'))
 
-    # If the order was matched with another order, this is when that happened
+    # If the order was completely filled, this is when that happened
     executed_at = Column(DateTime)
 
     user = relationship(User, backref=backref('orders', order_by=id))
@@ -50,55 +76,122 @@ class Order(Base):
     def __repr__(self):
         return "<Order {}>".format(self.id)
 
+    @validates('expires_in')
+    def _set_expires_at(self, key, expires_in):
+        self.expires_at = (self.created_at or datetime.now()) + expires_in if expires_in is not None else None
+        return expires_in
+
     @classmethod
-    def create_order(cls, session, user, price, price_asset, contract, contract_volume, is_bid, order_type):
-        if price_asset.removed or contract.contract_asset.removed:
-            logger.error('Cannot create order with removed asset {}, {}'.format(price_asset.id,
-                                                                                contract.contract_asset_id))
+    @timed(CREATE_ORDER_SECONDS)
+    def create_order(cls, session, user, price, price_asset, contract, contract_volume, is_bid, order_type,
+                     expires_in=None, commit=None):
+        """
+        Creates an order and reserves its funds. The reservation locks the user's balance until the transaction ends,
+        so it is committed right away: otherwise that lock would still be held when `put_order` locks the balances of
+        a trade in key order, and two users crossing each other's orders could deadlock. Callers that create and match
+        orders in one unit of work keep the lock, and should not match orders of different users concurrently.
+        """
+        if asset_removed(session, price_asset) or get_asset(session, contract.contract_asset_id).removed:
+            logger.error('Cannot create order with removed asset %s, %s', price_asset.id, contract.contract_asset_id)
+            ORDERS_REJECTED.labels('removed_asset').inc()
             return None
 
         if not contract.can_be_used_in_order():
-            logger.error('Tried to use an inactive contract ({}) in an order'.format(contract.id))
+            logger.error('Tried to use an inactive contract (%s) in an order', contract.id)
+            ORDERS_REJECTED.labels('inactive_contract').inc()
+            return None
+
+        # The bid side reserves its price, the ask side the volume of the contract it sells (see `reserved_for`)
+        if is_bid:
+            asset_id, reserved = instance_id(price_asset), price.quantize(VOLUME_QUANTUM, rounding=ROUND_DOWN)
+        else:
+            asset_id, reserved = contract.contract_asset_id, contract_volume
+        reservation = Reservation.place(session, user, asset_id, reserved)
+        if reservation is None:
+            logger.info('Insufficient funds for user %s', user.id)
+            ORDERS_REJECTED.labels('insufficient_funds').inc()
             return None
 
         direction = DirectionType.bid.value if is_bid else DirectionType.ask.value
         order = cls(user=user, price=price, asset=price_asset, contract=contract, volume=contract_volume,
+                    unit_price=cls.compute_unit_price(price, contract_volume), filled_volume=Decimal('0'),
                     direction=direction, order_type=order_type, state='Created', created_at=datetime.now())
+        order.expires_in = expires_in
+        reservation.order = order
 
-        if not is_bid and user.volume_of_asset(session, contract.contract_asset) >= contract_volume:
-            user.decrease_volume_of_asset(session, contract.contract_asset, contract_volume)
-        elif is_bid and user.volume_of_asset(session, price_asset) >= price:
-            user.decrease_volume_of_asset(session, price_asset, price)
-        else:
-            logger.info('Insufficient funds for user {}'.format(user.id))
-            return None
-
-        session.add(order)
+        session.add_all([order, reservation])
+        commit_or_flush(session, commit)
+        ORDERS_CREATED.inc()
         return order
 
     def executed(self):
-        return bool(self.executed_bid or self.executed_ask)
+        return self.state == OrderStateType.executed.value
+
+    def has_expired(self, now=None):
+        return self.expires_at is not None and self.expires_at <= (now or datetime.now())
+
+    @property
+    def remaining_volume(self):
+        return self.volume - (self.filled_volume or Decimal('0'))
+
+    def reserved_for(self, volume):
+        """The part of the funds reserved in `create_order` that covers `volume` of this order"""
+        if self.direction == DirectionType.ask.value:
+            return volume
+        return self.price_for(volume)
+
+    def price_for(self, volume, rounding=ROUND_DOWN):
+        """The part of `price` that pays for `volume` of this order"""
+        return (self.price * volume / self.volume).quantize(VOLUME_QUANTUM, rounding=rounding)
+
+    def release(self, session, volume):
+        """
+        Makes `volume` of what this order reserved available to its user again, without touching the ledger. Once the
+        order is executed or cancelled its reservation is removed, so that must be the last of it.
+        """
+        if self.id is None:
+            session.flush()
+        # The reservation was flushed along with the order. Not flushing again here lets the balance below be updated
+        # together with its volume.
+        reservation = session.query(Reservation).filter(Reservation.order_id == self.id).autoflush(False)
+        if self.state in (OrderStateType.executed.value, OrderStateType.cancelled.value):
+            reservation.delete(synchronize_session=False)
+        elif volume:
+            reservation.update({Reservation.volume: Reservation.volume - volume}, synchronize_session=False)
+
+        asset_id = self.asset_id if self.direction == DirectionType.bid.value else self.contract.contract_asset_id
+        if volume:
+            Balance.release(session, self.user_id, asset_id, volume)
+
+    def cancel(self, session, commit=None, lock=True):
+        # A matcher may be filling this order right now; wait for it and look at the state it left behind. Callers that
+        # have locked the order already pass `lock=False`.
+        if lock and self.id is not None:
+            session.query(Order).filter(Order.id == self.id).with_for_update().populate_existing().one()
 
-    def cancel(self, session):
         if self.state in (OrderStateType.created.value, OrderStateType.in_market.value):
-            if self.direction == DirectionType.ask.value:
-                asset = self.contract.contract_asset
-                volume = self.volume
-            else:
-                asset = self.asset
-                volume = self.price
+            # Only the part that has not been filled yet is still reserved
+            volume = self.reserved_for(self.volume) - self.reserved_for(self.filled_volume or Decimal('0'))
             self.state = OrderStateType.cancelled.value
-            self.user.increase_volume_of_asset(session, asset, volume)
             session.add(self)
-            session.commit()
+            self.release(session, volume)
+            commit_or_flush(session, commit)
             return True
         else:
-            logger.warning('Tried to cancel and refund order {}, but it is in state {}'.format(self.id, self.state))
+            logger.warning('Tried to cancel order %s, but it is in state %s', self.id, self.state)
             return False
 
+    @staticmethod
+    def compute_unit_price(price, volume):
+        if price is None or not volume:
+            return None
+        return (price / volume).quantize(PRICE_QUANTUM)
+
     @property
     def price_to_volume(self):
-        return self.price / self.volume
+        if self.unit_price is not None:
+            return self.unit_price
+        return self.compute_unit_price(self.price, self.volume)
 
 
 class Transaction(Base):
@@ -106,7 +199,8 @@ class Transaction(Base):
     """Basically an executed `Order` -- of course with corresponding buying/selling party"""
 
     __tablename__ = 'transactions'
-    __table_args__ = (UniqueConstraint('ask_order_id', 'bid_order_id'),)
+    __table_args__ = (UniqueConstraint('ask_order_id', 'bid_order_id'),
+                      Index('ix_transactions_contract', 'contract_id', 'id'))
 
     id = Column(Integer, primary_key=True)
 
@@ -127,18 +221,130 @@ class Transaction(Base):
 
     contract = relationship('Contract', backref=backref('transactions', order_by=id.desc(), lazy='dynamic'))
     ask_order = relationship('Order', uselist=False, foreign_keys=[ask_order_id],
-                             backref=backref('executed_ask', uselist=False))
+                             backref=backref('ask_transactions', order_by=id))
     bid_order = relationship('Order', uselist=False, foreign_keys=[bid_order_id],
-                             backref=backref('executed_bid', uselist=False))
+                             backref=backref('bid_transactions', order_by=id))
     asset = relationship('Asset')
 
-    def execute_trade(self, session):
+    @timed(EXECUTE_TRADE_SECONDS)
+    def execute_trade(self, session, bid_released=None):
+        """
+        Moves `price` from the bid side to the ask side and `volume` of the contract the other way. Both orders release
+        what they reserved for this volume first: the ask side `volume`, the bid side `bid_released`, which is more than
+        `price` if it pays less than its own price (`price` by default).
+        """
         if self.executed_at is not None:
             return
-
-        # Note that we have already *decreased* the volumes when we initially created the orders
-        self.bid_order.user.increase_volume_of_asset(session, self.contract.contract_asset, self.volume)
-        self.ask_order.user.increase_volume_of_asset(session, self.asset, self.price)
+        # Set before anything is flushed, so that the transaction is inserted in one statement
         self.executed_at = datetime.now()
+
+        # Lock every balance this trade changes up front and in a fixed order, so concurrent trades cannot deadlock
+        bid_user, ask_user = self.bid_order.user, self.ask_order.user
+        if bid_user.id is None or ask_user.id is None:
+            session.flush()
+        contract_asset = self.contract.contract_asset
+        Balance.lock(session, [(bid_user.id, contract_asset.id), (ask_user.id, self.asset.id),
+                               (bid_user.id, self.asset.id), (ask_user.id, contract_asset.id)])
+
+        self.bid_order.release(session, self.price if bid_released is None else bid_released)
+        self.ask_order.release(session, self.volume)
+        bid_user.decrease_volume_of_asset(session, self.asset, self.price)
+        bid_user.increase_volume_of_asset(session, contract_asset, self.volume)
+        ask_user.decrease_volume_of_asset(session, contract_asset, self.volume)
+        ask_user.increase_volume_of_asset(session, self.asset, self.price)
         session.add(self)
         return True
+
+
+class Reservation(Base):
+
+    """What one open order holds of its user's `Balance`, in `asset`; removed once the order is executed or cancelled"""
+
+    __tablename__ = 'reservations'
+    __table_args__ = (Index('ix_reservations_user_asset', 'user_id', 'asset_id'),)
+
+    order_id = Column(Integer, ForeignKey('orders.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    asset_id = Column(Integer, ForeignKey('assets.id'), nullable=False)
+    # What is still reserved; it goes down as the order is filled
+    volume = Column(Numeric(precision=10, scale=4), nullable=False)
+
+    order = relationship(Order, backref=backref('reservation', uselist=False))
+
+    def __repr__(self):
+        return "<Reservation of order {}>".format(self.order_id)
+
+    @classmethod
+    def place(cls, session, user, asset_id, volume):
+        """Reserves `volume` of `asset_id` for a new order of `user`; None if that much is not available"""
+        user_id = instance_id(user)
+        if user_id is None:
+            session.flush()
+            user_id = user.id
+        if volume and not Balance.hold(session, user_id, asset_id, volume):
+            return None
+        return cls(user_id=user_id, asset_id=asset_id, volume=volume)
+
+    @classmethod
+    def totals(cls, session):
+        """`{(user_id, asset_id): volume}` summed over all reservations"""
+        reserved = session.query(cls.user_id, cls.asset_id, func.sum(cls.volume)).group_by(cls.user_id, cls.asset_id)
+        return dict(((user_id, asset_id), volume) for user_id, asset_id, volume in reserved)
+
+    @classmethod
+    def verify(cls, session):
+        """
+        Returns `(user_id, asset_id, reserved_by_orders, balance_reserved)` for each balance whose `reserved` differs
+        from the sum of its reservations
+        """
+        reserved_by_orders = cls.totals(session)
+        balance_reserved = dict(((user_id, asset_id), reserved) for user_id, asset_id, reserved in
+                                session.query(Balance.user_id, Balance.asset_id, Balance.reserved))
+
+        mismatches = []
+        for user_id, asset_id in sorted(set(reserved_by_orders) | set(balance_reserved)):
+            by_orders = reserved_by_orders.get((user_id, asset_id)) or Decimal('0')
+            reserved = balance_reserved.get((user_id, asset_id)) or Decimal('0')
+            if by_orders != reserved:
+                mismatches.append((user_id, asset_id, by_orders, reserved))
+
+        return mismatches
+
+    @classmethod
+    def rebuild(cls, session):
+        """Recomputes `Balance.reserved` from the reservations"""
+        reservations, balances = cls.__table__, Balance.__table__
+        reserved = select([func.coalesce(func.sum(reservations.c.volume), 0)])\
+            .where(and_(reservations.c.user_id == balances.c.user_id, reservations.c.asset_id == balances.c.asset_id))\
+            .as_scalar()
+        session.execute(balances.update().values(reserved=reserved))
+        session.expire_all()
+        logger.info('Rebuilt reserved balances from the reservations')
+
+
+def reserve_open_orders(session, commit=None):
+    """
+    Moves the funds of orders that were opened before there were reservations, which `create_order` took out of the
+    ledger, back to the ledger and into a `Reservation`. Returns how many orders were converted.
+    """
+    open_states = (OrderStateType.created.value, OrderStateType.in_market.value)
+    orders = session.query(Order)\
+        .outerjoin(Reservation, Reservation.order_id == Order.id)\
+        .filter(Order.state.in_(open_states), Reservation.order_id.is_(None))\
+        .order_by(Order.id)\
+        .all()
+
+    for order in orders:
+        asset = order.asset if order.direction == DirectionType.bid.value else order.contract.contract_asset
+        volume = order.reserved_for(order.volume) - order.reserved_for(order.filled_volume or Decimal('0'))
+        if volume:
+            holding = Holding.create_holding(session, order.user, asset, volume, source='InternalTrade',
+                                             description='Reservation of order {}'.format(order.id))
+            session.add(holding)
+            Balance.record_holding(session, holding)
+            Balance.hold(session, order.user_id, asset.id, volume)
+        session.add(Reservation(order=order, user_id=order.user_id, asset_id=asset.id, volume=volume))
+
+    commit_or_flush(session, commit)
+    logger.info('Moved the funds of %s open orders into reservations', len(orders))
+    return len(orders)
@@ -0,0 +1,28 @@
+"""Small SQL constructs that have to be spelled differently per dialect"""
+
+from sqlalchemy import Numeric
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+
+class truncate(FunctionElement):
+
+    """Truncates a numeric expression towards zero, keeping `scale` decimals"""
+
+    type = Numeric()
+    name = 'truncate'
+
+    def __init__(self, expression, scale):
+        self.scale = scale
+        super(truncate, self).__init__(expression)
+
+
+@compiles(truncate)
+def compile_truncate(element, compiler, **kw):
+    return 'trunc({}, {:d})'.format(compiler.process(element.clauses, **kw), element.scale)
+
+
+@compiles(truncate, 'sqlite')
+def compile_truncate_sqlite(element, compiler, **kw):
+    factor = 10 ** element.scale
+    return '(CAST(({}) * {:d} AS INTEGER) / {:d}.0)'.format(compiler.process(element.clauses, **kw), factor, factor)
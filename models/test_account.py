@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from models.testing import DatabaseTestCase
+from models.account import User, Holding, Balance, ArchivedHolding, compact_holdings
+from models.asset import Asset
+
+
+class BalanceTest(DatabaseTestCase):
+    def test_balance_follows_ledger(self):
+        user = User.create_user(self.session, 'user', 'abcd')
+        usd = Asset.create_asset('USD')
+        user.increase_volume_of_asset(self.session, usd, Decimal('10'))
+        user.decrease_volume_of_asset(self.session, usd, Decimal('3.5'))
+
+        # Overdrawing is refused based on the balance
+        assert user.decrease_volume_of_asset(self.session, usd, Decimal('7')) is None
+        self.session.commit()
+
+        assert user.volume_of_asset(self.session, usd) == Decimal('6.5')
+        assert Holding.current_holdings_for_user(self.session, user) == \
+            Holding.ledger_holdings_for_user(self.session, user)
+        assert Balance.verify(self.session) == []
+
+    def test_verify_and_rebuild(self):
+        user = User.create_user(self.session, 'user', 'abcd')
+        usd = Asset.create_asset('USD')
+        user.increase_volume_of_asset(self.session, usd, Decimal('10'))
+        self.session.commit()
+
+        Balance.get(self.session, user, usd).volume = Decimal('12')
+        self.session.commit()
+        assert Balance.verify(self.session) == [(user.id, usd.id, Decimal('10'), Decimal('12'))]
+
+        Balance.rebuild(self.session)
+        self.session.commit()
+        assert Balance.verify(self.session) == []
+        assert user.volume_of_asset(self.session, usd) == Decimal('10')
+
+    def test_users_that_hold_asset(self):
+        users = [User.create_user(self.session, 'user{}'.format(i), 'abcd') for i in range(3)]
+        usd, btc = Asset.create_asset('USD'), Asset.create_asset('BTC')
+        users[0].increase_volume_of_asset(self.session, usd, Decimal('1'))
+        users[2].increase_volume_of_asset(self.session, usd, Decimal('2'))
+        users[1].increase_volume_of_asset(self.session, btc, Decimal('3'))
+        self.session.commit()
+
+        assert Holding.users_that_hold_asset(self.session, usd) == [(users[0], Decimal('1')), (users[2], Decimal('2'))]
+        assert list(Holding.iter_users_that_hold_asset(self.session, usd, exclude_user=users[0], chunk_size=1)) == \
+            [(users[2], Decimal('2'))]
+
+    def test_compact_holdings(self):
+        users = [User.create_user(self.session, 'user{}'.format(i), 'abcd') for i in range(3)]
+        usd, btc = Asset.create_asset('USD'), Asset.create_asset('BTC')
+        for user in users:
+            user.increase_volume_of_asset(self.session, usd, Decimal('10'))
+            user.decrease_volume_of_asset(self.session, usd, Decimal('2.5'))
+        users[0].increase_volume_of_asset(self.session, btc, Decimal('1'))
+        users[0].decrease_volume_of_asset(self.session, btc, Decimal('1'))
+        self.session.commit()
+
+        cutoff = datetime.now() + timedelta(seconds=1)
+        recent = users[1].increase_volume_of_asset(self.session, usd, Decimal('1'))
+        recent.created_at = cutoff + timedelta(seconds=1)
+        self.session.commit()
+        balances = [Holding.current_holdings_for_user(self.session, user) for user in users]
+
+        assert compact_holdings(self.session, cutoff, chunk_size=2) == 8
+        assert compact_holdings(self.session, cutoff, chunk_size=2) == 0
+        assert self.session.query(ArchivedHolding).count() == 8
+
+        # One snapshot per user and asset, except where everything cancelled out; newer holdings stay as they are
+        assert sorted((holding.user_id, holding.asset_id, holding.volume, holding.source)
+                      for holding in self.session.query(Holding)) == sorted(
+            [(user.id, usd.id, Decimal('7.5'), 'Snapshot') for user in users] +
+            [(users[1].id, usd.id, Decimal('1'), 'InternalTrade')])
+        assert [Holding.current_holdings_for_user(self.session, user) for user in users] == balances
+        assert [dict((asset_id, volume) for asset_id, volume in Holding.ledger_holdings_for_user(self.session, user)
+                     .items() if volume) for user in users] == \
+            [dict((asset_id, volume) for asset_id, volume in balance.items() if volume) for balance in balances]
+        assert Balance.verify(self.session) == []
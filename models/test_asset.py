@@ -0,0 +1,72 @@
+from datetime import datetime
+
+from models import Session
+from models.testing import DatabaseTestCase
+from models.asset import Asset, get_asset, find_asset, asset_removed, load_assets, refresh_assets
+
+
+class AssetRegistryTest(DatabaseTestCase):
+    def setUp(self):
+        super(AssetRegistryTest, self).setUp()
+        # Assets are only shared once the transaction that added them commits, which savepoints do not
+        self.other_session = Session(bind=self.connection)
+        self.btc = Asset.create_asset(' btc ')
+        self.other_session.add(self.btc)
+        self.other_session.commit()
+
+    def tearDown(self):
+        self.other_session.close()
+        super(AssetRegistryTest, self).tearDown()
+
+    def test_lookups_are_cached(self):
+        info = get_asset(self.session, self.btc.id)
+        assert (info.name, info.removed) == ('BTC', False)
+
+        # An expired instance is not loaded again to find out whether it was removed
+        btc = self.session.query(Asset).get(self.btc.id)
+        self.session.expire(btc)
+        with self.assertQueryBudget(0):
+            assert get_asset(self.session, self.btc.id) is info
+            assert find_asset(self.session, 'Btc ') is info
+            assert asset_removed(self.session, btc) is False
+        assert get_asset(self.session, self.btc.id + 1) is None
+        assert find_asset(self.session, 'ETH') is None
+
+    def test_remove(self):
+        assert not get_asset(self.session, self.btc.id).removed
+
+        # The session that removes an asset sees it right away; everybody else once it has committed
+        btc = self.other_session.query(Asset).get(self.btc.id)
+        btc.remove(self.other_session)
+        assert get_asset(self.other_session, btc.id).removed
+        assert find_asset(self.other_session, 'BTC') is None
+        assert not get_asset(self.session, btc.id).removed
+
+        self.other_session.commit()
+        assert get_asset(self.session, btc.id).removed
+        assert find_asset(self.session, 'BTC') is None
+
+    def test_rolled_back_assets_are_not_shared(self):
+        eth = Asset.create_asset('ETH')
+        self.other_session.add(eth)
+        self.other_session.flush()
+        assert find_asset(self.other_session, 'ETH').id == eth.id
+
+        self.other_session.rollback()
+        assert find_asset(self.session, 'ETH') is None
+
+    def test_refresh(self):
+        assert load_assets(self.session) == 1
+        assert refresh_assets(self.session) is False
+
+        # What another process changes shows up in the registry once it is refreshed
+        self.connection.execute(Asset.__table__.insert().values(name='ETH'))
+        self.connection.execute(Asset.__table__.update().where(Asset.id == self.btc.id)
+                                .values(name=None, previous_name='BTC', removed_at=datetime.now()))
+        assert find_asset(self.session, 'BTC').id == self.btc.id
+
+        assert refresh_assets(self.session) is True
+        assert find_asset(self.session, 'BTC') is None
+        assert get_asset(self.session, self.btc.id).removed
+        assert find_asset(self.session, 'ETH') is not None
+        assert refresh_assets(self.session) is False
@@ -0,0 +1,49 @@
+import threading
+
+from models.testing import DatabaseTestCase
+from models.account import User
+from models.budget import SQL_STATEMENTS, query_budget
+
+
+class QueryBudgetTest(DatabaseTestCase):
+    def setUp(self):
+        super(QueryBudgetTest, self).setUp()
+        # Begin the savepoint now, so that it is not counted in the tests
+        self.connection = self.session.connection()
+
+    def test_counts_statements_and_rows(self):
+        User.create_user(self.session, 'first', 'abcd')
+        User.create_user(self.session, 'second', 'abcd')
+        statements = SQL_STATEMENTS.labels('rename').value
+
+        with query_budget('rename') as outer:
+            self.session.flush()
+            with self.assertLogs(level='WARNING'):
+                with query_budget('rename', max_statements=0) as inner:
+                    self.session.execute("UPDATE users SET username = username || '!'")
+
+        # Budgets nest; the inner one only sees its own block
+        assert (outer.statements, inner.statements) == (3, 1)
+        assert (outer.rows, inner.rows) == (4, 2)
+        assert outer.seconds >= inner.seconds > 0
+        assert outer.executed[-1] == inner.executed[0] == "UPDATE users SET username = username || '!'"
+        assert inner.exceeded() and not outer.exceeded()
+        assert SQL_STATEMENTS.labels('rename').value == statements + 4
+
+    def test_budgets_belong_to_their_thread(self):
+        with query_budget('main') as budget:
+            thread = threading.Thread(target=self.connection.execute, args=('SELECT 1',))
+            thread.start()
+            thread.join()
+        assert budget.statements == 0
+
+    def test_assert_query_budget(self):
+        with self.assertQueryBudget(1):
+            self.session.execute('SELECT 1')
+
+        with self.assertRaises(AssertionError) as raised:
+            with self.assertQueryBudget(1):
+                self.session.execute('SELECT 1')
+                self.session.execute('SELECT 2')
+        assert 'Executed 2 statements, 1 over the budget of 1' in str(raised.exception)
+        assert '2. SELECT 2' in str(raised.exception)
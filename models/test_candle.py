@@ -0,0 +1,49 @@
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+from models.testing import MarketTestCase
+from models.candle import Candle, backfill_candles, bucket_start
+from models.order import Order, Transaction
+from models.consts import OrderType
+from market.market import put_order
+
+
+class CandleTest(MarketTestCase):
+    def trade(self, price, volume):
+        for user, is_bid in ((self.issuer, False), (self.buyer, True)):
+            order = Order.create_order(self.session, user, price, self.usd, self.contract, volume, is_bid,
+                                       OrderType.limit_order.value)
+            transactions = put_order(self.session, order)
+        return transactions[0]
+
+    def candles(self, interval):
+        return [(candle.open, candle.high, candle.low, candle.close, candle.volume, candle.trades)
+                for candle in Candle.for_contract(self.session, self.contract, interval)]
+
+    def test_bucket_start(self):
+        timestamp = datetime(2016, 3, 4, 5, 6, 7, 8)
+        assert bucket_start(timestamp, 1) == datetime(2016, 3, 4, 5, 6, 7)
+        assert bucket_start(timestamp, 60) == datetime(2016, 3, 4, 5, 6)
+        assert bucket_start(timestamp, 86400) == datetime(2016, 3, 4)
+
+    def test_candles_follow_trades_and_backfill(self):
+        for price, volume in ((Decimal('5'), Decimal('10')), (Decimal('8'), Decimal('10')),
+                              (Decimal('2'), Decimal('5')), (Decimal('3'), Decimal('5'))):
+            self.trade(price, volume)
+
+        # All four trades fall in the same day
+        expected = (Decimal('0.5'), Decimal('0.8'), Decimal('0.4'), Decimal('0.6'), Decimal('30'), 4)
+        assert self.candles(86400) == [expected]
+        assert sum(trades for _, _, _, _, _, trades in self.candles(1)) == 4
+
+        # Move the trades into the past and drop the candles, as if they had happened before candles were kept
+        for transaction in self.session.query(Transaction):
+            transaction.executed_at -= timedelta(days=1)
+        self.session.query(Candle).delete()
+        self.session.commit()
+        latest = self.trade(Decimal('7'), Decimal('10'))
+
+        assert backfill_candles(self.session, self.contract, chunk_size=3) == 4
+        assert backfill_candles(self.session, self.contract, chunk_size=3) == 0
+        assert self.candles(86400) == [expected, (Decimal('0.7'),) * 4 + (Decimal('10'), 1)]
+        assert self.session.query(Candle).filter(Candle.first_transaction_id == latest.id).count() == 4
@@ -0,0 +1,115 @@
+import csv
+import gzip
+import json
+import os
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+
+from models.testing import DatabaseTestCase
+from models.account import User, Holding
+from models.asset import Asset
+from models.consts import OrderStateType
+from models.export import export_table
+from models.order import Order
+
+
+class ExportTest(DatabaseTestCase):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super(ExportTest, self).tearDown()
+
+    def read(self, name):
+        rows = []
+        for filename in sorted(os.listdir(self.directory.name)):
+            if filename.startswith(name) and filename.endswith('.csv.gz'):
+                with gzip.open(os.path.join(self.directory.name, filename), 'rt', newline='') as f:
+                    rows.extend(list(csv.reader(f))[1:])
+        return rows
+
+    def test_export_resumes_where_it_stopped(self):
+        user = User.create_user(self.session, 'user', 'abcd')
+        usd = Asset.create_asset('USD')
+        for volume in range(1, 6):
+            user.increase_volume_of_asset(self.session, usd, Decimal(volume))
+        self.session.commit()
+
+        connection = self.session.connection()
+        assert export_table(connection, 'holdings', self.directory.name, chunk_size=2, chunks_per_file=2) == 5
+        assert sorted(os.listdir(self.directory.name)) == ['checkpoint.json', 'holdings-000000.csv.gz',
+                                                           'holdings-000001.csv.gz']
+
+        # Only what was added since the last run is exported again
+        user.increase_volume_of_asset(self.session, usd, Decimal('6'))
+        self.session.commit()
+        assert export_table(connection, 'holdings', self.directory.name, chunk_size=2, chunks_per_file=2) == 1
+        assert export_table(connection, 'holdings', self.directory.name, chunk_size=2, chunks_per_file=2) == 0
+
+        rows = self.read('holdings')
+        assert [Decimal(row[3]) for row in rows] == [Decimal(volume) for volume in range(1, 7)]
+        assert [int(row[0]) for row in rows] == sorted(int(row[0]) for row in rows)
+
+    def pending(self, name):
+        with open(os.path.join(self.directory.name, 'checkpoint.json')) as f:
+            return json.load(f)[name]['pending']
+
+    def test_rows_committed_late_are_exported(self):
+        user = User.create_user(self.session, 'user', 'abcd')
+        usd = Asset.create_asset('USD')
+        holdings = [user.increase_volume_of_asset(self.session, usd, Decimal(volume)) for volume in range(1, 6)]
+        self.session.commit()
+
+        # Until it commits, a row with a lower id than the others is missing
+        holdings_table = Holding.__table__
+        late = self.session.execute(holdings_table.select().where(holdings_table.c.id == holdings[2].id)).fetchone()
+        self.session.execute(holdings_table.delete().where(holdings_table.c.id == late.id))
+
+        connection = self.session.connection()
+        assert export_table(connection, 'holdings', self.directory.name, chunk_size=2) == 4
+        assert self.pending('holdings') == [late.id]
+
+        self.session.execute(holdings_table.insert().values(**dict(late)))
+        assert export_table(connection, 'holdings', self.directory.name, chunk_size=2) == 1
+        assert self.pending('holdings') == []
+        assert sorted(int(row[0]) for row in self.read('holdings')) == [holding.id for holding in holdings]
+
+    def test_missing_rows_are_given_up_after_the_gap_window(self):
+        user = User.create_user(self.session, 'user', 'abcd')
+        usd = Asset.create_asset('USD')
+        holdings = [user.increase_volume_of_asset(self.session, usd, Decimal(volume)) for volume in range(1, 6)]
+        self.session.commit()
+        self.session.delete(holdings[1])
+        self.session.commit()
+
+        connection = self.session.connection()
+        assert export_table(connection, 'holdings', self.directory.name, gap_window=10) == 4
+        assert self.pending('holdings') == [holdings[1].id]
+
+        # Three ids below the highest one, it is taken to be rolled back
+        assert export_table(connection, 'holdings', self.directory.name, gap_window=2) == 0
+        assert self.pending('holdings') == []
+
+    def test_open_orders_wait_until_they_are_closed(self):
+        user = User.create_user(self.session, 'user', 'abcd')
+        usd = Asset.create_asset('USD')
+        orders = [Order(user=user, asset=usd, price=Decimal('1'), volume=Decimal('1'), filled_volume=Decimal('0'),
+                        direction='Bid', order_type='LimitOrder', state=state, created_at=datetime.now())
+                  for state in (OrderStateType.executed.value, OrderStateType.in_market.value)]
+        self.session.add_all(orders)
+        self.session.commit()
+
+        connection = self.session.connection()
+        assert export_table(connection, 'orders', self.directory.name) == 1
+        assert self.pending('orders') == [orders[1].id]
+
+        # Only the final state of an order is exported
+        orders[1].state = OrderStateType.cancelled.value
+        self.session.commit()
+        assert export_table(connection, 'orders', self.directory.name, gap_window=0) == 1
+        assert self.pending('orders') == []
+        assert [(int(row[0]), row[-2]) for row in self.read('orders')] == \
+            [(orders[0].id, OrderStateType.executed.value), (orders[1].id, OrderStateType.cancelled.value)]
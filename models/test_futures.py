@@ -1,37 +1,22 @@
-import os
-import unittest
 from decimal import Decimal
 from datetime import datetime, timedelta
 
 from sqlalchemy import inspect
-from sqlalchemy.engine import create_engine
-from sqlalchemy.orm import sessionmaker
 
-from models import Base
-from models.account import User
+from models.testing import DatabaseTestCase
+from models.account import User, Balance
 from models.asset import Asset
 from models.order import Order, Transaction
-from models.contract import FuturesContract
+from models.contract import FuturesContract, expire_due_contracts
 from models.consts import OrderType
 from market.market import put_order
 
 
-# We use Postgres for testing since SQLite doesn't have an INTERVAL data type
-engine = create_engine('postgres://btcex:{}@localhost:5432/btcex_test'.format(os.environ.get('BTCEX_TEST_PW')))
-Session = sessionmaker(bind=engine)
-
-
-class FuturesTest(unittest.TestCase):
+class FuturesTest(DatabaseTestCase):
     def setUp(self):
-        self.session = Session()
-        Base.metadata.drop_all(bind=engine)
-        Base.metadata.create_all(bind=engine)
+        super(FuturesTest, self).setUp()
         self.now = datetime.now()
 
-    def tearDown(self):
-        self.session.commit()
-        Base.metadata.drop_all(bind=engine)
-
     def test_normal_scenario_with_two_users(self):
         # First create some users
         user1 = User.create_user(self.session, 'user1', 'abcd')
@@ -58,7 +43,7 @@ class FuturesTest(unittest.TestCase):
         self.session.commit()
 
         # Put order into market
-        assert put_order(self.session, ask_order) is None
+        assert put_order(self.session, ask_order) == []
 
         # Create a bid order from user2
         user2.increase_volume_of_asset(self.session, usd, Decimal('20'))
@@ -67,7 +52,9 @@ class FuturesTest(unittest.TestCase):
         # Make sure we have enough funds
         assert bid_order1 is not None
 
-        transaction = put_order(self.session, bid_order1)
+        transactions = put_order(self.session, bid_order1)
+        assert len(transactions) == 1
+        transaction = transactions[0]
         assert isinstance(transaction, Transaction)
         assert transaction.ask_order is ask_order
         assert transaction.bid_order is bid_order1
@@ -136,7 +123,7 @@ class FuturesTest(unittest.TestCase):
         assert contract.cancel(self.session) is False
 
         # Put order into market
-        assert put_order(self.session, ask_order) is None
+        assert put_order(self.session, ask_order) == []
 
         # Assert that we cannot cancel the contract if there are orders in the market
         assert contract.cancel(self.session) is False
@@ -149,3 +136,29 @@ class FuturesTest(unittest.TestCase):
         assert contract.cancel(self.session) is True
         assert inspect(contract).deleted is False
         assert contract.cancelled is True
+
+    def test_expire_due_contracts(self):
+        users = [User.create_user(self.session, 'user{}'.format(i), 'abcd') for i in range(3)]
+        btc = Asset.create_asset('BTC')
+        users[0].increase_volume_of_asset(self.session, btc, Decimal('2'))
+
+        due, _ = FuturesContract.create_contract(self.session, users[0], self.now + timedelta(days=1), btc,
+                                                 Decimal('1'), 'DUE', Decimal('3'))
+        later, _ = FuturesContract.create_contract(self.session, users[0], self.now + timedelta(days=14), btc,
+                                                   Decimal('1'), 'LATER', Decimal('3'))
+        for user in users[1:]:
+            users[0].decrease_volume_of_asset(self.session, due.contract_asset, Decimal('1'))
+            user.increase_volume_of_asset(self.session, due.contract_asset, Decimal('1'))
+        self.session.commit()
+
+        assert expire_due_contracts(self.session, self.now + timedelta(days=2)) == [due]
+        assert due.expired is True
+        assert later.expired is False
+
+        # Every holder gets a third; the rounding remainder goes to the lowest user id since they all hold as much
+        assert [user.volume_of_asset(self.session, btc) for user in users] == \
+            [Decimal('0.3334'), Decimal('0.3333'), Decimal('0.3333')]
+        assert Balance.verify(self.session) == []
+
+        # Nothing is due anymore
+        assert expire_due_contracts(self.session, self.now + timedelta(days=2)) == []
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+from urllib.request import urlopen
+
+from models.metrics import Registry, Stopwatch, counter, histogram, timed, dump, serve
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        orders = counter('orders_total', 'Orders', registry=self.registry)
+        rejected = counter('rejected_total', 'Rejected orders', ['reason'], registry=self.registry)
+        orders.inc()
+        orders.inc(2)
+        rejected.labels('funds').inc()
+
+        assert orders.value == 3
+        assert counter('orders_total', 'Orders', registry=self.registry) is orders
+        with self.assertRaises(ValueError):
+            histogram('orders_total', 'Orders', registry=self.registry)
+        with self.assertRaises(ValueError):
+            rejected.inc()
+
+        assert self.registry.render() == '\n'.join([
+            '# HELP orders_total Orders',
+            '# TYPE orders_total counter',
+            'orders_total 3',
+            '# HELP rejected_total Rejected orders',
+            '# TYPE rejected_total counter',
+            'rejected_total{reason="funds"} 1',
+        ]) + '\n'
+
+    def test_histogram(self):
+        seconds = histogram('seconds', 'Latency', ['stage'], buckets=(0.1, 1), registry=self.registry)
+        for value in (0.05, 0.05, 0.5, 0.5, 2):
+            seconds.labels('commit').observe(value)
+
+        lines = self.registry.render().splitlines()
+        assert lines[2:] == [
+            'seconds_bucket{stage="commit",le="0.1"} 2',
+            'seconds_bucket{stage="commit",le="1.0"} 4',
+            'seconds_bucket{stage="commit",le="+Inf"} 5',
+            'seconds_sum{stage="commit"} 3.1',
+            'seconds_count{stage="commit"} 5',
+        ]
+
+        # Interpolated within the bucket the quantile falls in; above the highest bound it is that bound
+        commit = seconds.labels('commit')
+        assert commit.quantile(0.2) == 0.05
+        assert abs(commit.quantile(0.6) - 0.55) < 1e-9
+        assert commit.quantile(0.99) == 1
+        assert seconds.labels('lookup').quantile(0.99) is None
+
+    def test_timing(self):
+        seconds = histogram('seconds', 'Latency', registry=self.registry)
+
+        @timed(seconds)
+        def fail():
+            raise ZeroDivisionError
+
+        with self.assertRaises(ZeroDivisionError):
+            fail()
+        with seconds.time():
+            pass
+        assert seconds.labels().count == 2
+
+        stages = histogram('stage_seconds', 'Latency by stage', ['stage'], registry=self.registry)
+        stopwatch = Stopwatch()
+        stopwatch.lap('lookup')
+        stopwatch.lap('execute')
+        stopwatch.lap('lookup')
+        stopwatch.observe(stages)
+        assert [(label_values, child.count) for label_values, child in sorted(stages._children.items())] == \
+            [(('execute',), 1), (('lookup',), 1), (('total',), 1)]
+        assert stages.labels('total').sum >= stages.labels('lookup').sum
+
+    def test_dump_and_serve(self):
+        counter('orders_total', 'Orders', registry=self.registry).inc()
+        expected = self.registry.render()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'btcex.prom')
+            dump(path, self.registry)
+            with open(path) as f:
+                assert f.read() == expected
+
+        server = serve(0, registry=self.registry)
+        try:
+            with urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1])) as response:
+                assert response.read().decode('utf-8') == expected
+        finally:
+            server.shutdown()
+            server.server_close()
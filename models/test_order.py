@@ -0,0 +1,85 @@
+from decimal import Decimal
+from datetime import datetime
+
+from models.testing import MarketTestCase
+from models.account import Holding, Balance
+from models.order import Order, Reservation, reserve_open_orders
+from models.consts import OrderType, OrderStateType
+from market.market import put_order
+
+
+class ReservationTest(MarketTestCase):
+    def bid(self, price, volume):
+        return Order.create_order(self.session, self.buyer, price, self.usd, self.contract, volume, True,
+                                  OrderType.limit_order.value)
+
+    def reserved(self, user, asset):
+        return Balance.get(self.session, user, asset).reserved
+
+    def test_hold_and_release_without_ledger(self):
+        holdings = self.session.query(Holding).count()
+        order = self.bid(Decimal('60'), Decimal('10'))
+        self.session.commit()
+
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('40')
+        assert self.reserved(self.buyer, self.usd) == Decimal('60')
+        assert [(r.order_id, r.volume) for r in self.session.query(Reservation)] == [(order.id, Decimal('60'))]
+
+        # Only what is available can be reserved
+        assert self.bid(Decimal('41'), Decimal('10')) is None
+        assert self.session.query(Order).count() == 1
+
+        assert order.cancel(self.session) is True
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('100')
+        assert self.reserved(self.buyer, self.usd) == Decimal('0')
+        assert self.session.query(Reservation).count() == 0
+        assert self.session.query(Holding).count() == holdings
+
+    def test_fill_releases_what_it_covers(self):
+        ask_order = Order.create_order(self.session, self.issuer, Decimal('5'), self.usd, self.contract,
+                                       Decimal('10'), False, OrderType.limit_order.value)
+        assert put_order(self.session, ask_order) == []
+        bid_order = self.bid(Decimal('12'), Decimal('20'))
+        assert len(put_order(self.session, bid_order)) == 1
+
+        # The bid paid 5 for half of its volume, and keeps 6 reserved for the other half
+        assert bid_order.state == OrderStateType.in_market.value
+        assert self.reserved(self.buyer, self.usd) == Decimal('6')
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('89')
+        assert self.reserved(self.issuer, self.future) == Decimal('0')
+        assert [(r.order_id, r.volume) for r in self.session.query(Reservation)] == [(bid_order.id, Decimal('6'))]
+        assert Reservation.verify(self.session) == []
+        assert Balance.verify(self.session) == []
+
+    def test_verify_and_rebuild(self):
+        self.bid(Decimal('30'), Decimal('10'))
+        self.session.commit()
+
+        Balance.get(self.session, self.buyer, self.usd).reserved = Decimal('0')
+        self.session.commit()
+        assert Reservation.verify(self.session) == [(self.buyer.id, self.usd.id, Decimal('30'), Decimal('0'))]
+
+        Reservation.rebuild(self.session)
+        self.session.commit()
+        assert Reservation.verify(self.session) == []
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('70')
+
+    def test_reserve_open_orders(self):
+        # An order from before reservations: its funds were taken out of the ledger
+        order = Order(user=self.buyer, price=Decimal('30'), asset=self.usd, contract=self.contract,
+                      volume=Decimal('10'), unit_price=Decimal('3'), filled_volume=Decimal('0'),
+                      direction='Bid', order_type=OrderType.limit_order.value, state='InMarket',
+                      created_at=datetime.now())
+        self.buyer.decrease_volume_of_asset(self.session, self.usd, Decimal('30'))
+        self.session.add(order)
+        self.session.commit()
+
+        assert reserve_open_orders(self.session) == 1
+        assert reserve_open_orders(self.session) == 0
+        assert Balance.volume_for(self.session, self.buyer, self.usd) == Decimal('100')
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('70')
+        assert Reservation.verify(self.session) == []
+        assert Balance.verify(self.session) == []
+
+        assert order.cancel(self.session) is True
+        assert self.buyer.volume_of_asset(self.session, self.usd) == Decimal('100')
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from models.testing import DatabaseTestCase
+from models.account import User
+from models.asset import Asset
+from models.order import Order
+from models.contract import FuturesContract
+from models.consts import OrderType
+
+
+class IntervalTest(DatabaseTestCase):
+    def test_expires_in_round_trip(self):
+        user = User.create_user(self.session, 'user', 'abcd')
+        btc = Asset.create_asset('BTC')
+        user.increase_volume_of_asset(self.session, btc, Decimal('1'))
+        contract, asset = FuturesContract.create_contract(self.session, user, datetime.now() + timedelta(days=14), btc,
+                                                          Decimal('1'), 'FUTURE', Decimal('100'))
+        order = Order.create_order(self.session, user, Decimal('20'), btc, contract, Decimal('50'), False,
+                                   OrderType.limit_order.value)
+        order.expires_in = timedelta(hours=1, seconds=5)
+        self.session.commit()
+
+        self.session.expire(order)
+        assert order.expires_in == timedelta(hours=1, seconds=5)
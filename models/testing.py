@@ -0,0 +1,117 @@
+"""
+Base class for tests that need a database.
+
+Tests run against `BTCEX_TEST_DATABASE_URL`, an in-memory SQLite database by default. The schema is created once per
+test run; every test runs inside a transaction that is rolled back afterwards, so commits made by the code under test
+only release a savepoint.
+"""
+
+import os
+import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import event
+
+from models import Base, Session, configure, get_engine
+from models.budget import query_budget
+import models.contract  # noqa: F401 -- registers every table with `Base.metadata`
+import models.candle  # noqa: F401
+from market.book import clear_books
+from market.depth import clear_depths
+from models.account import User
+from models.asset import Asset, clear_assets
+from models.contract import FuturesContract
+
+
+configure(url=os.environ.get('BTCEX_TEST_DATABASE_URL', 'sqlite://'))
+
+_schema_created = False
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        global _schema_created
+        if not _schema_created:
+            engine = get_engine()
+            Base.metadata.drop_all(bind=engine)
+            Base.metadata.create_all(bind=engine)
+            _schema_created = True
+
+    def setUp(self):
+        self.connection = get_engine().connect()
+        self.transaction = self.connection.begin()
+        self.session = Session(bind=self.connection)
+        self.session.begin_nested()
+
+        event.listen(self.session, 'after_transaction_end', self._restart_savepoint)
+
+        # Ids are handed out again after a rollback, so books from earlier tests must not be reused
+        clear_books()
+        clear_depths()
+        clear_assets()
+
+    @staticmethod
+    def _restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
+
+    @contextmanager
+    def assertQueryBudget(self, max_statements):
+        """Fails the test when the block executes more than `max_statements` SQL statements, and lists them"""
+        with query_budget(self._testMethodName) as budget:
+            yield budget
+        if budget.statements > max_statements:
+            self.fail('Executed {} statements, {} over the budget of {}:\n{}'.format(
+                budget.statements, budget.statements - max_statements, max_statements, budget.report()))
+
+    def tearDown(self):
+        # Leave the last savepoint before closing, so that closing the session does not have to roll it back
+        event.remove(self.session, 'after_transaction_end', self._restart_savepoint)
+        self.session.rollback()
+        self.session.close()
+        if self.transaction.is_active:
+            self.transaction.rollback()
+        self.connection.close()
+        clear_books()
+        clear_depths()
+        clear_assets()
+
+
+class MarketFixture(object):
+
+    """
+    Creates an issuer with a futures contract on BTC and a buyer with 100 USD, using `self.session`. Set
+    `contract_count` for more contracts; the issuer puts up 1 BTC for each of them.
+    """
+
+    contract_count = 1
+
+    def create_market(self):
+        self.issuer = User.create_user(self.session, 'issuer', 'abcd')
+        self.buyer = User.create_user(self.session, 'buyer', 'abcd')
+        self.btc, self.usd = Asset.create_asset('BTC'), Asset.create_asset('USD')
+        self.issuer.increase_volume_of_asset(self.session, self.btc, Decimal(self.contract_count))
+        self.buyer.increase_volume_of_asset(self.session, self.usd, Decimal('100'))
+
+        if self.contract_count == 1:
+            names = ['FUTURE']
+        else:
+            names = ['FUTURE{}'.format(i) for i in range(self.contract_count)]
+        expires_at = datetime.now() + timedelta(days=14)
+        created = [FuturesContract.create_contract(self.session, self.issuer, expires_at, self.btc, Decimal('1'), name,
+                                                   Decimal('100')) for name in names]
+        self.contracts = [contract for contract, _ in created]
+        self.contract, self.future = created[0]
+        self.session.commit()
+
+
+class MarketTestCase(MarketFixture, DatabaseTestCase):
+
+    def setUp(self):
+        super(MarketTestCase, self).setUp()
+        self.create_market()
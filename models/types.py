@@ -0,0 +1,29 @@
+"""Column types that behave the same on every backend we run on"""
+
+from datetime import timedelta
+
+from sqlalchemy import Integer
+from sqlalchemy import Interval as BaseInterval
+from sqlalchemy.types import TypeDecorator
+
+
+class Interval(TypeDecorator):
+
+    """A native INTERVAL where there is one; on SQLite, the interval as a whole number of seconds"""
+
+    impl = BaseInterval
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'sqlite':
+            return dialect.type_descriptor(Integer())
+        return dialect.type_descriptor(BaseInterval())
+
+    def process_bind_param(self, value, dialect):
+        if dialect.name == 'sqlite' and value is not None:
+            return int(value.total_seconds())
+        return value
+
+    def process_result_value(self, value, dialect):
+        if dialect.name == 'sqlite' and value is not None:
+            return timedelta(seconds=value)
+        return value
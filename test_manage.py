@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from models import Base, make_engine
+import models.contract  # noqa: F401 -- registers every table with `Base.metadata`
+import models.candle  # noqa: F401
+
+
+MANAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manage.py')
+
+
+class ManageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///' + os.path.join(self.directory.name, 'btcex.db')
+        engine = make_engine(self.url)
+        Base.metadata.create_all(bind=engine)
+        engine.dispose()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def manage(self, *args):
+        environ = dict(os.environ, BTCEX_DATABASE_URL=self.url)
+        return subprocess.run([sys.executable, MANAGE] + list(args), env=environ, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, universal_newlines=True)
+
+    def test_commands_run_against_an_empty_database(self):
+        for args in (['verify_balances'], ['rebuild_balances'], ['reserve_open_orders'], ['compact_holdings'],
+                     ['export', os.path.join(self.directory.name, 'export')]):
+            result = self.manage(*args)
+            assert result.returncode == 0, result.stdout